@@ -0,0 +1,182 @@
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import case, delete, func, insert, select
+from app import db
+from models import CohortRollup, JournalEntry, JournalRollup, SiteSettings, User, upsert_statement
+
+# Reserved settings row holding when the rollups were last refreshed
+WATERMARK_SETTING = '_analytics_watermark'
+
+# Entries saved this long before the last refresh are looked at again, for
+# transactions that were still open while it ran (re-aggregating is harmless)
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+# Ratings are 1-10; histograms count each value
+RATING_VALUES = range(1, 11)
+
+# Rollup column prefix for each rated JournalEntry column
+RATING_METRICS = {
+    'mood': JournalEntry.mood_rating,
+    'energy': JournalEntry.energy_level,
+    'sleep': JournalEntry.sleep_quality,
+}
+
+# Days shown as steps of the retention funnel
+FUNNEL_DAYS = (1, 3, 7, 14, 21, 30)
+
+
+def cohort_expression(column):
+    """SQL for the YYYY-MM month of a datetime column"""
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return func.strftime('%Y-%m', column)
+    return func.to_char(column, 'YYYY-MM')
+
+
+def _rollup_query(cohorts):
+    """Aggregate every entry of the given cohorts per (cohort, day) in one grouped query
+
+    Histograms are built in the same pass with one conditional SUM per rating value.
+    """
+    cohort = cohort_expression(User.created_date).label('cohort')
+    columns = [
+        cohort,
+        JournalEntry.day_number,
+        func.count().label('entries'),
+        func.sum(case((JournalEntry.completed.is_(True), 1), else_=0)).label('completed_entries'),
+        func.coalesce(func.sum(JournalEntry.completion_percentage), 0).label('completion_total'),
+        func.coalesce(func.sum(JournalEntry.time_spent_minutes), 0).label('minutes_total'),
+        func.count(JournalEntry.time_spent_minutes).label('minutes_count'),
+    ]
+    for metric, column in RATING_METRICS.items():
+        columns.append(func.coalesce(func.sum(column), 0).label(f'{metric}_total'))
+        columns.append(func.count(column).label(f'{metric}_count'))
+        columns.extend(
+            func.sum(case((column == value, 1), else_=0)).label(f'{metric}_{value}')
+            for value in RATING_VALUES
+        )
+
+    return (
+        select(*columns)
+        .join(User, User.id == JournalEntry.user_id)
+        .where(cohort.in_(cohorts))
+        .group_by(cohort, JournalEntry.day_number)
+    )
+
+
+def _rollup_row(row, now):
+    values = row._asdict()
+    rollup = {'updated_date': now}
+    for metric in RATING_METRICS:
+        rollup[f'{metric}_histogram'] = json.dumps([values.pop(f'{metric}_{value}') for value in RATING_VALUES])
+    rollup.update(values)
+    return rollup
+
+
+def refresh_rollups(full=False):
+    """Bring the rollup tables up to date; the caller commits
+
+    Only cohorts with entries saved since the last refresh are re-aggregated
+    (all of them with ``full``), each with a single grouped query. Cohort sizes
+    are always recounted, as that's one small grouped query over users.
+    Returns the cohorts that were re-aggregated.
+    """
+    now = datetime.utcnow()
+    watermark = None if full else db.session.execute(
+        select(SiteSettings.setting_value).filter_by(setting_name=WATERMARK_SETTING)
+    ).scalar()
+
+    cohort = cohort_expression(User.created_date)
+    changed = select(cohort).distinct().join(JournalEntry, JournalEntry.user_id == User.id)
+    if watermark:
+        changed = changed.where(JournalEntry.updated_date > datetime.fromisoformat(watermark) - WATERMARK_OVERLAP)
+    cohorts = db.session.execute(changed).scalars().all()
+
+    if cohorts:
+        rows = [_rollup_row(row, now) for row in db.session.execute(_rollup_query(cohorts))]
+        db.session.execute(delete(JournalRollup).where(JournalRollup.cohort.in_(cohorts)))
+        if rows:
+            db.session.execute(insert(JournalRollup), rows)
+
+    cohort_sizes = db.session.execute(
+        select(
+            cohort.label('cohort'),
+            func.count().label('users'),
+            func.sum(case((User.subscription_status == 'active', 1), else_=0)).label('subscribers'),
+        ).group_by(cohort)
+    ).all()
+    db.session.execute(delete(CohortRollup))
+    if cohort_sizes:
+        db.session.execute(insert(CohortRollup), [dict(row._asdict(), updated_date=now) for row in cohort_sizes])
+
+    statement = upsert_statement(SiteSettings).values(
+        setting_name=WATERMARK_SETTING,
+        setting_value=now.isoformat(),
+        description='When the analytics rollups were last refreshed',
+        updated_date=now
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['setting_name'],
+        set_={'setting_value': statement.excluded.setting_value, 'updated_date': statement.excluded.updated_date}
+    ))
+    return cohorts
+
+
+def rollups_updated_at():
+    """When the rollups were last refreshed, or None if they never were"""
+    watermark = db.session.execute(
+        select(SiteSettings.setting_value).filter_by(setting_name=WATERMARK_SETTING)
+    ).scalar()
+    return datetime.fromisoformat(watermark) if watermark else None
+
+
+def _average(total, count):
+    return round(total / count, 1) if count else None
+
+
+def day_summaries(cohort=None):
+    """Averages and rating distributions per journal day, for one cohort or all of them"""
+    query = select(JournalRollup).order_by(JournalRollup.day_number)
+    if cohort:
+        query = query.filter_by(cohort=cohort)
+
+    days = {}
+    for rollup in db.session.execute(query).scalars():
+        day = days.setdefault(rollup.day_number, {'day_number': rollup.day_number, 'entries': 0,
+                                                  'completed_entries': 0, 'completion_total': 0,
+                                                  'minutes_total': 0, 'minutes_count': 0})
+        for field in ('entries', 'completed_entries', 'completion_total', 'minutes_total', 'minutes_count'):
+            day[field] += getattr(rollup, field)
+        for metric in RATING_METRICS:
+            day[f'{metric}_total'] = day.get(f'{metric}_total', 0) + getattr(rollup, f'{metric}_total')
+            day[f'{metric}_count'] = day.get(f'{metric}_count', 0) + getattr(rollup, f'{metric}_count')
+            histogram = json.loads(getattr(rollup, f'{metric}_histogram'))
+            day[f'{metric}_histogram'] = [a + b for a, b in zip(day.get(f'{metric}_histogram', [0] * 10), histogram)]
+
+    summaries = []
+    for day in days.values():
+        day['average_completion'] = _average(day['completion_total'], day['entries'])
+        day['average_minutes'] = _average(day['minutes_total'], day['minutes_count'])
+        for metric in RATING_METRICS:
+            day[f'average_{metric}'] = _average(day[f'{metric}_total'], day[f'{metric}_count'])
+        summaries.append(day)
+    return summaries
+
+
+def cohort_funnels():
+    """Per signup cohort, newest first: its size and how many users reached each funnel day"""
+    reached = {}
+    for cohort, day_number, entries in db.session.execute(
+        select(JournalRollup.cohort, JournalRollup.day_number, JournalRollup.entries)
+        .where(JournalRollup.day_number.in_(FUNNEL_DAYS))
+    ):
+        reached[(cohort, day_number)] = entries
+
+    return [
+        {
+            'cohort': rollup.cohort,
+            'users': rollup.users,
+            'subscribers': rollup.subscribers,
+            'funnel': [reached.get((rollup.cohort, day), 0) for day in FUNNEL_DAYS],
+        }
+        for rollup in db.session.execute(select(CohortRollup).order_by(CohortRollup.cohort.desc())).scalars()
+    ]
@@ -1,12 +1,26 @@
 import os
+import time
+
+# Startup is timed from here, before the heavy imports; see create_app()
+_started = time.perf_counter()
+
 import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
+from drawing_store import init_drawing_store
+from assets import init_assets
+from page_cache import init_page_cache
+from instrumentation import init_instrumentation
+from logging_config import configure_logging
+from startup_profile import StartupProfile
 
-# Set up logging for debugging
-logging.basicConfig(level=logging.DEBUG)
+startup_profile = StartupProfile(_started)
+startup_profile.mark('imports')
+
+# Set up logging from LOG_LEVEL, LOG_FORMAT and friends (INFO and plain text by default)
+configure_logging()
 
 class Base(DeclarativeBase):
     pass
@@ -24,8 +38,55 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "pool_pre_ping": True,
 }
 
+# Connection pool per worker; gevent workers, which run many requests at once,
+# get a larger one from gunicorn_gevent.conf.py
+if os.environ.get("DB_POOL_SIZE"):
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"].update(
+        pool_size=int(os.environ["DB_POOL_SIZE"]),
+        max_overflow=int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+    )
+
+# Where canvas drawings are stored (defaults to instance/drawings)
+app.config["DRAWING_STORE_PATH"] = os.environ.get("DRAWING_STORE_PATH")
+
+# Seconds each worker trusts its cached layout settings before checking for changes
+app.config["SETTINGS_CACHE_TTL"] = int(os.environ.get("SETTINGS_CACHE_TTL", 30))
+
+# The subscriber-only journal PDF, and optionally a front-end server to send it:
+# 'x-accel-redirect' (nginx, to PDF_ACCEL_REDIRECT_PATH) or 'x-sendfile'
+app.config["JOURNAL_PDF_PATH"] = os.environ.get("JOURNAL_PDF_PATH") or os.path.join(
+    app.root_path, "static", "downloads", "recovery-journal-full.pdf")
+app.config["PDF_OFFLOAD"] = os.environ.get("PDF_OFFLOAD")
+app.config["PDF_ACCEL_REDIRECT_PATH"] = os.environ.get("PDF_ACCEL_REDIRECT_PATH", "/protected/recovery-journal-full.pdf")
+
+# Per-page images of the journal PDF, built by `flask render-pdf-pages`
+app.config["JOURNAL_PAGES_PATH"] = os.environ.get("JOURNAL_PAGES_PATH") or os.path.join(app.instance_path, "journal-pages")
+
+# Seconds a session's entitlement claim is trusted before the user's subscription is re-read,
+# and how often each worker checks whether a webhook changed any subscription
+app.config["ENTITLEMENT_TTL"] = int(os.environ.get("ENTITLEMENT_TTL", 300))
+app.config["ENTITLEMENT_VERSION_TTL"] = int(os.environ.get("ENTITLEMENT_VERSION_TTL", 5))
+
+# Rendered public pages: seconds they are kept, how many each worker keeps,
+# and optionally a Redis server to share them between workers
+app.config["PAGE_CACHE_TTL"] = int(os.environ.get("PAGE_CACHE_TTL", 300))
+app.config["PAGE_CACHE_SIZE"] = int(os.environ.get("PAGE_CACHE_SIZE", 128))
+app.config["PAGE_CACHE_REDIS_URL"] = os.environ.get("PAGE_CACHE_REDIS_URL")
+
+# Instrumentation: SQL statements slower than this many seconds are logged, a request
+# running one statement this many times is logged as a likely N+1, and /metrics
+# requires "Authorization: Bearer <METRICS_TOKEN>" (it returns 404 when no token is set)
+app.config["SLOW_QUERY_SECONDS"] = float(os.environ.get("SLOW_QUERY_SECONDS", 0.25))
+app.config["N_PLUS_ONE_THRESHOLD"] = int(os.environ.get("N_PLUS_ONE_THRESHOLD", 10))
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+
 # Initialize the app with the extension
 db.init_app(app)
+init_instrumentation(app)
+init_drawing_store(app)
+init_assets(app)
+init_page_cache(app)
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -38,14 +99,26 @@ def load_user(user_id):
     from models import User
     return User.query.get(int(user_id))
 
-# Create database tables
-with app.app_context():
-    # Import models to register them with SQLAlchemy
-    import models
-    db.create_all()
+startup_profile.mark('configure')
 
-# Import routes after app creation to avoid circular imports
-from routes import *
+def create_app():
+    """Finish setting up the app and return it, for servers and the flask CLI
+
+    Registers the models, routes and CLI commands. Nothing here touches the
+    database or an external service: tables are managed by `flask migrate-db`,
+    and the Stripe and SendGrid SDKs are imported on first use. How long each
+    startup phase took is logged and kept in app.extensions['startup_profile'].
+    """
+    if 'startup_profile' in app.extensions:
+        return app
+
+    import models
+    startup_profile.mark('models')
+    import routes
+    startup_profile.mark('routes')
+    import commands
+    startup_profile.mark('commands')
 
-if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    app.extensions['startup_profile'] = startup_profile
+    logging.info("App started in %s", startup_profile.summary())
+    return app
@@ -0,0 +1,223 @@
+import io
+import os
+import re
+import gzip
+import json
+import hashlib
+import logging
+import mimetypes
+from flask import abort, current_app, request, send_file, url_for
+from werkzeug.security import safe_join
+
+# Static folders the build picks up (downloads are served as-is)
+ASSET_DIRS = ('css', 'images')
+
+# Build output, under the static folder
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+
+# Widths for resized image variants; images are never scaled up
+IMAGE_WIDTHS = (480, 960, 1600)
+RASTER_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# Text assets stored precompressed next to the original
+COMPRESSIBLE_EXTENSIONS = ('.css', '.svg', '.js')
+
+# url(...) references in stylesheets
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+# Per-worker copy of the manifest, with the mtime it was read at
+_manifest_cache = {'path': None, 'mtime': None, 'manifest': {}}
+
+
+def _hashed_name(filename, data, suffix=None):
+    """Name for a build output, e.g. images/logo.png -> images/logo.3f2a9c1b7d.png"""
+    base, extension = os.path.splitext(filename)
+    if suffix:
+        base = f"{base}-{suffix}"
+    return f"{base}.{hashlib.sha256(data).hexdigest()[:10]}{extension}"
+
+
+def _write(dist_root, name, data):
+    path = os.path.join(dist_root, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def _precompress(dist_root, name, data):
+    """Store .gz (and .br, when brotli is installed) copies of a text asset"""
+    _write(dist_root, f"{name}.gz", gzip.compress(data, 9, mtime=0))
+    try:
+        import brotli
+    except ImportError:
+        return
+    _write(dist_root, f"{name}.br", brotli.compress(data, quality=11))
+
+
+def _image_variants(dist_root, filename, data, widths, quality):
+    """Write resized WebP (and AVIF, when Pillow supports it) copies of a raster image
+
+    Returns the image size and the variants by format, or None without Pillow.
+    """
+    try:
+        from PIL import Image, features
+    except ImportError:
+        return None
+
+    formats = ['webp'] + (['avif'] if features.check('avif') else [])
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        size = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+
+        variants = {image_format: [] for image_format in formats}
+        for width in sorted(set(min(width, size[0]) for width in widths)):
+            height = round(size[1] * width / size[0])
+            resized = image if width == size[0] else image.resize((width, height), Image.LANCZOS)
+            for image_format in formats:
+                buffer = io.BytesIO()
+                resized.save(buffer, image_format.upper(), quality=quality if image_format == 'webp' else quality - 20)
+                name = _hashed_name(os.path.splitext(filename)[0] + f'.{image_format}', buffer.getvalue(), width)
+                _write(dist_root, name, buffer.getvalue())
+                variants[image_format].append({'file': name, 'width': width})
+    return size, variants
+
+
+def build_assets(static_folder, widths=IMAGE_WIDTHS, quality=80):
+    """Fingerprint, compress and resize the static assets and write the manifest
+
+    Images go first so stylesheets can point at their built names. Resized
+    variants need the optional Pillow package and brotli output the optional
+    brotli package; without them those outputs are skipped.
+    """
+    dist_root = os.path.join(static_folder, DIST_DIR)
+    manifest = {}
+    stylesheets = []
+
+    for asset_dir in ASSET_DIRS:
+        for root, _, files in os.walk(os.path.join(static_folder, asset_dir)):
+            for file_name in sorted(files):
+                filename = os.path.relpath(os.path.join(root, file_name), static_folder).replace(os.sep, '/')
+                extension = os.path.splitext(file_name)[1].lower()
+                if extension == '.css':
+                    stylesheets.append(filename)
+                    continue
+
+                with open(os.path.join(static_folder, filename), 'rb') as f:
+                    data = f.read()
+                entry = {'file': _hashed_name(filename, data)}
+                _write(dist_root, entry['file'], data)
+
+                if extension in COMPRESSIBLE_EXTENSIONS:
+                    _precompress(dist_root, entry['file'], data)
+                elif extension in RASTER_EXTENSIONS:
+                    result = _image_variants(dist_root, filename, data, widths, quality)
+                    if result is None:
+                        logging.warning(f"Pillow is not installed, skipping resized variants of {filename}")
+                    else:
+                        (entry['width'], entry['height']), entry['variants'] = result
+                manifest[filename] = entry
+
+    for filename in stylesheets:
+        with open(os.path.join(static_folder, filename), 'r', encoding='utf-8') as f:
+            css = f.read()
+
+        def rewrite(match):
+            reference = match.group(2)
+            if re.match(r'^(data:|https?:|//|#)', reference):
+                return match.group(0)
+            target = os.path.normpath(os.path.join(os.path.dirname(filename), reference)).replace(os.sep, '/')
+            entry = manifest.get(target)
+            if entry is None:
+                return match.group(0)
+            # Stylesheets can't offer a srcset, so use the largest WebP variant when there is one
+            built = entry['variants']['webp'][-1]['file'] if entry.get('variants') else entry['file']
+            return f"url('{os.path.relpath(built, os.path.dirname(filename)).replace(os.sep, '/')}')"
+
+        data = CSS_URL.sub(rewrite, css).encode('utf-8')
+        entry = {'file': _hashed_name(filename, data)}
+        _write(dist_root, entry['file'], data)
+        _precompress(dist_root, entry['file'], data)
+        manifest[filename] = entry
+
+    os.makedirs(dist_root, exist_ok=True)
+    with open(os.path.join(dist_root, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+
+def load_asset_manifest():
+    """Get the asset manifest, re-reading it only when it changes (empty before the first build)"""
+    path = os.path.join(current_app.static_folder, DIST_DIR, MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    if _manifest_cache['path'] != path or _manifest_cache['mtime'] != mtime:
+        with open(path) as f:
+            _manifest_cache.update(path=path, mtime=mtime, manifest=json.load(f))
+    return _manifest_cache['manifest']
+
+
+def asset_url(filename, image_format=None, width=None):
+    """URL of a static asset, using its fingerprinted build when there is one
+
+    For images, ``image_format`` and ``width`` pick the closest resized variant
+    at least that wide. Falls back to the plain static URL.
+    """
+    entry = load_asset_manifest().get(filename)
+    if entry is None:
+        return url_for('static', filename=filename)
+
+    variants = (entry.get('variants') or {}).get(image_format)
+    if variants:
+        if width is None:
+            variant = variants[-1]
+        else:
+            variant = next((variant for variant in variants if variant['width'] >= width), variants[-1])
+        return url_for('asset', filename=variant['file'])
+    return url_for('asset', filename=entry['file'])
+
+
+def asset_srcset(filename, image_format):
+    """srcset of an image's resized variants in one format, or '' if it has none"""
+    entry = load_asset_manifest().get(filename) or {}
+    return ', '.join(
+        f"{url_for('asset', filename=variant['file'])} {variant['width']}w"
+        for variant in (entry.get('variants') or {}).get(image_format, [])
+    )
+
+
+def send_asset(filename):
+    """Serve a built asset for a year as immutable, precompressed when the client accepts it"""
+    dist_root = os.path.join(current_app.static_folder, DIST_DIR)
+    path = safe_join(dist_root, filename)
+    if path is None or filename == MANIFEST_NAME or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = None
+    if filename.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if candidate in request.accept_encodings and os.path.isfile(path + suffix):
+                encoding, path = candidate, path + suffix
+                break
+
+    response = send_file(path, mimetype=mimetype, download_name=os.path.basename(filename),
+                         conditional=True, max_age=31536000)
+    if encoding:
+        response.content_encoding = encoding
+    if filename.lower().endswith(COMPRESSIBLE_EXTENSIONS):
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_assets(app):
+    """Register the built-asset route and the asset_url/asset_srcset template helpers"""
+    app.add_url_rule(f"{app.static_url_path}/{DIST_DIR}/<path:filename>", 'asset', send_asset)
+    app.jinja_env.globals.update(asset_url=asset_url, asset_srcset=asset_srcset)
@@ -0,0 +1,327 @@
+import os
+import time
+import logging
+import uuid
+import random
+import threading
+from types import SimpleNamespace
+from sqlalchemy import delete, func, insert, select
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+from app import app, db
+from models import DrawingStrokeBatch, EmailSubscriber, JournalEntry, OutboundEmail, PDFAnnotation, User
+from drawing_store import get_drawing_store
+from email_outbox import process_outbox
+from email_service import get_transport
+from instrumentation import REQUEST_QUERIES
+from strokes import encode_strokes, rasterize_png
+from stripe_gateway import CircuitBreaker
+import stripe_service
+
+# Seeded users are recognised (and replaced on the next run) by this email prefix
+BENCHMARK_EMAIL_PREFIX = 'bench-'
+
+JOURNAL_DAYS = 30
+PDF_PAGES = 79
+
+# Distinct canvas drawings rendered for the seed data and shared between rows
+DRAWING_VARIANTS = 12
+
+# Share of seeded rows that have a drawing
+DRAWING_SHARE = 0.6
+
+SAMPLE_TEXT = (
+    "Today I noticed the urge come and go. I called my sponsor, went for a walk "
+    "and wrote down three things I'm grateful for. Tomorrow I want to get to the "
+    "morning meeting and make time for breakfast."
+)
+
+
+class FakeStripeGateway:
+    """Stands in for StripeGateway, answering every call locally"""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker()
+        self.calls = 0
+
+    def _session(self):
+        self.calls += 1
+        session_id = f"cs_bench_{uuid.uuid4().hex}"
+        return SimpleNamespace(id=session_id, url=f"https://checkout.example.com/{session_id}")
+
+    def create_checkout_session(self, params, idempotency_key=None):
+        return self._session()
+
+    def create_portal_session(self, params, idempotency_key=None):
+        return self._session()
+
+    def update_subscription(self, subscription_id, params, idempotency_key=None):
+        self.calls += 1
+        return SimpleNamespace(id=subscription_id, status='canceled')
+
+
+def use_local_fakes():
+    """Send emails to the in-memory fake transport and Stripe calls to a fake gateway"""
+    os.environ['EMAIL_TRANSPORT'] = 'fake'
+    stripe_service._gateway = FakeStripeGateway()
+    # Forms are posted without fetching a CSRF token first
+    app.config['WTF_CSRF_ENABLED'] = False
+
+
+def _random_strokes(rng):
+    strokes = []
+    for _ in range(rng.randint(5, 40)):
+        x, y = rng.uniform(0, 760), rng.uniform(0, 400)
+        points = []
+        for _ in range(rng.randint(10, 80)):
+            x = min(max(x + rng.uniform(-12, 12), 0), 760)
+            y = min(max(y + rng.uniform(-12, 12), 0), 400)
+            points.extend((x, y))
+        strokes.append(('pen', rng.uniform(1, 8), (rng.randrange(256), rng.randrange(256), rng.randrange(256)), points))
+    return strokes
+
+
+def seed_benchmark_data(user_count, seed=0):
+    """Replace the benchmark users with ``user_count`` new ones and return their ids
+
+    Every user is an active subscriber with all 30 journal entries and 79
+    PDF annotations saved; most rows have a stored canvas drawing, and some
+    canvases have saved strokes.
+    """
+    rng = random.Random(seed)
+    clear_benchmark_data()
+
+    store = get_drawing_store()
+    drawings = []
+    stroke_batches = []
+    for _ in range(DRAWING_VARIANTS):
+        packed = encode_strokes(_random_strokes(rng))
+        stroke_batches.append(packed)
+        drawings.append(store.put(rasterize_png(packed, 760, 400)))
+
+    password_hash = generate_password_hash('benchmark')
+    db.session.execute(insert(User), [
+        {
+            'email': f"{BENCHMARK_EMAIL_PREFIX}{index}@example.com",
+            'name': f"Benchmark User {index}",
+            'password_hash': password_hash,
+            'subscription_status': 'active',
+            'current_day': rng.randint(1, JOURNAL_DAYS),
+        }
+        for index in range(user_count)
+    ])
+    user_ids = db.session.execute(
+        select(User.id).where(User.email.like(f"{BENCHMARK_EMAIL_PREFIX}%")).order_by(User.id)
+    ).scalars().all()
+
+    def drawing():
+        return rng.choice(drawings) if rng.random() < DRAWING_SHARE else None
+
+    for user_id in user_ids:
+        db.session.execute(insert(JournalEntry), [
+            {
+                'user_id': user_id,
+                'day_number': day,
+                **{field: SAMPLE_TEXT for field in JournalEntry.TEXT_FIELDS},
+                'mood_rating': rng.randint(1, 10),
+                'energy_level': rng.randint(1, 10),
+                'sleep_quality': rng.randint(1, 10),
+                'time_spent_minutes': rng.randint(5, 45),
+                'completion_percentage': 100,
+                'completed': True,
+                'drawing_ref': drawing(),
+                'version': 1,
+            }
+            for day in range(1, JOURNAL_DAYS + 1)
+        ])
+        db.session.execute(insert(PDFAnnotation), [
+            {'user_id': user_id, 'page_number': page, 'notes': SAMPLE_TEXT, 'drawing_ref': drawing()}
+            for page in range(1, PDF_PAGES + 1)
+        ])
+        db.session.execute(insert(DrawingStrokeBatch), [
+            {'user_id': user_id, 'canvas': 'journal', 'number': day, 'data': rng.choice(stroke_batches)}
+            for day in rng.sample(range(1, JOURNAL_DAYS + 1), 5)
+        ])
+        db.session.commit()
+    return user_ids
+
+
+def clear_benchmark_data():
+    """Delete the benchmark users, their rows and the subscribers /join created"""
+    user_ids = select(User.id).where(User.email.like(f"{BENCHMARK_EMAIL_PREFIX}%")).scalar_subquery()
+    for model in (JournalEntry, PDFAnnotation, DrawingStrokeBatch):
+        db.session.execute(delete(model).where(model.user_id.in_(user_ids)))
+    db.session.execute(delete(User).where(User.email.like(f"{BENCHMARK_EMAIL_PREFIX}%")))
+    db.session.execute(delete(EmailSubscriber).where(EmailSubscriber.email.like(f"{BENCHMARK_EMAIL_PREFIX}%")))
+    db.session.execute(delete(OutboundEmail).where(OutboundEmail.to_email.like(f"{BENCHMARK_EMAIL_PREFIX}%")))
+    db.session.commit()
+
+
+def has_other_data():
+    """Whether the database has users or subscribers the benchmark didn't create"""
+    return any(
+        db.session.execute(select(func.count()).select_from(model).where(model.email.not_like(f"{BENCHMARK_EMAIL_PREFIX}%"))).scalar()
+        for model in (User, EmailSubscriber)
+    )
+
+
+def session_cookie(user_id):
+    """A signed session cookie logging in the user, as Flask-Login would after /login"""
+    serializer = app.session_interface.get_signing_serializer(app)
+    return serializer.dumps({'_user_id': str(user_id), '_fresh': True})
+
+
+# What each scenario requests: (endpoint, method, path, form data), given a random generator
+SCENARIOS = {
+    'save_journal_entry': lambda rng: ('save_journal_entry', 'POST', '/save-journal-entry', {
+        'day_number': rng.randint(1, JOURNAL_DAYS),
+        **{field: f"{SAMPLE_TEXT} {rng.random()}" for field in JournalEntry.TEXT_FIELDS},
+        'mood_rating': rng.randint(1, 10),
+        'energy_level': rng.randint(1, 10),
+        'sleep_quality': rng.randint(1, 10),
+    }),
+    'save_pdf_annotation': lambda rng: ('save_pdf_annotation', 'POST', '/save-pdf-annotation', {
+        'page_number': rng.randint(1, PDF_PAGES),
+        'notes': f"{SAMPLE_TEXT} {rng.random()}",
+    }),
+    'dashboard': lambda rng: ('dashboard', 'GET', '/dashboard', None),
+    'recovery_journal': lambda rng: ('recovery_journal', 'GET', f"/recovery-journal?day={rng.randint(1, JOURNAL_DAYS)}", None),
+    'join': lambda rng: ('join_community', 'POST', '/join', {
+        'name': 'Benchmark Visitor',
+        'email': f"{BENCHMARK_EMAIL_PREFIX}join-{uuid.uuid4().hex}@example.com",
+    }),
+}
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def _queries_per_request(endpoint, before, after):
+    total_before, count_before = before.get((endpoint,), (0, 0))
+    total_after, count_after = after.get((endpoint,), (0, 0))
+    requests = count_after - count_before
+    return round((total_after - total_before) / requests, 2) if requests else None
+
+
+def _run_workers(worker_count, requests_per_worker, send):
+    """Call send(worker_index, rng) from each worker thread; return latencies and error count"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def work(index):
+        rng = random.Random(index)
+        mine = []
+        failed = 0
+        for _ in range(requests_per_worker):
+            started = time.perf_counter()
+            try:
+                ok = send(index, rng)
+            except Exception:
+                ok = False
+            mine.append(time.perf_counter() - started)
+            failed += not ok
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=work, args=(index,)) for index in range(worker_count)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started
+
+
+def run_benchmark(user_ids, mode='client', workers=1, requests=200, scenarios=None):
+    """Drive each scenario in turn and return the results as a dict
+
+    ``mode`` 'client' sends requests through Flask test clients, one per
+    worker thread; 'http' serves the app on a local threaded server and
+    sends real HTTP requests from the workers over kept-alive connections.
+    Each user's session cookie is kept between requests, so entitlement
+    claims are reused as they would be in a browser.
+    """
+    use_local_fakes()
+    cookie_name = app.config['SESSION_COOKIE_NAME']
+    cookies = {user_id: session_cookie(user_id) for user_id in user_ids}
+    server = None
+
+    if mode == 'http':
+        import requests as http
+
+        # Per-request access logging would be measured along with the app
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        local = threading.local()
+
+        def request(index, method, path, data, user_id):
+            if not hasattr(local, 'session'):
+                local.session = http.Session()
+            response = local.session.request(method, base_url + path, data=data,
+                                             cookies={cookie_name: cookies[user_id]}, allow_redirects=False)
+            cookies[user_id] = response.cookies.get(cookie_name, cookies[user_id])
+            return response.status_code
+    else:
+        clients = [app.test_client() for _ in range(workers)]
+
+        def request(index, method, path, data, user_id):
+            client = clients[index]
+            client.set_cookie(cookie_name, cookies[user_id])
+            status_code = client.open(path, method=method, data=data).status_code
+            cookies[user_id] = client.get_cookie(cookie_name).value
+            return status_code
+
+    results = {}
+    try:
+        for name in scenarios or SCENARIOS:
+            build = SCENARIOS[name]
+            endpoint = build(random.Random())[0]
+
+            def send(index, rng):
+                _, method, path, data = build(rng)
+                return request(index, method, path, data, rng.choice(user_ids)) < 400
+
+            queries_before = REQUEST_QUERIES.totals()
+            latencies, errors, elapsed = _run_workers(workers, max(1, requests // workers), send)
+            queries_after = REQUEST_QUERIES.totals()
+
+            latencies.sort()
+            results[name] = {
+                'endpoint': endpoint,
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput_rps': round(len(latencies) / elapsed, 1),
+                'p50_ms': round(_percentile(latencies, 0.50) * 1000, 2),
+                'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+                'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2),
+                'queries_per_request': _queries_per_request(endpoint, queries_before, queries_after),
+            }
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    # Deliver the welcome emails /join queued, through the fake transport
+    emails = 0
+    while True:
+        sent = process_outbox(batch_size=100)
+        if not sent:
+            break
+        emails += sent
+
+    return {
+        'database': db.engine.dialect.name,
+        'mode': mode,
+        'workers': workers,
+        'users': len(user_ids),
+        'scenarios': results,
+        'emails_delivered': emails,
+        'fake_email_messages': len(getattr(get_transport(), 'sent', [])),
+        'fake_stripe_calls': stripe_service._gateway.calls,
+    }
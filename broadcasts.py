@@ -0,0 +1,177 @@
+import html
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import or_, select, update
+from app import db
+from models import Broadcast, BroadcastBatch, EmailSubscriber
+from email_service import WELCOME_FROM, deliver_email
+
+# SendGrid accepts at most 1000 personalizations per request
+BATCH_SIZE = 1000
+
+# Pause between SendGrid requests, to stay well under the API rate limit
+BATCH_INTERVAL_SECONDS = 1.0
+
+# How long a sender may go without finishing a batch before another sender takes over
+SEND_LEASE_SECONDS = 300
+
+# Placeholder in the message for the subscriber's name, and the SendGrid substitution tags it becomes
+# in the plain text and (HTML-escaped) in the HTML part; neither tag may contain the other
+NAME_PLACEHOLDER = '{name}'
+NAME_TAG = '-name-'
+NAME_HTML_TAG = '-htmlname-'
+
+
+def create_broadcast(subject, message):
+    """Add a pending broadcast to the session; the caller commits"""
+    broadcast = Broadcast(subject=subject, message=message)
+    db.session.add(broadcast)
+    return broadcast
+
+
+def build_broadcast_email(broadcast, recipients):
+    """Build one SendGrid request with a personalization per (id, email, name) recipient"""
+    from sendgrid.helpers.mail import Mail, Email, To
+
+    paragraphs = [
+        html.escape(paragraph.strip()).replace('\n', '<br>').replace(NAME_PLACEHOLDER, NAME_HTML_TAG)
+        for paragraph in broadcast.message.split('\n\n') if paragraph.strip()
+    ]
+    return Mail(
+        from_email=Email(*WELCOME_FROM),
+        to_emails=[
+            To(email, name, substitutions={NAME_TAG: name or 'friend', NAME_HTML_TAG: html.escape(name or 'friend')})
+            for _, email, name in recipients
+        ],
+        subject=broadcast.subject,
+        html_content=''.join(f"<p>{paragraph}</p>" for paragraph in paragraphs),
+        plain_text_content=broadcast.message.replace(NAME_PLACEHOLDER, NAME_TAG),
+        is_multiple=True
+    )
+
+
+def iter_subscriber_batches(after_id, batch_size=BATCH_SIZE):
+    """Yield lists of (id, email, name) for active subscribers after the given id
+
+    Rows are streamed with a server-side cursor on a connection of their own,
+    so only one batch is held in memory and commits on the session don't end it.
+    SQLite can't commit while another connection is reading, so there each
+    batch is fetched as its own keyset page instead.
+    """
+    query = (
+        select(EmailSubscriber.id, EmailSubscriber.email, EmailSubscriber.name)
+        .where(EmailSubscriber.is_active.is_(True))
+        .order_by(EmailSubscriber.id)
+    )
+
+    if db.engine.dialect.name == 'sqlite':
+        while True:
+            partition = db.session.execute(
+                query.where(EmailSubscriber.id > after_id).limit(batch_size)
+            ).all()
+            if not partition:
+                return
+            yield partition
+            after_id = partition[-1].id
+
+    with db.engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=batch_size).execute(
+            query.where(EmailSubscriber.id > after_id)
+        )
+        for partition in result.partitions(batch_size):
+            yield partition
+
+
+def claim_broadcast(broadcast_id):
+    """Take the send lease on a broadcast, returning False if it's finished or another sender holds it"""
+    now = datetime.utcnow()
+    claimed = db.session.execute(
+        update(Broadcast)
+        .where(
+            Broadcast.id == broadcast_id,
+            or_(
+                Broadcast.status == 'pending',
+                (Broadcast.status == 'sending') & or_(
+                    Broadcast.lease_expires_at.is_(None), Broadcast.lease_expires_at < now
+                )
+            )
+        )
+        .values(status='sending', lease_expires_at=now + timedelta(seconds=SEND_LEASE_SECONDS))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    db.session.commit()
+    return bool(claimed)
+
+
+def release_broadcast(broadcast_id):
+    """Give up the send lease after a failure, so the broadcast can be resumed straight away"""
+    db.session.execute(
+        update(Broadcast)
+        .where(Broadcast.id == broadcast_id, Broadcast.status == 'sending')
+        .values(lease_expires_at=None)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+
+
+def send_broadcast(broadcast_id, batch_size=BATCH_SIZE, interval=BATCH_INTERVAL_SECONDS, transport=None,
+                   claimed=False):
+    """Send a broadcast batch by batch, returning the number of recipients sent this run
+
+    Each batch is recorded together with the new resume point once SendGrid
+    accepts it, so an interrupted broadcast continues after the last recorded
+    batch. A batch accepted just before a crash may be sent again on resume.
+    Pass ``claimed`` when the caller already took the lease with claim_broadcast().
+    """
+    if not claimed and not claim_broadcast(broadcast_id):
+        logging.info("Broadcast %s is finished or being sent elsewhere", broadcast_id)
+        return 0
+
+    broadcast = db.session.get(Broadcast, broadcast_id)
+    sent = 0
+    try:
+        for recipients in iter_subscriber_batches(broadcast.last_subscriber_id or 0, batch_size):
+            if sent:
+                time.sleep(interval)
+            deliver_email(build_broadcast_email(broadcast, recipients), transport)
+
+            db.session.add(BroadcastBatch(
+                broadcast_id=broadcast.id,
+                first_subscriber_id=recipients[0].id,
+                last_subscriber_id=recipients[-1].id,
+                recipient_count=len(recipients)
+            ))
+            broadcast.last_subscriber_id = recipients[-1].id
+            broadcast.recipients_sent = (broadcast.recipients_sent or 0) + len(recipients)
+            broadcast.lease_expires_at = datetime.utcnow() + timedelta(seconds=SEND_LEASE_SECONDS)
+            db.session.commit()
+            sent += len(recipients)
+            logging.info("Broadcast %s: sent %s so far", broadcast.id, broadcast.recipients_sent)
+    except Exception:
+        db.session.rollback()
+        release_broadcast(broadcast_id)
+        raise
+
+    broadcast.status = 'completed'
+    broadcast.completed_date = datetime.utcnow()
+    broadcast.lease_expires_at = None
+    db.session.commit()
+    logging.info("Broadcast %s completed with %s recipients", broadcast.id, broadcast.recipients_sent)
+    return sent
+
+
+def start_broadcast_thread(app, broadcast_id, claimed=False):
+    """Send a broadcast from a daemon thread of this process"""
+    def work():
+        with app.app_context():
+            try:
+                send_broadcast(broadcast_id, claimed=claimed)
+            except Exception as e:
+                db.session.rollback()
+                logging.error("Broadcast %s stopped, it can be resumed: %s", broadcast_id, e)
+
+    thread = threading.Thread(target=work, name=f'broadcast-{broadcast_id}', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,220 @@
+import json
+import logging
+import click
+from sqlalchemy import select
+from sqlalchemy.orm import undefer
+from app import app, db
+from models import JournalEntry, PDFAnnotation, Broadcast, StripeEvent
+from drawing_store import DrawingStoreError, store_drawing
+from email_outbox import run_outbox_worker
+from analytics import refresh_rollups
+from migrations import migrate_database, recompute_progress
+from startup_profile import profile_cold_start
+from benchmark import SCENARIOS, clear_benchmark_data, has_other_data, run_benchmark, seed_benchmark_data
+from assets import IMAGE_WIDTHS, build_assets
+from pdf_pages import PAGE_FORMATS, PAGE_WIDTHS, render_pdf_pages
+from stripe_events import process_stripe_events, record_stripe_event
+from broadcasts import BATCH_INTERVAL_SECONDS, BATCH_SIZE, create_broadcast, send_broadcast
+
+@app.cli.command('migrate-drawings')
+@click.option('--batch-size', default=100, show_default=True, help='Rows to commit per batch.')
+def migrate_drawings(batch_size):
+    """Move legacy base64 drawings from the database into the drawing store
+
+    Drawings that can't be stored are left in the database and reported.
+    """
+    for model in (JournalEntry, PDFAnnotation):
+        moved = failed = last_id = 0
+        while True:
+            rows = model.query.options(undefer(model.drawing_data)).filter(
+                model.drawing_data.isnot(None), model.drawing_ref.is_(None), model.id > last_id
+            ).order_by(model.id).limit(batch_size).all()
+            if not rows:
+                break
+            
+            for row in rows:
+                last_id = row.id
+                try:
+                    row.drawing_ref = store_drawing(row.drawing_data.strip())
+                except DrawingStoreError as e:
+                    logging.warning("Leaving unreadable drawing on %r in the database: %s", row, e)
+                    failed += 1
+                    continue
+                row.drawing_data = None
+                moved += 1
+            db.session.commit()
+        
+        click.echo(f"{model.__name__}: moved {moved} drawings, {failed} could not be stored")
+
+@app.cli.command('migrate-db')
+def migrate_db():
+    """Create missing tables and apply pending schema migrations (run on deploy, not at startup)"""
+    applied = migrate_database()
+    for number, description in applied:
+        click.echo(f"Applied migration {number}: {description}")
+    click.echo(f"Applied {len(applied)} migrations" if applied else "Database is up to date")
+
+@app.cli.command('startup-profile')
+@click.option('--path', help='Also time a first request to this path, e.g. /faq.')
+@click.option('--imports', 'import_count', default=10, show_default=True, help='Slowest packages to list.')
+def startup_profile_command(path, import_count):
+    """Time a cold start of the app in a fresh interpreter, as a new instance would start"""
+    try:
+        profile = profile_cold_start(app.root_path, path, import_count)
+    except RuntimeError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(profile, indent=2))
+
+@app.cli.command('repair-progress')
+def repair_progress():
+    """Recompute stored completion percentages and per-user completed-day counters"""
+    entries, users = recompute_progress()
+    db.session.commit()
+    
+    click.echo(f"Recomputed {entries} journal entries and {users} users")
+
+@app.cli.command('email-worker')
+@click.option('--poll-interval', default=5, show_default=True, help='Seconds to wait when no emails are due.')
+@click.option('--batch-size', default=20, show_default=True, help='Emails to claim per batch.')
+@click.option('--once', is_flag=True, help='Send one batch and exit (for cron).')
+def email_worker(poll_interval, batch_size, once):
+    """Send queued outbound emails, retrying failures with backoff"""
+    sent = run_outbox_worker(poll_interval, batch_size, once)
+    if once:
+        click.echo(f"Attempted {sent} emails")
+
+@app.cli.command('send-broadcast')
+@click.argument('broadcast_id', type=int, required=False)
+@click.option('--subject', help='Create a new broadcast with this subject.')
+@click.option('--message-file', type=click.File(), help='Plain text message for the new broadcast.')
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Recipients per SendGrid request (at most 1000).')
+@click.option('--interval', default=BATCH_INTERVAL_SECONDS, show_default=True, help='Seconds to wait between requests.')
+def send_broadcast_command(broadcast_id, subject, message_file, batch_size, interval):
+    """Send (or resume) a broadcast to all active subscribers
+
+    Pass a broadcast id to resume it, or --subject and --message-file to create one.
+    Without either, every unfinished broadcast is sent.
+    """
+    if subject or message_file:
+        if not (subject and message_file):
+            raise click.UsageError('--subject and --message-file must be given together')
+        broadcast = create_broadcast(subject, message_file.read())
+        db.session.commit()
+        broadcast_ids = [broadcast.id]
+    elif broadcast_id:
+        broadcast_ids = [broadcast_id]
+    else:
+        broadcast_ids = db.session.execute(
+            select(Broadcast.id).where(Broadcast.status != 'completed').order_by(Broadcast.id)
+        ).scalars().all()
+    
+    for broadcast_id in broadcast_ids:
+        sent = send_broadcast(broadcast_id, min(batch_size, BATCH_SIZE), interval)
+        click.echo(f"Broadcast {broadcast_id}: sent to {sent} subscribers")
+
+@app.cli.command('process-stripe-events')
+def process_stripe_events_command():
+    """Apply Stripe webhook events that are pending or failed earlier"""
+    handled = process_stripe_events(limit=1000)
+    click.echo(f"Handled {handled} Stripe events")
+
+@app.cli.command('replay-stripe-events')
+@click.argument('event_files', nargs=-1, required=True, type=click.File())
+def replay_stripe_events(event_files):
+    """Record and apply saved Stripe event JSON files, e.g. fixtures/stripe_events/*.json
+
+    For local development and testing without live Stripe; signatures aren't checked.
+    """
+    event_ids = []
+    for event_file in event_files:
+        event = json.load(event_file)
+        if record_stripe_event(event):
+            event_ids.append(event['id'])
+        else:
+            click.echo(f"{event['id']} was already received")
+    db.session.commit()
+    
+    process_stripe_events(event_ids)
+    for event_id in event_ids:
+        click.echo(repr(db.session.get(StripeEvent, event_id)))
+
+@app.cli.command('render-pdf-pages')
+@click.option('--widths', default=','.join(map(str, PAGE_WIDTHS)), show_default=True, help='Comma-separated widths in pixels.')
+@click.option('--formats', default=','.join(PAGE_FORMATS), show_default=True, help='Comma-separated image formats, fallback last.')
+@click.option('--quality', default=80, show_default=True, help='WebP quality.')
+def render_pdf_pages_command(widths, formats, quality):
+    """Render each page of the journal PDF to images for the PDF viewer
+
+    Needs the optional packages from the 'pdf-pages' extra (pypdfium2 and Pillow).
+    """
+    try:
+        import pypdfium2, PIL
+    except ImportError:
+        raise click.ClickException("Rendering pages needs pypdfium2 and Pillow: pip install pypdfium2 pillow")
+    
+    formats = [image_format.strip().lower() for image_format in formats.split(',')]
+    if not set(formats) <= {'webp', 'png'}:
+        raise click.BadParameter('Formats must be webp and/or png', param_hint='--formats')
+    
+    manifest = render_pdf_pages(
+        app.config['JOURNAL_PDF_PATH'],
+        app.config['JOURNAL_PAGES_PATH'],
+        widths=[int(width) for width in widths.split(',')],
+        formats=formats,
+        quality=quality
+    )
+    click.echo(f"Rendered {manifest['page_count']} pages to {app.config['JOURNAL_PAGES_PATH']}")
+
+@app.cli.command('build-assets')
+@click.option('--widths', default=','.join(map(str, IMAGE_WIDTHS)), show_default=True, help='Comma-separated widths for resized images.')
+@click.option('--quality', default=80, show_default=True, help='WebP quality (AVIF uses 20 less).')
+def build_assets_command(widths, quality):
+    """Fingerprint, precompress and resize static assets into static/dist
+
+    Resized WebP/AVIF images need Pillow and brotli output needs brotli (the
+    optional 'assets' extra); without them those outputs are skipped.
+    """
+    manifest = build_assets(app.static_folder, widths=[int(width) for width in widths.split(',')], quality=quality)
+    variants = sum(len(files) for entry in manifest.values() for files in entry.get('variants', {}).values())
+    click.echo(f"Built {len(manifest)} assets and {variants} image variants")
+
+@app.cli.command('rollup-analytics')
+@click.option('--full', is_flag=True, help='Re-aggregate every cohort, not just those with new entries.')
+def rollup_analytics(full):
+    """Refresh the owner analytics rollups; run it periodically, e.g. from cron every 15 minutes"""
+    cohorts = refresh_rollups(full=full)
+    db.session.commit()
+    click.echo(f"Re-aggregated {len(cohorts)} cohorts")
+
+@app.cli.command('benchmark')
+@click.option('--users', default=20, show_default=True, help='Synthetic users to seed.')
+@click.option('--requests', 'request_count', default=200, show_default=True, help='Requests per scenario.')
+@click.option('--workers', default=1, show_default=True, help='Concurrent worker threads.')
+@click.option('--mode', type=click.Choice(['client', 'http']), default='client', show_default=True,
+              help='Flask test client, or real HTTP against a local threaded server.')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(list(SCENARIOS)),
+              help='Scenarios to run (default all).')
+@click.option('--output', type=click.File('w'), default='-', help='Where to write the JSON results.')
+@click.option('--keep-data', is_flag=True, help='Leave the seeded users in the database afterwards.')
+@click.option('--allow-existing-data', is_flag=True, help='Run even though the database has real users.')
+def benchmark_command(users, request_count, workers, mode, scenarios, output, keep_data, allow_existing_data):
+    """Seed synthetic users, load the journal endpoints and print throughput, latency and queries as JSON
+
+    Emails go to the fake transport and Stripe calls to a fake gateway. Meant
+    for a scratch database: it refuses to run where there are real users or
+    subscribers, as it writes journal entries and drains the email outbox.
+    """
+    if has_other_data() and not allow_existing_data:
+        raise click.ClickException("The database has users or subscribers the benchmark didn't create; "
+                                   "point DATABASE_URL at a scratch database")
+    
+    click.echo(f"Seeding {users} users...", err=True)
+    user_ids = seed_benchmark_data(users)
+    try:
+        results = run_benchmark(user_ids, mode=mode, workers=workers, requests=request_count,
+                                scenarios=scenarios or None)
+    finally:
+        if not keep_data:
+            clear_benchmark_data()
+    json.dump(results, output, indent=2)
+    output.write('\n')
@@ -0,0 +1,146 @@
+import os
+import base64
+import binascii
+import hashlib
+import tempfile
+from flask import current_app, url_for
+from strokes import rasterize_png
+
+# Canvas drawings larger than this are rejected rather than stored
+MAX_DRAWING_BYTES = 5 * 1024 * 1024
+
+PNG_DATA_URL_PREFIX = 'data:image/png;base64,'
+
+
+class DrawingStoreError(ValueError):
+    """Raised when submitted drawing data can't be stored"""
+
+
+class DrawingStore:
+    """Content-addressed storage for canvas drawings
+
+    Drawings are keyed by the sha256 of their bytes, so identical drawings
+    (blank canvases, re-saves of an unchanged page) are stored once.
+    Subclasses implement the actual storage backend.
+    """
+
+    def put(self, data):
+        """Store the bytes if needed and return their key"""
+        key = hashlib.sha256(data).hexdigest()
+        if not self.exists(key):
+            self.write(key, data)
+        return key
+
+    def exists(self, key):
+        raise NotImplementedError
+
+    def write(self, key, data):
+        raise NotImplementedError
+
+    def open(self, key):
+        """Return a readable binary file object for the key"""
+        raise NotImplementedError
+
+
+class LocalDrawingStore(DrawingStore):
+    """Drawing store backed by a directory on the local filesystem"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.png")
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def write(self, key, data):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so readers never see a partial drawing
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+
+def is_drawing_key(value):
+    """Check that a value looks like a drawing store key"""
+    return isinstance(value, str) and len(value) == 64 and all(c in '0123456789abcdef' for c in value)
+
+
+def init_drawing_store(app, store=None):
+    """Attach a drawing store to the app, defaulting to the local filesystem"""
+    if store is None:
+        root = app.config.get('DRAWING_STORE_PATH') or os.path.join(app.instance_path, 'drawings')
+        store = LocalDrawingStore(root)
+    app.extensions['drawing_store'] = store
+    app.jinja_env.globals.update(drawing_url=drawing_url)
+    return store
+
+
+def drawing_url(row):
+    """Where a canvas loads a journal entry's or annotation's saved drawing from, or ''
+
+    Drawings not yet moved by `flask migrate-drawings` are still served as
+    their legacy data URL, so they show up before and after the move.
+    """
+    if row.drawing_ref:
+        return url_for('drawing', key=row.drawing_ref)
+    legacy = (row.drawing_data or '').strip()
+    return legacy if legacy.startswith(PNG_DATA_URL_PREFIX) else ''
+
+
+def get_drawing_store():
+    """Get the drawing store for the current app"""
+    return current_app.extensions['drawing_store']
+
+
+def decode_data_url(data_url):
+    """Decode a canvas.toDataURL() PNG into raw bytes"""
+    if not data_url.startswith(PNG_DATA_URL_PREFIX):
+        raise DrawingStoreError('Drawings must be PNG data URLs')
+    encoded = data_url[len(PNG_DATA_URL_PREFIX):]
+    if len(encoded) > MAX_DRAWING_BYTES * 4 // 3 + 4:
+        raise DrawingStoreError('Drawing is too large')
+    try:
+        return base64.b64decode(encoded, validate=True)
+    except (binascii.Error, ValueError):
+        raise DrawingStoreError('Drawing data is not valid base64')
+
+
+def store_drawing(data_url):
+    """Store a submitted drawing and return its key, or None for an empty drawing"""
+    if not data_url:
+        return None
+    return get_drawing_store().put(decode_data_url(data_url))
+
+
+def stroke_png_key(data, width, height):
+    """The key a canvas's packed strokes are rasterized under, which also serves as their ETag"""
+    return hashlib.sha256(b'%dx%d:' % (width, height) + data).hexdigest()
+
+
+def render_stroke_png(data, width, height):
+    """Rasterize packed strokes to a PNG, reusing the copy in the drawing store when there is one
+
+    Rasterizing is slow, so each version of a canvas is only drawn once. The key
+    hashes the strokes rather than the PNG, so it never matches a stored drawing.
+    """
+    store = get_drawing_store()
+    key = stroke_png_key(data, width, height)
+    try:
+        with store.open(key) as png_file:
+            return png_file.read()
+    except FileNotFoundError:
+        png = rasterize_png(data, width, height)
+        store.write(key, png)
+        return png
@@ -0,0 +1,144 @@
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from app import db
+from models import OutboundEmail
+from email_service import build_welcome_email, deliver_email
+
+# How to build each kind of queued email from its recipient and payload
+EMAIL_BUILDERS = {
+    'welcome': lambda to_email, payload: build_welcome_email(to_email, payload.get('name')),
+}
+
+MAX_ATTEMPTS = 6
+RETRY_BASE_SECONDS = 30
+RETRY_MAX_SECONDS = 3600
+
+# How long a worker may hold a claimed email before another worker retries it
+SEND_LEASE_SECONDS = 300
+
+
+def enqueue_email(kind, to_email, **payload):
+    """Queue an email for the background worker
+
+    The email is added to the current session, so it commits (or rolls back)
+    together with whatever the request is saving.
+    """
+    if kind not in EMAIL_BUILDERS:
+        raise ValueError(f"Unknown email kind {kind}")
+    message = OutboundEmail(kind=kind, to_email=to_email, payload=json.dumps(payload))
+    db.session.add(message)
+    return message
+
+
+def get_email_status(message_id):
+    """Get the delivery status of a queued email, or None if there is no such email"""
+    return db.session.execute(
+        select(OutboundEmail.status).filter_by(id=message_id)
+    ).scalar()
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter for the given number of failed attempts"""
+    delay = min(RETRY_BASE_SECONDS * 2 ** (attempts - 1), RETRY_MAX_SECONDS)
+    return delay * random.uniform(0.5, 1.0)
+
+
+def claim_due_emails(batch_size):
+    """Lease a batch of due emails to this worker and commit the claim"""
+    now = datetime.utcnow()
+    messages = db.session.execute(
+        select(OutboundEmail)
+        .where(
+            OutboundEmail.status.in_(('pending', 'sending')),
+            OutboundEmail.next_attempt_at <= now
+        )
+        .order_by(OutboundEmail.next_attempt_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).scalars().all()
+
+    for message in messages:
+        message.status = 'sending'
+        message.next_attempt_at = now + timedelta(seconds=SEND_LEASE_SECONDS)
+    db.session.commit()
+    return messages
+
+
+def process_outbox(batch_size=20):
+    """Send one batch of due emails and return how many were attempted"""
+    messages = claim_due_emails(batch_size)
+
+    for message in messages:
+        message.attempts = (message.attempts or 0) + 1
+        try:
+            mail = EMAIL_BUILDERS[message.kind](message.to_email, json.loads(message.payload or '{}'))
+            deliver_email(mail)
+        except Exception as e:
+            message.last_error = str(e)
+            if message.attempts >= MAX_ATTEMPTS:
+                message.status = 'failed'
+                logging.error("Giving up on %r after %d attempts: %s", message, message.attempts, e)
+            else:
+                message.status = 'pending'
+                message.next_attempt_at = datetime.utcnow() + timedelta(seconds=retry_delay(message.attempts))
+                logging.warning("Email %s failed (attempt %d), will retry: %s", message.id, message.attempts, e)
+        else:
+            message.status = 'sent'
+            message.sent_date = datetime.utcnow()
+            message.last_error = None
+            logging.info("Sent %s email %s", message.kind, message.id)
+        db.session.commit()
+
+    return len(messages)
+
+
+def run_outbox_worker(poll_interval=5, batch_size=20, once=False):
+    """Keep sending due emails, sleeping between polls when the queue is empty"""
+    while True:
+        try:
+            sent = process_outbox(batch_size)
+        except Exception as e:
+            db.session.rollback()
+            logging.error("Email worker error: %s", e)
+            sent = 0
+        if once:
+            return sent
+        if not sent:
+            time.sleep(poll_interval)
+
+
+def start_outbox_thread(app, poll_interval=5):
+    """Run the email worker in a daemon thread of this process
+
+    For deployments without a separate worker process. Several processes can
+    do this at once, since emails are claimed with SKIP LOCKED.
+    """
+    def work():
+        with app.app_context():
+            run_outbox_worker(poll_interval)
+
+    thread = threading.Thread(target=work, name='email-outbox', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_outbox_thread_on_first_request(app, poll_interval=5):
+    """Start the email worker thread once this process serves its first request
+
+    Flask CLI commands import the app too but never serve a request, so they
+    don't start it; under gunicorn each worker starts its own after forking.
+    """
+    lock = threading.Lock()
+    started = []
+
+    @app.before_request
+    def start_outbox():
+        if not started:
+            with lock:
+                if not started:
+                    started.append(start_outbox_thread(app, poll_interval))
@@ -0,0 +1,121 @@
+import time
+import uuid
+from datetime import datetime
+from functools import wraps
+from flask import current_app, flash, g, redirect, session, url_for
+from sqlalchemy import select
+from app import db, login_manager
+from models import SiteSettings, User, upsert_statement
+
+# Reserved settings row that changes whenever any user's subscription changes
+ENTITLEMENT_VERSION_SETTING = '_entitlements_version'
+
+# Session key holding the current user's entitlement claim
+SESSION_KEY = 'entitlement'
+
+# Per-worker cache of the entitlement version
+_version_cache = {'version': None, 'checked_at': 0.0}
+
+
+def get_entitlement_version():
+    """Get the entitlement version, re-reading it at most once per ENTITLEMENT_VERSION_TTL"""
+    now = time.monotonic()
+    if now - _version_cache['checked_at'] >= current_app.config['ENTITLEMENT_VERSION_TTL']:
+        _version_cache['version'] = db.session.execute(
+            select(SiteSettings.setting_value).filter_by(setting_name=ENTITLEMENT_VERSION_SETTING)
+        ).scalar()
+        _version_cache['checked_at'] = now
+    return _version_cache['version']
+
+
+def bump_entitlement_version():
+    """Make every worker refresh its users' claims; runs in the caller's transaction"""
+    version = uuid.uuid4().hex
+    statement = upsert_statement(SiteSettings).values(
+        setting_name=ENTITLEMENT_VERSION_SETTING,
+        setting_value=version,
+        description='Changes whenever a subscription changes, to refresh entitlement claims',
+        updated_date=datetime.utcnow()
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['setting_name'],
+        set_={'setting_value': statement.excluded.setting_value, 'updated_date': statement.excluded.updated_date}
+    ))
+    _version_cache['version'] = version
+    _version_cache['checked_at'] = time.monotonic()
+
+
+def issue_entitlement(user_id):
+    """Load the user's subscription state and store a fresh claim in the session
+
+    Returns None if the user no longer exists.
+    """
+    version = get_entitlement_version()
+    row = db.session.execute(
+        select(User.is_owner, User.subscription_status).filter_by(id=user_id)
+    ).first()
+    if row is None:
+        session.pop(SESSION_KEY, None)
+        return None
+
+    claim = {
+        'uid': user_id,
+        'owner': bool(row.is_owner),
+        'status': row.subscription_status,
+        'exp': int(time.time()) + current_app.config['ENTITLEMENT_TTL'],
+        'ver': version,
+    }
+    session[SESSION_KEY] = claim
+    return claim
+
+
+def load_entitlement():
+    """Get the logged-in user's entitlement claim, refreshing it if stale
+
+    The claim lives in the signed session cookie, so while it's fresh this
+    makes no query for the user. Returns None when nobody is logged in.
+    """
+    user_id = session.get('_user_id')
+    if user_id is None:
+        return None
+
+    claim = session.get(SESSION_KEY)
+    if (claim is None or str(claim.get('uid')) != user_id or claim.get('exp', 0) <= time.time()
+            or claim.get('ver') != get_entitlement_version()):
+        claim = issue_entitlement(int(user_id))
+    return claim
+
+
+def is_entitled(claim):
+    """Check a claim for journal access, the same rule as User.has_active_subscription"""
+    return claim['owner'] or claim['status'] == 'active'
+
+
+def current_user_id():
+    """The id of the user whose claim the current request was checked against"""
+    return g.entitlement['uid']
+
+
+def subscription_required(view=None, api=False):
+    """Require a logged-in user with an active subscription (or the owner)
+
+    Use in place of login_required. Pages redirect to the subscription info
+    page; with api=True, JSON endpoints answer 403 instead.
+    """
+    if view is None:
+        return lambda view: subscription_required(view, api)
+
+    @wraps(view)
+    def decorated(*args, **kwargs):
+        claim = load_entitlement()
+        if claim is None:
+            return login_manager.unauthorized()
+        if not is_entitled(claim):
+            if api:
+                return {'success': False, 'error': 'Subscription required'}, 403
+            flash('Your subscription is not active. Please subscribe to access the recovery journal.', 'error')
+            return redirect(url_for('subscription_info'))
+        g.entitlement = claim
+        return view(*args, **kwargs)
+
+    return decorated
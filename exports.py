@@ -0,0 +1,175 @@
+import io
+import csv
+import json
+import zipfile
+from datetime import datetime
+from itertools import groupby
+from sqlalchemy import select
+from app import db
+from models import JournalEntry, PDFAnnotation, DrawingStrokeBatch
+from drawing_store import DrawingStoreError, decode_data_url, get_drawing_store, render_stroke_png
+from strokes import decode_strokes
+
+# Rows fetched per round trip while streaming an export
+EXPORT_BATCH_SIZE = 100
+
+# Bytes copied at a time from stored drawings into the archive
+COPY_CHUNK_SIZE = 64 * 1024
+
+# Exported fields per record type, in column order
+JOURNAL_EXPORT_FIELDS = (
+    ('day_number',) + JournalEntry.TEXT_FIELDS + JournalEntry.RATING_FIELDS +
+    ('completion_percentage', 'completed', 'time_spent_minutes', 'drawing_ref', 'created_date', 'updated_date')
+)
+PDF_EXPORT_FIELDS = ('page_number', 'notes', 'drawing_ref', 'created_date', 'updated_date')
+
+CSV_COLUMNS = ('record',) + JOURNAL_EXPORT_FIELDS + tuple(
+    field for field in PDF_EXPORT_FIELDS if field not in JOURNAL_EXPORT_FIELDS
+)
+
+
+def _stream(query):
+    """Execute a query with a server-side cursor, fetching EXPORT_BATCH_SIZE rows at a time"""
+    return db.session.execute(query.execution_options(stream_results=True, yield_per=EXPORT_BATCH_SIZE))
+
+
+def iter_export_records(user_id):
+    """Yield the user's journal entries, then their PDF annotations, as plain dicts
+
+    Each dict has a ``record`` key ('journal_entry' or 'pdf_annotation').
+    """
+    for record, model, fields, order in (
+        ('journal_entry', JournalEntry, JOURNAL_EXPORT_FIELDS, JournalEntry.day_number),
+        ('pdf_annotation', PDFAnnotation, PDF_EXPORT_FIELDS, PDFAnnotation.page_number),
+    ):
+        query = (
+            select(*(getattr(model, field) for field in fields))
+            .where(model.user_id == user_id)
+            .order_by(order)
+        )
+        for row in _stream(query):
+            values = {
+                field: value.isoformat() if isinstance(value, datetime) else value
+                for field, value in zip(fields, row)
+            }
+            yield dict(record=record, **values)
+
+
+def iter_export_ndjson(user_id):
+    """Yield the export as newline-delimited JSON, one record per line"""
+    for values in iter_export_records(user_id):
+        yield json.dumps(values) + '\n'
+
+
+def iter_export_csv(user_id):
+    """Yield the export as CSV, journal entries and annotations sharing one set of columns"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS)
+    writer.writeheader()
+    for values in iter_export_records(user_id):
+        writer.writerow(values)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _ZipStream(io.RawIOBase):
+    """Write-only file that collects what the archive writes until it's drained"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _stored_entry(name):
+    """Archive entry for an already-compressed PNG, which deflate wouldn't shrink"""
+    return zipfile.ZipInfo(name, date_time=datetime.now().timetuple()[:6])
+
+
+def _drawing_name(record, number):
+    if record == 'journal_entry':
+        return f"journal-day-{number:02d}"
+    return f"pdf-page-{number:03d}"
+
+
+def iter_export_zip(user_id, canvas_size):
+    """Yield a ZIP archive of the export as it's written
+
+    The archive holds export.ndjson, each saved canvas drawing, and a PNG
+    and JSON copy of each stroke canvas. The archive is never held in
+    memory: entries are written with data descriptors and handed on in
+    chunks, and stored drawings are copied a chunk at a time.
+    """
+    return (chunk for chunk in _iter_zip_chunks(user_id, canvas_size) if chunk)
+
+
+def _iter_zip_chunks(user_id, canvas_size):
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        drawings = []
+        with archive.open('export.ndjson', 'w') as entry:
+            for values in iter_export_records(user_id):
+                entry.write((json.dumps(values) + '\n').encode('utf-8'))
+                if values['drawing_ref']:
+                    number = values.get('day_number') or values.get('page_number')
+                    drawings.append((_drawing_name(values['record'], number), values['drawing_ref']))
+                yield stream.drain()
+        yield stream.drain()
+
+        # Only (name, key) pairs are kept, a few dozen at most per user
+        store = get_drawing_store()
+        for name, key in drawings:
+            try:
+                drawing_file = store.open(key)
+            except FileNotFoundError:
+                continue
+            with drawing_file, archive.open(_stored_entry(f"drawings/{name}.png"), 'w') as entry:
+                for chunk in iter(lambda: drawing_file.read(COPY_CHUNK_SIZE), b''):
+                    entry.write(chunk)
+                    yield stream.drain()
+            yield stream.drain()
+
+        # Drawings `flask migrate-drawings` hasn't moved yet are decoded from their data URL
+        for record, model, number_column in (
+            ('journal_entry', JournalEntry, JournalEntry.day_number),
+            ('pdf_annotation', PDFAnnotation, PDFAnnotation.page_number),
+        ):
+            query = (
+                select(number_column, model.drawing_data)
+                .where(model.user_id == user_id, model.drawing_ref.is_(None), model.drawing_data.isnot(None))
+                .order_by(number_column)
+            )
+            for number, data_url in _stream(query):
+                try:
+                    png = decode_data_url(data_url.strip())
+                except DrawingStoreError:
+                    continue
+                archive.writestr(_stored_entry(f"drawings/{_drawing_name(record, number)}.png"), png)
+                yield stream.drain()
+
+        query = (
+            select(DrawingStrokeBatch.canvas, DrawingStrokeBatch.number, DrawingStrokeBatch.data)
+            .where(DrawingStrokeBatch.user_id == user_id)
+            .order_by(DrawingStrokeBatch.canvas, DrawingStrokeBatch.number, DrawingStrokeBatch.id)
+        )
+        # One canvas's strokes at a time, since rendering needs all of them; canvases
+        # already viewed or exported as a PNG are read back from the drawing store
+        for (canvas, number), batches in groupby(_stream(query), key=lambda row: (row.canvas, row.number)):
+            data = b''.join(batch.data for batch in batches)
+            name = _drawing_name('journal_entry' if canvas == 'journal' else 'pdf_annotation', number)
+            archive.writestr(f"strokes/{name}.json", json.dumps(decode_strokes(data)))
+            archive.writestr(_stored_entry(f"strokes/{name}.png"), render_stroke_png(data, *canvas_size))
+            yield stream.drain()
+    yield stream.drain()
@@ -75,3 +75,25 @@ class LoginForm(FlaskForm):
     ])
     
     submit = SubmitField('Sign In')
+
+class BroadcastForm(FlaskForm):
+    """Form for sending a broadcast email to all active subscribers"""
+    subject = StringField('Subject', validators=[
+        DataRequired(message="Please enter a subject"),
+        Length(min=5, max=200, message="Subject must be between 5 and 200 characters")
+    ])
+    
+    message = TextAreaField('Message', validators=[
+        DataRequired(message="Please enter your message"),
+        Length(min=10, max=20000, message="Message must be between 10 and 20000 characters")
+    ])
+    
+    submit = SubmitField('Send to All Subscribers')
+
+class ResumeBroadcastForm(FlaskForm):
+    """Form for resuming an interrupted broadcast (carries only the CSRF token)"""
+    submit = SubmitField('Resume')
+
+class RefreshAnalyticsForm(FlaskForm):
+    """Form for refreshing the analytics rollups (carries only the CSRF token)"""
+    submit = SubmitField('Refresh Now')
@@ -0,0 +1,28 @@
+import psycopg2
+from psycopg2 import extensions
+
+
+def gevent_wait_callback(connection, timeout=None):
+    """Wait for a psycopg2 connection by yielding to other greenlets instead of blocking the worker"""
+    from gevent.socket import wait_read, wait_write
+
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            break
+        elif state == extensions.POLL_READ:
+            wait_read(connection.fileno(), timeout=timeout)
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno(), timeout=timeout)
+        else:
+            raise psycopg2.OperationalError(f"Bad result from poll: {state!r}")
+
+
+def make_psycopg2_green():
+    """Make every psycopg2 query cooperative, so a slow query only holds up its own request
+
+    Call once per process after gevent has patched the standard library.
+    Outbound HTTP (Stripe through requests, SendGrid through http.client)
+    is made cooperative by that patching alone.
+    """
+    extensions.set_wait_callback(gevent_wait_callback)
@@ -0,0 +1,25 @@
+# Cooperative serving mode: gunicorn -c gunicorn_gevent.conf.py main:app
+#
+# Each worker runs many requests at once on gevent greenlets. While one waits on
+# Postgres, SendGrid or Stripe the others keep running, so an instance holds far
+# more in-flight requests (autosaves especially) without more processes.
+# Needs the optional 'gevent' extra.
+import os
+import multiprocessing
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 4)))
+
+# Requests each worker runs at once
+worker_connections = int(os.environ.get('GEVENT_WORKER_CONNECTIONS', 1000))
+
+# Requests share each worker's database connections; these become the app's pool settings
+os.environ.setdefault('DB_POOL_SIZE', '20')
+os.environ.setdefault('DB_MAX_OVERFLOW', '20')
+
+
+def post_fork(server, worker):
+    # The gevent worker has patched the standard library by now; psycopg2 needs a wait callback too
+    from gevent_support import make_psycopg2_green
+    make_psycopg2_green()
@@ -0,0 +1,233 @@
+import hmac
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from flask import abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Histogram buckets: seconds for latencies, plain numbers for query counts
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+# Longest SQL text quoted in slow-query and N+1 warnings
+MAX_LOGGED_SQL = 300
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    """Render [(name, value)] pairs as a Prometheus label set"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+class Metric:
+    """A named metric with one series per combination of label values"""
+
+    type = None
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        """The metric in the Prometheus text exposition format"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            series = sorted(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(list(zip(self.label_names, key)), value))
+        return lines
+
+
+class CounterMetric(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, labels, value):
+        return [f"{self.name}{_format_labels(labels)} {value}"]
+
+
+class HistogramMetric(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, label_names=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['buckets'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def totals(self):
+        """The sum and count of observations for each series, keyed by label values"""
+        with self._lock:
+            return {key: (series['sum'], series['count']) for key, series in self._series.items()}
+
+    def _render_series(self, labels, series):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, series['buckets']):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', bound)])} {cumulative}")
+        lines.append(f"{self.name}_bucket{_format_labels(labels + [('le', '+Inf')])} {series['count']}")
+        lines.append(f"{self.name}_sum{_format_labels(labels)} {series['sum']}")
+        lines.append(f"{self.name}_count{_format_labels(labels)} {series['count']}")
+        return lines
+
+
+REQUEST_SECONDS = HistogramMetric(
+    'http_request_duration_seconds', 'Time to produce a response, by endpoint.',
+    ('endpoint', 'method', 'status'))
+REQUEST_QUERIES = HistogramMetric(
+    'http_request_sql_queries', 'SQL statements executed per request, by endpoint.',
+    ('endpoint',), QUERY_COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = HistogramMetric(
+    'http_request_sql_duration_seconds', 'Time spent in SQL per request, by endpoint.',
+    ('endpoint',))
+SLOW_QUERIES = CounterMetric(
+    'sql_slow_queries_total', 'SQL statements slower than SLOW_QUERY_SECONDS, by endpoint.',
+    ('endpoint',))
+REPEATED_QUERIES = CounterMetric(
+    'sql_repeated_query_requests_total', 'Requests that ran one statement N_PLUS_ONE_THRESHOLD times or more.',
+    ('endpoint',))
+OUTBOUND_SECONDS = HistogramMetric(
+    'outbound_request_duration_seconds', 'Time spent calling external services.',
+    ('service', 'operation'))
+OUTBOUND_ERRORS = CounterMetric(
+    'outbound_request_errors_total', 'Failed calls to external services.',
+    ('service', 'operation'))
+
+METRICS = (REQUEST_SECONDS, REQUEST_QUERIES, REQUEST_SQL_SECONDS, SLOW_QUERIES, REPEATED_QUERIES,
+           OUTBOUND_SECONDS, OUTBOUND_ERRORS)
+
+# Set by init_instrumentation
+_settings = {'slow_query_seconds': None, 'n_plus_one_threshold': None}
+
+
+def observe_outbound(service, operation, seconds, error=False):
+    """Record one call to an external service"""
+    OUTBOUND_SECONDS.observe(seconds, service=service, operation=operation)
+    if error:
+        OUTBOUND_ERRORS.inc(service=service, operation=operation)
+
+
+@contextmanager
+def timed_outbound(service, operation):
+    """Time the enclosed call to an external service, counting it as failed if it raises"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        observe_outbound(service, operation, time.perf_counter() - started, error=True)
+        raise
+    observe_outbound(service, operation, time.perf_counter() - started)
+
+
+def _request_endpoint():
+    return request.endpoint or 'unmatched'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - conn.info['query_started'].pop()
+    in_request = has_request_context()
+    state = g.get('_request_metrics') if in_request else None
+    if state is not None:
+        state['queries'] += 1
+        state['sql_seconds'] += seconds
+        state['statements'][statement] += 1
+
+    slow_query_seconds = _settings['slow_query_seconds']
+    if slow_query_seconds is not None and seconds >= slow_query_seconds:
+        endpoint = _request_endpoint() if in_request else 'none'
+        SLOW_QUERIES.inc(endpoint=endpoint)
+        logging.warning("Slow query (%.3fs) in %s: %s", seconds, endpoint, statement[:MAX_LOGGED_SQL])
+
+
+def _handle_error(context):
+    # The statement failed, so after_cursor_execute won't pop its start time
+    if context.connection is not None and context.connection.info.get('query_started'):
+        context.connection.info['query_started'].pop()
+
+
+def _start_request():
+    g._request_metrics = {'started': time.perf_counter(), 'queries': 0, 'sql_seconds': 0.0, 'statements': Counter()}
+
+
+def _finish_request(response):
+    state = g.pop('_request_metrics', None)
+    if state is None or request.endpoint == 'metrics':
+        return response
+
+    endpoint = _request_endpoint()
+    REQUEST_SECONDS.observe(time.perf_counter() - state['started'],
+                            endpoint=endpoint, method=request.method, status=response.status_code)
+    REQUEST_QUERIES.observe(state['queries'], endpoint=endpoint)
+    REQUEST_SQL_SECONDS.observe(state['sql_seconds'], endpoint=endpoint)
+
+    if state['statements']:
+        statement, count = state['statements'].most_common(1)[0]
+        if count >= _settings['n_plus_one_threshold']:
+            REPEATED_QUERIES.inc(endpoint=endpoint)
+            logging.warning("Possible N+1 in %s: one statement ran %d times (%d queries in total): %s",
+                            endpoint, count, state['queries'], statement[:MAX_LOGGED_SQL])
+    return response
+
+
+def render_metrics():
+    """Every metric in the Prometheus text exposition format"""
+    return '\n'.join(line for metric in METRICS for line in metric.render()) + '\n'
+
+
+def metrics_view():
+    """Prometheus scrape endpoint, behind a bearer token; hidden unless METRICS_TOKEN is set"""
+    token = current_app.config.get('METRICS_TOKEN')
+    if not token or not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        abort(404)
+    return current_app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def init_instrumentation(app):
+    """Time requests, SQL and outbound calls, and serve the results at /metrics
+
+    Metrics are kept per process, so with several gunicorn workers each
+    scrape sees the worker that answered it.
+    """
+    _settings['slow_query_seconds'] = app.config.get('SLOW_QUERY_SECONDS')
+    _settings['n_plus_one_threshold'] = app.config.get('N_PLUS_ONE_THRESHOLD', 10)
+    if not event.contains(Engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+        event.listen(Engine, 'handle_error', _handle_error)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
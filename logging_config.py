@@ -0,0 +1,163 @@
+import os
+import sys
+import copy
+import json
+import atexit
+import queue
+import random
+import logging
+import logging.handlers
+from datetime import datetime, timezone
+from flask import has_request_context, request
+
+# Loggers that are far too chatty below WARNING for production, unless LOG_LEVELS says otherwise
+QUIET_LOGGERS = {
+    'sqlalchemy.engine': 'WARNING',
+    'sqlalchemy.pool': 'WARNING',
+    'urllib3': 'WARNING',
+    'stripe': 'WARNING',
+}
+
+# Attributes every LogRecord has; anything else came from `extra=` and is added to JSON output
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime', 'taskName'}
+
+# The running queue listener, stopped at exit so queued records are written
+_listener = None
+
+
+def _parse_pairs(value):
+    """Parse 'name=value,name=value' settings into a dict"""
+    pairs = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, setting = item.split('=', 1)
+            pairs[name.strip()] = setting.strip()
+    return pairs
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, with any `extra=` fields and the current request"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in _RECORD_ATTRIBUTES:
+                entry[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queues a snapshot of each record, leaving formatting and writing to the listener thread
+
+    The message and any traceback are rendered here, on the logging thread,
+    so arguments such as ORM objects are logged in their state at the time of
+    the call rather than whenever the listener gets to them. The standard
+    QueueHandler also runs the full formatter at this point; this queue never
+    leaves the process, so that part is left to the listener.
+    """
+
+    # Renders tracebacks exactly as the formatters would
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestContextFilter(logging.Filter):
+    """Adds the request's method and path to records logged while handling one
+
+    Runs in the logging call, where the request is still available; the
+    queue listener thread that formats the record has no request context.
+    """
+
+    def filter(self, record):
+        if has_request_context() and not hasattr(record, 'path'):
+            record.method = request.method
+            record.path = request.path
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through only a fraction of the records below WARNING from chosen loggers
+
+    ``rates`` maps logger names to the fraction kept; a logger's children are
+    sampled at its rate unless they have their own.
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        name = record.name
+        while name:
+            if name in self.rates:
+                return random.random() < self.rates[name]
+            name = name.rpartition('.')[0]
+        return True
+
+
+def stop_listener():
+    """Write out every queued record and stop the background logging thread, if there is one"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure_logging():
+    """Set up logging from the environment
+
+    LOG_LEVEL        root level (default INFO)
+    LOG_LEVELS       per-logger levels, e.g. "sqlalchemy.engine=INFO,stripe=DEBUG"
+    LOG_FORMAT       "text" (default) or "json", one object per line
+    LOG_SAMPLE       fraction of sub-WARNING records kept per logger, e.g. "sqlalchemy.engine=0.01"
+    LOG_QUEUE        "0" writes logs from the calling thread instead of a background one
+    """
+    global _listener
+
+    levels = dict(QUIET_LOGGERS, **_parse_pairs(os.environ.get('LOG_LEVELS')))
+    sample_rates = {name: float(rate) for name, rate in _parse_pairs(os.environ.get('LOG_SAMPLE')).items()}
+
+    handler = logging.StreamHandler(sys.stderr)
+    if os.environ.get('LOG_FORMAT', 'text').lower() == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    if os.environ.get('LOG_QUEUE', '1') != '0':
+        # Request threads only put records on a queue; a listener thread formats and writes them
+        log_queue = queue.SimpleQueue()
+        stop_listener()
+        _listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(stop_listener)
+        handler = BackgroundQueueHandler(log_queue)
+    handler.addFilter(SamplingFilter(sample_rates))
+    handler.addFilter(RequestContextFilter())
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level.upper())
@@ -1,4 +1,12 @@
-from app import app
+import os
+from app import create_app
+
+app = create_app()
+
+# Send queued emails from the server when there is no separate `flask email-worker`
+if os.environ.get("EMAIL_WORKER_IN_PROCESS"):
+    from email_outbox import start_outbox_thread_on_first_request
+    start_outbox_thread_on_first_request(app)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,186 @@
+import logging
+from datetime import datetime
+from sqlalchemy import delete, func, inspect, select, text, update
+from app import db
+from models import CheckoutSession, JournalEntry, PDFAnnotation, SiteSettings, User, upsert_statement
+
+# Reserved settings row holding the number of the last migration applied
+SCHEMA_VERSION_SETTING = '_schema_version'
+
+
+def recompute_progress(keep_updated_dates=False):
+    """Recompute stored completion percentages and per-user completed-day counters; the caller commits
+
+    Entries count as updated (so analytics picks them up) unless
+    ``keep_updated_dates`` is set. Returns the number of entries and users updated.
+    """
+    completion = JournalEntry.completion_percentage_sql()
+    values = {'completion_percentage': completion, 'completed': completion >= 50}
+    if keep_updated_dates:
+        values['updated_date'] = JournalEntry.updated_date
+    entries = db.session.execute(update(JournalEntry).values(**values))
+    users = db.session.execute(
+        update(User).values(days_completed=select(func.count(JournalEntry.id)).where(
+            JournalEntry.user_id == User.id, JournalEntry.completed.is_(True)
+        ).scalar_subquery())
+    )
+    return entries.rowcount, users.rowcount
+
+
+def _quote(name):
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def _add_column(model, column, definition):
+    """Add a column that tables created before it was in the model are missing"""
+    table = model.__table__.name
+    if column in {existing['name'] for existing in inspect(db.session.connection()).get_columns(table)}:
+        return False
+    db.session.execute(text(f"ALTER TABLE {_quote(table)} ADD COLUMN {_quote(column)} {definition}"))
+    return True
+
+
+def _add_unique(model, name, columns):
+    """Add one of the model's unique constraints, first removing rows that break it
+
+    Of each group of duplicates the most recently updated row is kept.
+    """
+    table = model.__table__.name
+    inspector = inspect(db.session.connection())
+    existing = [set(constraint['column_names']) for constraint in inspector.get_unique_constraints(table)]
+    existing += [set(index['column_names']) for index in inspector.get_indexes(table) if index['unique']]
+    if set(columns) in existing:
+        return False
+
+    key = [getattr(model, column) for column in columns]
+    ranked = select(
+        model.id,
+        func.row_number().over(partition_by=key, order_by=(model.updated_date.desc().nulls_last(), model.id.desc())).label('rank')
+    ).subquery()
+    removed = db.session.execute(delete(model).where(model.id.in_(select(ranked.c.id).where(ranked.c.rank > 1))))
+    if removed.rowcount:
+        logging.warning("Removed %d duplicate %s rows before adding %s", removed.rowcount, table, name)
+
+    column_list = ', '.join(_quote(column) for column in columns)
+    if db.engine.dialect.name == 'sqlite':
+        # SQLite can't add constraints to a table; a unique index backs ON CONFLICT just the same
+        db.session.execute(text(f"CREATE UNIQUE INDEX {_quote(name)} ON {_quote(table)} ({column_list})"))
+    else:
+        db.session.execute(text(f"ALTER TABLE {_quote(table)} ADD CONSTRAINT {_quote(name)} UNIQUE ({column_list})"))
+    return True
+
+
+def _add_index(model, name):
+    """Create one of the model's indexes if the table doesn't have it yet"""
+    index = next(index for index in model.__table__.indexes if index.name == name)
+    if name in {existing['name'] for existing in inspect(db.session.connection()).get_indexes(model.__table__.name)}:
+        return False
+    index.create(db.session.connection())
+    return True
+
+
+def _add_drawing_refs():
+    _add_column(JournalEntry, 'drawing_ref', 'VARCHAR(64)')
+    _add_column(PDFAnnotation, 'drawing_ref', 'VARCHAR(64)')
+
+
+def _add_entry_version():
+    _add_column(JournalEntry, 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+def _add_completion_percentage():
+    if _add_column(JournalEntry, 'completion_percentage', 'INTEGER NOT NULL DEFAULT 0'):
+        # Keeping the dates lets the next migration tell which duplicate entry was edited last
+        recompute_progress(keep_updated_dates=True)
+
+
+def _add_unique_days_and_pages():
+    removed_entries = _add_unique(JournalEntry, 'uq_journal_entry_user_day', ('user_id', 'day_number'))
+    _add_unique(PDFAnnotation, 'uq_pdf_annotation_user_page', ('user_id', 'page_number'))
+    if removed_entries:
+        # Removed duplicates may have been counted in days_completed
+        recompute_progress(keep_updated_dates=True)
+
+
+def _add_subscription_tracking():
+    _add_column(User, 'stripe_subscription_id', 'VARCHAR(100)')
+    _add_column(User, 'subscription_updated_at', 'TIMESTAMP')
+
+
+def _add_entry_updated_index():
+    _add_index(JournalEntry, 'ix_journal_entry_updated_date')
+
+
+def _add_checkout_idempotency_keys():
+    table = CheckoutSession.__table__
+    connection = db.session.connection()
+    if 'idempotency_key' in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        return
+    # Open sessions only save repeat calls to Stripe, so the table is recreated rather
+    # than altered (SQLite can't make the session id and URL columns nullable)
+    table.drop(connection)
+    table.create(connection)
+
+
+# Changes to tables that db.create_all() leaves alone once they exist, in the order they were made.
+# Each checks the live schema first, so databases patched by hand are brought up to date safely.
+# Append new ones; never renumber.
+MIGRATIONS = (
+    (1, 'Add drawing_ref to journal entries and PDF annotations', _add_drawing_refs),
+    (2, 'Add version to journal entries', _add_entry_version),
+    (3, 'Add completion_percentage to journal entries', _add_completion_percentage),
+    (4, 'Remove duplicate days and pages and make them unique', _add_unique_days_and_pages),
+    (5, 'Add Stripe subscription tracking to users', _add_subscription_tracking),
+    (6, 'Index journal entries by updated_date', _add_entry_updated_index),
+    (7, 'Give checkout sessions their own idempotency keys', _add_checkout_idempotency_keys),
+)
+
+
+def schema_version():
+    """The number of the last migration applied, 0 for a database that has never been migrated"""
+    if not inspect(db.session.connection()).has_table(SiteSettings.__table__.name):
+        return 0
+    version = db.session.execute(
+        select(SiteSettings.setting_value).filter_by(setting_name=SCHEMA_VERSION_SETTING)
+    ).scalar()
+    return int(version) if version else 0
+
+
+def _set_schema_version(number):
+    now = datetime.utcnow()
+    statement = upsert_statement(SiteSettings).values(
+        setting_name=SCHEMA_VERSION_SETTING,
+        setting_value=str(number),
+        description='Last database migration applied by `flask migrate-db`',
+        updated_date=now
+    )
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['setting_name'],
+        set_={'setting_value': statement.excluded.setting_value, 'updated_date': statement.excluded.updated_date}
+    ))
+
+
+def migrate_database():
+    """Create missing tables and apply pending migrations, committing after each one
+
+    Returns the (number, description) of each migration applied.
+    """
+    current = schema_version()
+    new_database = not inspect(db.session.connection()).get_table_names()
+    db.create_all()
+    if new_database:
+        # Every table was just created as the models define it, so there is nothing to migrate
+        current = MIGRATIONS[-1][0]
+        _set_schema_version(current)
+    db.session.commit()
+
+    applied = []
+    for number, description, migrate in MIGRATIONS:
+        if number <= current:
+            continue
+        migrate()
+        _set_schema_version(number)
+        db.session.commit()
+        logging.info("Applied migration %d: %s", number, description)
+        applied.append((number, description))
+    return applied
@@ -1,8 +1,20 @@
 from app import db
+from collections import namedtuple
 from datetime import datetime
+from sqlalchemy import case, func
+from sqlalchemy.dialects import postgresql, sqlite
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 
+# Progress for a journal day that has no saved entry yet
+DayProgress = namedtuple('DayProgress', 'day_number completed mood_rating completion_percentage')
+
+def upsert_statement(model):
+    """INSERT for the current database that supports ON CONFLICT clauses"""
+    if db.session.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(model)
+    return postgresql.insert(model)
+
 class EmailSubscriber(db.Model):
     """Model for storing email subscribers to the recovery community"""
     id = db.Column(db.Integer, primary_key=True)
@@ -15,6 +27,81 @@ class EmailSubscriber(db.Model):
     def __repr__(self):
         return f'<EmailSubscriber {self.email}>'
 
+class OutboundEmail(db.Model):
+    """Model for queued outbound emails, delivered by the background email worker"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # Which email to build, e.g. 'welcome'
+    to_email = db.Column(db.String(120), nullable=False)
+    payload = db.Column(db.Text, nullable=True)  # JSON arguments for building the email
+    status = db.Column(db.String(20), default='pending')  # pending, sending, sent, failed
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)  # Also the lease expiry while sending
+    last_error = db.Column(db.Text, nullable=True)
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_date = db.Column(db.DateTime, nullable=True)
+    
+    __table_args__ = (
+        db.Index('ix_outbound_email_due', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<OutboundEmail {self.kind} to {self.to_email}: {self.status}>'
+
+class Broadcast(db.Model):
+    """Model for an email broadcast to every active subscriber"""
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(200), nullable=False)
+    message = db.Column(db.Text, nullable=False)  # Plain text; {name} becomes the subscriber's name
+    status = db.Column(db.String(20), default='pending')  # pending, sending, completed
+    last_subscriber_id = db.Column(db.Integer, default=0)  # Resume point: highest subscriber id already sent
+    recipients_sent = db.Column(db.Integer, default=0)
+    lease_expires_at = db.Column(db.DateTime, nullable=True)  # While sending, when another sender may take over
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_date = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<Broadcast {self.id} {self.subject!r}: {self.status}>'
+
+class BroadcastBatch(db.Model):
+    """Model for one SendGrid request sent as part of a broadcast"""
+    id = db.Column(db.Integer, primary_key=True)
+    broadcast_id = db.Column(db.Integer, db.ForeignKey('broadcast.id'), nullable=False, index=True)
+    first_subscriber_id = db.Column(db.Integer, nullable=False)
+    last_subscriber_id = db.Column(db.Integer, nullable=False)
+    recipient_count = db.Column(db.Integer, nullable=False)
+    sent_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<BroadcastBatch {self.first_subscriber_id}-{self.last_subscriber_id} of Broadcast {self.broadcast_id}>'
+
+class StripeEvent(db.Model):
+    """Model for Stripe webhook events, logged once per event id so redeliveries are ignored"""
+    id = db.Column(db.String(255), primary_key=True)  # Stripe's event id (evt_...)
+    type = db.Column(db.String(100), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # The event JSON as Stripe sent it
+    status = db.Column(db.String(20), default='pending')  # pending, processed, ignored, failed
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)  # When Stripe created the event
+    received_date = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_date = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<StripeEvent {self.id} {self.type}: {self.status}>'
+
+class CheckoutSession(db.Model):
+    """Model for open Stripe checkout sessions, reused while they're fresh instead of creating new ones"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_email = db.Column(db.String(120), unique=True, nullable=False)
+    idempotency_key = db.Column(db.String(64), nullable=False)  # Random, sent with every attempt to create this session
+    stripe_session_id = db.Column(db.String(255))  # Empty until Stripe has created the session
+    url = db.Column(db.Text)
+    expires_at = db.Column(db.DateTime, nullable=False)  # Stop handing out the URL after this
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CheckoutSession {self.stripe_session_id} for {self.user_email}>'
+
 class ContactMessage(db.Model):
     """Model for storing contact form messages"""
     id = db.Column(db.Integer, primary_key=True)
@@ -43,6 +130,8 @@ class User(UserMixin, db.Model):
     subscription_status = db.Column(db.String(50), default='inactive')  # active, canceled, past_due
     subscription_start = db.Column(db.DateTime, nullable=True)
     subscription_end = db.Column(db.DateTime, nullable=True)
+    stripe_subscription_id = db.Column(db.String(100), nullable=True)
+    subscription_updated_at = db.Column(db.DateTime, nullable=True)  # Creation time of the last Stripe event applied
     
     # Recovery journal progress
     current_day = db.Column(db.Integer, default=1)
@@ -66,54 +155,120 @@ class User(UserMixin, db.Model):
 
 class JournalEntry(db.Model):
     """Model for individual journal entries with enhanced content storage"""
+    # Form fields that can be saved, grouped by how they are validated
+    TEXT_FIELDS = (
+        'daily_reflection', 'gratitude_items', 'challenges_faced',
+        'wins_celebrations', 'goals_tomorrow', 'trigger_notes',
+        'coping_strategies', 'support_connections'
+    )
+    RATING_FIELDS = ('mood_rating', 'energy_level', 'sleep_quality')
+
+    # Fields that count towards the completion percentage
+    COMPLETION_TEXT_FIELDS = TEXT_FIELDS
+    COMPLETION_RATING_FIELDS = ('mood_rating', 'energy_level')
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     day_number = db.Column(db.Integer, nullable=False)  # Day 1-30
     
     # Enhanced content fields for comprehensive journaling
-    daily_reflection = db.Column(db.Text, nullable=True)  # Main reflection content
-    gratitude_items = db.Column(db.Text, nullable=True)  # Gratitude list (JSON or text)
-    challenges_faced = db.Column(db.Text, nullable=True)  # Daily challenges
-    wins_celebrations = db.Column(db.Text, nullable=True)  # Daily wins/celebrations
-    goals_tomorrow = db.Column(db.Text, nullable=True)  # Goals for next day
+    # (text is deferred so progress views never load it; accessing one loads them all)
+    daily_reflection = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Main reflection content
+    gratitude_items = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Gratitude list (JSON or text)
+    challenges_faced = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Daily challenges
+    wins_celebrations = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Daily wins/celebrations
+    goals_tomorrow = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Goals for next day
     mood_rating = db.Column(db.Integer, nullable=True)  # 1-10 scale
     energy_level = db.Column(db.Integer, nullable=True)  # 1-10 scale
     sleep_quality = db.Column(db.Integer, nullable=True)  # 1-10 scale
-    trigger_notes = db.Column(db.Text, nullable=True)  # Trigger awareness notes
-    coping_strategies = db.Column(db.Text, nullable=True)  # Strategies used today
-    support_connections = db.Column(db.Text, nullable=True)  # People connected with
-    drawing_data = db.Column(db.Text, nullable=True)  # Canvas drawing data as base64
+    trigger_notes = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Trigger awareness notes
+    coping_strategies = db.deferred(db.Column(db.Text, nullable=True), group='content')  # Strategies used today
+    support_connections = db.deferred(db.Column(db.Text, nullable=True), group='content')  # People connected with
+    drawing_ref = db.Column(db.String(64), nullable=True)  # Drawing store key for the canvas PNG
+    drawing_data = db.deferred(db.Column(db.Text, nullable=True))  # Legacy base64 canvas data, shown until `flask migrate-drawings` moves it
     
     # Progress tracking
     completed = db.Column(db.Boolean, default=False)
+    completion_percentage = db.Column(db.Integer, nullable=False, default=0)  # Stored result of get_completion_percentage()
     time_spent_minutes = db.Column(db.Integer, nullable=True)  # Time spent journaling
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
     updated_date = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = db.Column(db.Integer, nullable=False, default=1)  # Bumped on every save for autosave conflict checks
     
     # Relationship
     user = db.relationship('User', backref=db.backref('journal_entries', lazy=True))
+
+    # Entries are only created on the first save, so days without one are virtual
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'day_number', name='uq_journal_entry_user_day'),
+        db.Index('ix_journal_entry_updated_date', 'updated_date'),  # Finds entries changed since the last rollup
+    )
+    __mapper_args__ = {'version_id_col': version}
+    
+    def update_completion(self):
+        """Recalculate and store the completion percentage and completed flag"""
+        self.completion_percentage = self.get_completion_percentage()
+        self.completed = self.completion_percentage >= 50  # Consider 50%+ as completed
+        return self.completion_percentage
     
     def get_completion_percentage(self):
         """Calculate how complete this journal entry is based on filled fields"""
         total_fields = 10  # Number of main content fields
         filled_fields = 0
         
-        fields_to_check = [
-            self.daily_reflection, self.gratitude_items, self.challenges_faced,
-            self.wins_celebrations, self.goals_tomorrow, self.trigger_notes,
-            self.coping_strategies, self.support_connections
-        ]
+        fields_to_check = [getattr(self, name) for name in self.COMPLETION_TEXT_FIELDS]
         
         for field in fields_to_check:
             if field and field.strip():
                 filled_fields += 1
         
-        if self.mood_rating is not None:
-            filled_fields += 1
-        if self.energy_level is not None:
-            filled_fields += 1
+        for name in self.COMPLETION_RATING_FIELDS:
+            if getattr(self, name) is not None:
+                filled_fields += 1
             
         return int((filled_fields / total_fields) * 100)
+
+    @classmethod
+    def progress_summary(cls, user_id):
+        """Get day number, completion and mood for each of a user's entries without loading any text"""
+        return db.session.execute(
+            db.select(
+                cls.day_number,
+                cls.completed,
+                cls.mood_rating,
+                cls.completion_percentage
+            )
+            .where(cls.user_id == user_id)
+            .order_by(cls.day_number)
+        ).all()
+
+    @classmethod
+    def progress_grid(cls, user_id, days=30):
+        """Get progress for every journal day, filling days without an entry with empty progress"""
+        saved = {row.day_number: row for row in cls.progress_summary(user_id)}
+        return [saved.get(day) or DayProgress(day, False, None, 0) for day in range(1, days + 1)]
+
+    @classmethod
+    def completion_percentage_sql(cls, overrides=None):
+        """SQL version of get_completion_percentage() for use inside UPDATE/SELECT statements
+
+        Fields present in ``overrides`` are scored in Python from the new values;
+        the rest are scored from the stored columns.
+        """
+        overrides = overrides or {}
+        score = 0
+        for name in cls.COMPLETION_TEXT_FIELDS:
+            if name in overrides:
+                score += 1 if overrides[name] and overrides[name].strip() else 0
+            else:
+                column = getattr(cls, name)
+                score += case((func.length(func.trim(func.coalesce(column, ''))) > 0, 1), else_=0)
+        for name in cls.COMPLETION_RATING_FIELDS:
+            if name in overrides:
+                score += 1 if overrides[name] is not None else 0
+            else:
+                score += case((getattr(cls, name).isnot(None), 1), else_=0)
+        return score * 10
     
     def __repr__(self):
         return f'<JournalEntry Day {self.day_number} for User {self.user_id}>'
@@ -124,16 +279,78 @@ class PDFAnnotation(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     page_number = db.Column(db.Integer, nullable=False)  # Page 1-79
     notes = db.Column(db.Text, nullable=True)  # Text notes for this page
-    drawing_data = db.Column(db.Text, nullable=True)  # Canvas drawing data as base64
+    drawing_ref = db.Column(db.String(64), nullable=True)  # Drawing store key for the canvas PNG
+    drawing_data = db.deferred(db.Column(db.Text, nullable=True))  # Legacy base64 canvas data, shown until `flask migrate-drawings` moves it
     created_date = db.Column(db.DateTime, default=datetime.utcnow)
     updated_date = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     # Relationship
     user = db.relationship('User', backref=db.backref('pdf_annotations', lazy=True))
+
+    # Annotations are only created on the first save
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'page_number', name='uq_pdf_annotation_user_page'),
+    )
     
     def __repr__(self):
         return f'<PDFAnnotation Page {self.page_number} for User {self.user_id}>'
 
+class DrawingStrokeBatch(db.Model):
+    """Model for strokes appended to a journal or PDF page canvas in one save"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    canvas = db.Column(db.String(20), nullable=False)  # 'journal' (day) or 'pdf' (page)
+    number = db.Column(db.Integer, nullable=False)  # Day or page number
+    data = db.Column(db.LargeBinary, nullable=False)  # Strokes packed by strokes.encode_strokes
+    created_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_drawing_stroke_batch_canvas', 'user_id', 'canvas', 'number'),
+    )
+    
+    def __repr__(self):
+        return f'<DrawingStrokeBatch {self.canvas} {self.number} for User {self.user_id}>'
+
+class JournalRollup(db.Model):
+    """Model for journal metrics pre-aggregated per signup cohort and day, rebuilt by analytics.refresh_rollups()"""
+    id = db.Column(db.Integer, primary_key=True)
+    cohort = db.Column(db.String(7), nullable=False)  # Signup month, YYYY-MM
+    day_number = db.Column(db.Integer, nullable=False)
+    entries = db.Column(db.Integer, nullable=False, default=0)  # Users with an entry for the day (the retention funnel)
+    completed_entries = db.Column(db.Integer, nullable=False, default=0)
+    completion_total = db.Column(db.Integer, nullable=False, default=0)  # Sum of completion percentages
+    # Sums and counts of the non-empty values of each metric, for averages
+    mood_total = db.Column(db.Integer, nullable=False, default=0)
+    mood_count = db.Column(db.Integer, nullable=False, default=0)
+    energy_total = db.Column(db.Integer, nullable=False, default=0)
+    energy_count = db.Column(db.Integer, nullable=False, default=0)
+    sleep_total = db.Column(db.Integer, nullable=False, default=0)
+    sleep_count = db.Column(db.Integer, nullable=False, default=0)
+    minutes_total = db.Column(db.Integer, nullable=False, default=0)
+    minutes_count = db.Column(db.Integer, nullable=False, default=0)
+    # JSON lists counting the ratings 1-10
+    mood_histogram = db.Column(db.Text, nullable=False, default='[]')
+    energy_histogram = db.Column(db.Text, nullable=False, default='[]')
+    sleep_histogram = db.Column(db.Text, nullable=False, default='[]')
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    __table_args__ = (
+        db.UniqueConstraint('cohort', 'day_number', name='uq_journal_rollup_cohort_day'),
+    )
+    
+    def __repr__(self):
+        return f'<JournalRollup {self.cohort} day {self.day_number}: {self.entries} entries>'
+
+class CohortRollup(db.Model):
+    """Model for the number of users who signed up in each month, rebuilt by analytics.refresh_rollups()"""
+    cohort = db.Column(db.String(7), primary_key=True)  # Signup month, YYYY-MM
+    users = db.Column(db.Integer, nullable=False, default=0)
+    subscribers = db.Column(db.Integer, nullable=False, default=0)  # Of those, how many are subscribed now
+    updated_date = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CohortRollup {self.cohort}: {self.users} users>'
+
 class SiteSettings(db.Model):
     """Model for customizable site layout and styling"""
     id = db.Column(db.Integer, primary_key=True)
@@ -0,0 +1,164 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import current_app, request, session
+
+# Prefix for page cache keys in a shared backend
+SHARED_KEY_PREFIX = 'page-cache:'
+
+
+class PageCache:
+    """Rendered pages, keyed by path and login state
+
+    Entries are dicts with the body, its mimetype, its ETag and when it was
+    rendered. Subclasses implement the actual storage backend.
+    """
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, entry):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class LocalPageCache(PageCache):
+    """Per-worker cache that drops the least recently used page when full"""
+
+    def __init__(self, max_entries=128, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry['rendered_at'] >= self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TieredPageCache(PageCache):
+    """A per-worker cache in front of a Redis cache shared by all workers
+
+    A page rendered by one worker is served by the others without rendering
+    it again. Needs the optional redis package.
+    """
+
+    def __init__(self, redis_url, max_entries=128, ttl=300):
+        import redis
+
+        self.local = LocalPageCache(max_entries, ttl)
+        self.shared = redis.Redis.from_url(redis_url, socket_timeout=0.5)
+        self.ttl = ttl
+
+    def get(self, key):
+        entry = self.local.get(key)
+        if entry is not None:
+            return entry
+        try:
+            data = self.shared.get(SHARED_KEY_PREFIX + key)
+        except Exception as e:
+            current_app.logger.warning(f"Shared page cache unavailable: {e}")
+            return None
+        if data is None:
+            return None
+        entry = json.loads(data)
+        self.local.set(key, entry)
+        return entry
+
+    def set(self, key, entry):
+        self.local.set(key, entry)
+        try:
+            self.shared.set(SHARED_KEY_PREFIX + key, json.dumps(entry), ex=self.ttl)
+        except Exception as e:
+            current_app.logger.warning(f"Shared page cache unavailable: {e}")
+
+    def clear(self):
+        self.local.clear()
+        for key in self.shared.scan_iter(f"{SHARED_KEY_PREFIX}*"):
+            self.shared.delete(key)
+
+
+def init_page_cache(app, cache=None):
+    """Attach a page cache to the app: shared through PAGE_CACHE_REDIS_URL when set, else per worker"""
+    if cache is None:
+        max_entries = app.config.get('PAGE_CACHE_SIZE', 128)
+        ttl = app.config.get('PAGE_CACHE_TTL', 300)
+        if app.config.get('PAGE_CACHE_REDIS_URL'):
+            cache = TieredPageCache(app.config['PAGE_CACHE_REDIS_URL'], max_entries, ttl)
+        else:
+            cache = LocalPageCache(max_entries, ttl)
+    app.extensions['page_cache'] = cache
+    return cache
+
+
+def get_page_cache():
+    """Get the page cache for the current app"""
+    return current_app.extensions['page_cache']
+
+
+def clear_page_cache():
+    """Forget every cached page, e.g. after changing a template at runtime"""
+    get_page_cache().clear()
+
+
+def cached_page(view):
+    """Serve a public page from the page cache, answering If-None-Match with a 304
+
+    The page can only vary by whether someone is logged in, which is read
+    from the session without loading the user. Query strings (such as the
+    tracking parameters on shared links) are ignored. Requests with flashed
+    messages waiting are rendered normally, as those are shown once.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or session.get('_flashes') or current_app.debug:
+            return view(*args, **kwargs)
+
+        bucket = 'user' if session.get('_user_id') else 'anonymous'
+        key = f"{request.path}:{bucket}"
+        cache = get_page_cache()
+        entry = cache.get(key)
+        if entry is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200 or response.direct_passthrough:
+                return response
+            body = response.get_data(as_text=True)
+            entry = {
+                'body': body,
+                'mimetype': response.mimetype,
+                'etag': hashlib.sha256(body.encode('utf-8')).hexdigest()[:32],
+                'rendered_at': time.time(),
+            }
+            cache.set(key, entry)
+
+        response = current_app.response_class(entry['body'], mimetype=entry['mimetype'])
+        response.set_etag(entry['etag'])
+        # The page differs for logged-in users, so shared caches must not keep it
+        response.cache_control.private = True
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+        return response.make_conditional(request)
+    return wrapper
@@ -0,0 +1,79 @@
+import os
+import hashlib
+from flask import abort, current_app, request, send_file
+
+JOURNAL_PDF_NAME = 'recovery-journal-full.pdf'
+
+# Front-end server offload modes: nginx's X-Accel-Redirect, or X-Sendfile (Apache, lighttpd)
+OFFLOAD_MODES = ('x-accel-redirect', 'x-sendfile')
+
+# sha256 of the PDF by path, with the (mtime, size) it was computed for
+_etag_cache = {}
+
+
+def get_file_etag(path):
+    """Strong ETag for a file, re-hashing it only when its mtime or size changes"""
+    stat = os.stat(path)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+    cached = _etag_cache.get(path)
+    if cached is None or cached[0] != stamp:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        cached = (stamp, digest.hexdigest())
+        _etag_cache[path] = cached
+    return cached[1]
+
+
+def journal_pdf_version():
+    """Short content version of the journal PDF for cache-busting URLs, or None if it's missing"""
+    try:
+        return get_file_etag(current_app.config['JOURNAL_PDF_PATH'])[:16]
+    except FileNotFoundError:
+        return None
+
+
+def send_journal_pdf(as_attachment=False):
+    """Respond with the journal PDF, honouring Range and If-None-Match
+
+    Requests for the current version (``?v=``) may be cached by the browser
+    for a year; others must revalidate. With PDF_OFFLOAD set, the body is left
+    to the front-end server, which also answers Range requests.
+    """
+    path = current_app.config['JOURNAL_PDF_PATH']
+    try:
+        etag = get_file_etag(path)
+    except FileNotFoundError:
+        abort(404)
+
+    offload = current_app.config.get('PDF_OFFLOAD')
+    if offload == 'x-accel-redirect':
+        response = current_app.response_class(mimetype='application/pdf')
+        response.headers['X-Accel-Redirect'] = current_app.config['PDF_ACCEL_REDIRECT_PATH']
+    elif offload == 'x-sendfile':
+        response = current_app.response_class(mimetype='application/pdf')
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        # Werkzeug streams the file through wsgi.file_wrapper (sendfile under gunicorn)
+        response = send_file(path, mimetype='application/pdf', etag=False, conditional=False)
+
+    if as_attachment:
+        response.headers['Content-Disposition'] = f'attachment; filename="{JOURNAL_PDF_NAME}"'
+    response.set_etag(etag)
+    response.last_modified = os.path.getmtime(path)
+    response.cache_control.private = True
+    response.cache_control.no_cache = None
+    if request.args.get('v') == etag[:16]:
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+
+    response = response.make_conditional(request, accept_ranges=not offload, complete_length=os.path.getsize(path))
+    if response.status_code == 304:
+        # Some front-end servers would send the file anyway
+        response.headers.pop('X-Accel-Redirect', None)
+        response.headers.pop('X-Sendfile', None)
+    return response
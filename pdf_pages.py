@@ -0,0 +1,146 @@
+import os
+import io
+import json
+import hashlib
+import tempfile
+from flask import current_app, url_for
+
+# Default render widths in pixels, and the one used when the browser can't choose
+PAGE_WIDTHS = (480, 800, 1200)
+DEFAULT_WIDTH = 800
+
+# Formats in order of preference; the last one is the <img> fallback
+PAGE_FORMATS = ('webp', 'png')
+
+MANIFEST_NAME = 'manifest.json'
+
+# Per-worker copy of the manifest, with the mtime it was read at
+_manifest_cache = {'path': None, 'mtime': None, 'manifest': None}
+
+
+def _write_atomic(path, data):
+    """Write a file so readers never see it half-written"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def render_pdf_pages(pdf_path, output_dir, widths=PAGE_WIDTHS, formats=PAGE_FORMATS, quality=80):
+    """Render every page of a PDF at each width and format, then write the manifest
+
+    Files are named after a hash of their content, so they can be cached
+    forever. Needs the optional pypdfium2 and Pillow packages.
+    """
+    import pypdfium2
+
+    os.makedirs(output_dir, exist_ok=True)
+    with open(pdf_path, 'rb') as f:
+        source_sha256 = hashlib.sha256(f.read()).hexdigest()
+
+    pdf = pypdfium2.PdfDocument(pdf_path)
+    pages = {}
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            page_width, _ = page.get_size()
+            renders = {}
+            for width in widths:
+                image = page.render(scale=width / page_width).to_pil()
+                variants = {}
+                for image_format in formats:
+                    buffer = io.BytesIO()
+                    if image_format == 'webp':
+                        image.save(buffer, 'WEBP', quality=quality, method=6)
+                    else:
+                        image.save(buffer, image_format.upper(), optimize=True)
+                    data = buffer.getvalue()
+                    name = f"page-{index + 1:03d}-{width}-{hashlib.sha256(data).hexdigest()[:12]}.{image_format}"
+                    _write_atomic(os.path.join(output_dir, name), data)
+                    variants[image_format] = name
+                renders[str(width)] = {'width': image.width, 'height': image.height, 'files': variants}
+            pages[str(index + 1)] = renders
+            page.close()
+        page_count = len(pdf)
+    finally:
+        pdf.close()
+
+    manifest = {
+        'source_sha256': source_sha256,
+        'page_count': page_count,
+        'widths': list(widths),
+        'formats': list(formats),
+        'pages': pages,
+    }
+    _write_atomic(os.path.join(output_dir, MANIFEST_NAME), json.dumps(manifest, indent=1).encode())
+    return manifest
+
+
+def load_page_manifest():
+    """Get the page render manifest, re-reading it only when it changes, or None if there isn't one"""
+    path = os.path.join(current_app.config['JOURNAL_PAGES_PATH'], MANIFEST_NAME)
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    if _manifest_cache['path'] != path or _manifest_cache['mtime'] != mtime:
+        with open(path) as f:
+            manifest = json.load(f)
+        manifest['file_names'] = {
+            name
+            for renders in manifest['pages'].values()
+            for render in renders.values()
+            for name in render['files'].values()
+        }
+        _manifest_cache.update(path=path, mtime=mtime, manifest=manifest)
+    return _manifest_cache['manifest']
+
+
+def is_page_image(name):
+    """Check that a file name is one of the rendered page images"""
+    manifest = load_page_manifest()
+    return manifest is not None and name in manifest['file_names']
+
+
+def page_image(page_number):
+    """Template data for showing one rendered page, or None to fall back to the PDF
+
+    Returns the srcset for each format, the fallback image URL and its size.
+    """
+    manifest = load_page_manifest()
+    renders = manifest and manifest['pages'].get(str(page_number))
+    if not renders:
+        return None
+
+    widths = sorted(renders, key=int)
+    default = renders.get(str(DEFAULT_WIDTH)) or renders[widths[-1]]
+    formats = manifest['formats']
+    return {
+        'srcsets': {
+            image_format: ', '.join(
+                f"{url_for('journal_page_image', name=renders[width]['files'][image_format])} {width}w"
+                for width in widths
+            )
+            for image_format in formats
+        },
+        'src': url_for('journal_page_image', name=default['files'][formats[-1]]),
+        'width': default['width'],
+        'height': default['height'],
+    }
+
+
+def page_prefetch_url(page_number):
+    """URL of the image a browser is most likely to show for a page, for prefetching"""
+    manifest = load_page_manifest()
+    renders = manifest and manifest['pages'].get(str(page_number))
+    if not renders:
+        return None
+    render = renders.get(str(DEFAULT_WIDTH)) or renders[max(renders, key=int)]
+    return url_for('journal_page_image', name=render['files'][manifest['formats'][0]])
@@ -1,26 +1,51 @@
-from flask import render_template, request, flash, redirect, url_for, session, send_from_directory
+from flask import render_template, request, flash, redirect, url_for, session, send_file, abort, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from app import app, db
-from forms import ContactForm, EmailSubscriptionForm, RegistrationForm, LoginForm
-from models import EmailSubscriber, ContactMessage, User, JournalEntry, SiteSettings, PDFAnnotation
-from email_service import send_welcome_email
-from stripe_service import create_checkout_session, create_customer_portal_session, get_subscription_status
-import stripe
+from forms import ContactForm, EmailSubscriptionForm, RegistrationForm, LoginForm, BroadcastForm, ResumeBroadcastForm, RefreshAnalyticsForm
+from models import EmailSubscriber, ContactMessage, User, JournalEntry, PDFAnnotation, DrawingStrokeBatch, Broadcast, upsert_statement
+from email_outbox import enqueue_email, get_email_status
+from broadcasts import claim_broadcast, create_broadcast, start_broadcast_thread
+from stripe_service import create_checkout_session, create_customer_portal_session, is_stripe_available
+from stripe_events import process_stripe_events, record_stripe_event
+from drawing_store import DrawingStoreError, get_drawing_store, is_drawing_key, render_stroke_png, store_drawing, stroke_png_key
+from settings_cache import get_site_settings, save_site_settings
+from entitlements import current_user_id, subscription_required
+from page_cache import cached_page
+from analytics import FUNNEL_DAYS, cohort_funnels, day_summaries, refresh_rollups, rollups_updated_at
+from exports import iter_export_csv, iter_export_ndjson, iter_export_zip
+from pdf_delivery import journal_pdf_version, send_journal_pdf
+from pdf_pages import is_page_image, page_image, page_prefetch_url
+from strokes import StrokeError, decode_strokes, encode_strokes, parse_strokes
+from sqlalchemy import case, exists, func, select, update
+from sqlalchemy.orm import undefer, undefer_group
 import logging
 import os
+import json
 from datetime import datetime
 
+# Canvases that accept strokes: the JSON field holding their number, its maximum and the owning model
+STROKE_CANVASES = {
+    'journal': ('day_number', 30, JournalEntry),
+    'pdf': ('page_number', 79, PDFAnnotation),
+}
+
+# Size of the journal and PDF drawing canvases, used when exporting strokes to PNG
+DRAWING_CANVAS_SIZE = (760, 400)
+
 @app.route('/')
+@cached_page
 def index():
     """Main homepage with hero section and overview"""
     return render_template('index.html')
 
 @app.route('/products')
+@cached_page
 def products():
     """Product showcase page for digital and POD items"""
     return render_template('products.html')
 
 @app.route('/faq')
+@cached_page
 def faq():
     """FAQ page with common questions"""
     return render_template('faq.html')
@@ -42,7 +67,7 @@ def contact():
         try:
             db.session.add(contact_msg)
             db.session.commit()
-            logging.info(f"Contact form submitted: {form.name.data} ({form.email.data}) - {form.subject.data}")
+            logging.info("Contact form submitted: %s (%s) - %s", form.name.data, form.email.data, form.subject.data)
             flash(f"Thank you {form.name.data}! Your message has been received. We'll get back to you soon.", 'success')
         except Exception as e:
             db.session.rollback()
@@ -66,18 +91,14 @@ def join_community():
             if existing_subscriber.is_active:
                 flash("You're already part of our community! Thanks for your continued support.", 'info')
             else:
-                # Reactivate the subscription
+                # Reactivate the subscription and queue a welcome email for returning subscriber
                 existing_subscriber.is_active = True
                 existing_subscriber.name = form.name.data if form.name.data else existing_subscriber.name
+                welcome_email = enqueue_email('welcome', form.email.data, name=form.name.data)
                 db.session.commit()
+                session['welcome_email_id'] = welcome_email.id
                 
-                # Send welcome email for returning subscriber
-                email_sent = send_welcome_email(form.email.data, form.name.data)
-                
-                if email_sent:
-                    flash("Welcome back! Your subscription has been reactivated and fresh recovery resources are on their way to your inbox!", 'success')
-                else:
-                    flash("Welcome back! Your subscription has been reactivated.", 'success')
+                flash("Welcome back! Your subscription has been reactivated and fresh recovery resources are on their way to your inbox!", 'success')
         else:
             # Create new subscriber
             subscriber = EmailSubscriber(
@@ -88,17 +109,14 @@ def join_community():
             
             try:
                 db.session.add(subscriber)
+                # Queue welcome email with resources; it commits with the subscriber
+                welcome_email = enqueue_email('welcome', form.email.data, name=form.name.data)
                 db.session.commit()
-                logging.info(f"New email subscriber: {form.email.data}")
+                session['welcome_email_id'] = welcome_email.id
+                logging.info("New email subscriber: %s", form.email.data)
                 
-                # Send welcome email with resources
-                email_sent = send_welcome_email(form.email.data, form.name.data)
+                flash(f"Welcome to the Eyes of an Addict community! Check your email at {form.email.data} for your free recovery resources!", 'success')
                 
-                if email_sent:
-                    flash(f"Welcome to the Eyes of an Addict community! Check your email at {form.email.data} for your free recovery resources!", 'success')
-                else:
-                    flash(f"You've joined our community! We're working on getting your welcome email to you - please check back if you don't receive it soon.", 'success')
-                    
             except Exception as e:
                 db.session.rollback()
                 logging.error(f"Error saving email subscriber: {e}")
@@ -108,6 +126,15 @@ def join_community():
     
     return render_template('join.html', form=form)
 
+@app.route('/join/email-status')
+def welcome_email_status():
+    """Report whether the welcome email queued from this browser has been sent"""
+    message_id = session.get('welcome_email_id')
+    status = get_email_status(message_id) if message_id else None
+    if status is None:
+        return {'status': 'unknown'}, 404
+    return {'status': status}
+
 @app.errorhandler(404)
 def page_not_found(e):
     """Handle 404 errors"""
@@ -116,6 +143,10 @@ def page_not_found(e):
 @app.route('/register', methods=['GET', 'POST'])
 def register():
     """User registration for journal subscription"""
+    # Signed-up users who haven't paid yet go straight back to checkout
+    if current_user.is_authenticated and not current_user.has_active_subscription():
+        return redirect(url_for('subscription_checkout'))
+    
     form = RegistrationForm()
     
     if form.validate_on_submit():
@@ -125,6 +156,11 @@ def register():
             flash('An account with this email already exists. Please log in instead.', 'error')
             return redirect(url_for('login'))
         
+        # Don't create an account we can't take payment for right now
+        if not is_stripe_available():
+            flash('Our payment provider is temporarily unavailable. Please try again in a few minutes.', 'error')
+            return render_template('register.html', form=form)
+        
         # Create new user
         user = User(
             email=form.email.data,
@@ -139,13 +175,7 @@ def register():
             # Log in the user
             login_user(user)
             
-            # Create Stripe checkout session
-            checkout_url = create_checkout_session(user.email, user.name)
-            if checkout_url:
-                return redirect(checkout_url)
-            else:
-                flash('Error creating checkout session. Please try again.', 'error')
-                return redirect(url_for('register'))
+            return redirect(url_for('subscription_checkout'))
                 
         except Exception as e:
             db.session.rollback()
@@ -179,71 +209,76 @@ def login():
 def logout():
     """User logout"""
     logout_user()
+    session.pop('entitlement', None)
     flash('You have been logged out successfully.', 'success')
     return redirect(url_for('index'))
 
 @app.route('/dashboard')
-@login_required
+@subscription_required
 def dashboard():
     """User dashboard for recovery journal access"""
-    # Check subscription status
-    if not current_user.has_active_subscription():
-        flash('Your subscription is not active. Please subscribe to access your recovery journal.', 'error')
-        return redirect(url_for('subscription_info'))
+    # Get user's progress for days 1-30 (days not started yet have no entry)
+    entries = JournalEntry.progress_grid(current_user.id)
     
-    # Get user's basic progress tracking entries
-    entries = JournalEntry.query.filter_by(user_id=current_user.id).order_by(JournalEntry.day_number).all()
-    
-    # Create missing entries for days 1-30 for progress tracking
-    existing_days = {entry.day_number for entry in entries}
-    for day in range(1, 31):
-        if day not in existing_days:
-            new_entry = JournalEntry(user_id=current_user.id, day_number=day)
-            db.session.add(new_entry)
+    # Get current layout settings for dynamic styling
+    settings = get_site_settings()
     
-    try:
+    return render_template('dashboard.html', entries=entries, current_user=current_user, settings=settings)
+
+@app.route('/subscription/checkout')
+@login_required
+def subscription_checkout():
+    """Send the logged-in user to Stripe checkout to start their subscription"""
+    checkout_url = create_checkout_session(current_user.email, current_user.name)
+    if checkout_url:
         db.session.commit()
-        entries = JournalEntry.query.filter_by(user_id=current_user.id).order_by(JournalEntry.day_number).all()
-    except Exception as e:
-        db.session.rollback()
-        logging.error(f"Error creating journal entries: {e}")
+        return redirect(checkout_url)
     
-    # Get current layout settings for dynamic styling
-    settings = {}
-    for setting in SiteSettings.query.all():
-        settings[setting.setting_name] = setting.setting_value
+    db.session.rollback()
     
-    return render_template('dashboard.html', entries=entries, current_user=current_user, settings=settings)
+    flash("Your account is ready, but we couldn't reach our payment provider. "
+          "Please come back to the sign-up page in a few minutes to finish subscribing.", 'error')
+    return redirect(url_for('index'))
 
 @app.route('/subscription/success')
 def subscription_success():
-    """Handle successful Stripe subscription"""
-    session_id = request.args.get('session_id')
-    
-    if session_id:
-        try:
-            # Retrieve the session from Stripe
-            stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
-            session = stripe.checkout.Session.retrieve(session_id)
-            
-            if session.payment_status == 'paid':
-                # Update user subscription status
-                user_email = session.metadata.get('user_email')
-                user = User.query.filter_by(email=user_email).first()
-                
-                if user:
-                    user.stripe_customer_id = session.customer
-                    user.subscription_status = 'active'
-                    db.session.commit()
-                    
-                    flash('Welcome to your Recovery Journal! Your subscription is now active.', 'success')
-                    return redirect(url_for('dashboard'))
-        except Exception as e:
-            logging.error(f"Error processing subscription success: {e}")
+    """Handle the redirect back from a successful Stripe checkout"""
+    # Stripe confirms the subscription through the webhook, which applies it as it
+    # arrives; this only reads the status it left
+    if current_user.is_authenticated and current_user.has_active_subscription():
+        flash('Welcome to your Recovery Journal! Your subscription is now active.', 'success')
+        return redirect(url_for('dashboard'))
     
-    flash('There was an issue processing your subscription. Please contact support.', 'error')
+    flash("Thank you! We're confirming your payment with Stripe. Your journal will unlock within a minute - please log in again shortly.", 'info')
     return redirect(url_for('index'))
 
+@app.route('/stripe/webhook', methods=['POST'])
+def stripe_webhook():
+    """Receive Stripe events, check their signature and apply subscription changes"""
+    webhook_secret = os.environ.get('STRIPE_WEBHOOK_SECRET')
+    if not webhook_secret:
+        logging.error("STRIPE_WEBHOOK_SECRET environment variable not set")
+        return {'error': 'Webhook not configured'}, 500
+    
+    import stripe
+
+    payload = request.get_data()
+    try:
+        stripe.Webhook.construct_event(payload, request.headers.get('Stripe-Signature', ''), webhook_secret)
+    except (ValueError, stripe.SignatureVerificationError) as e:
+        logging.warning(f"Rejected Stripe webhook: {e}")
+        return {'error': 'Invalid payload or signature'}, 400
+    
+    event = json.loads(payload)
+    if record_stripe_event(event):
+        db.session.commit()
+        # Failures are left on the event log for `flask process-stripe-events` to retry
+        process_stripe_events([event['id']])
+    else:
+        logging.info("Ignoring redelivered Stripe event %s", event['id'])
+    
+    return {'received': True}
+
 @app.route('/subscription/cancel')
 def subscription_cancel():
     """Handle cancelled Stripe subscription"""
@@ -255,6 +290,10 @@ def subscription_cancel():
 def manage_subscription():
     """Redirect to Stripe customer portal"""
     if current_user.stripe_customer_id:
+        if not is_stripe_available():
+            flash('Subscription management is temporarily unavailable. Your journal access is not affected - please try again in a few minutes.', 'info')
+            return redirect(url_for('dashboard'))
+        
         portal_url = create_customer_portal_session(current_user.stripe_customer_id)
         if portal_url:
             return redirect(portal_url)
@@ -263,33 +302,30 @@ def manage_subscription():
     return redirect(url_for('dashboard'))
 
 @app.route('/subscription/info')
+@cached_page
 def subscription_info():
     """Information about journal subscription"""
     return render_template('subscription_info.html')
 
 @app.route('/recovery-journal')
-@login_required
+@subscription_required
 def recovery_journal():
     """Interactive recovery journal interface"""
-    # Check subscription status
-    if not current_user.has_active_subscription():
-        flash('Your subscription is not active. Please subscribe to access the recovery journal.', 'error')
-        return redirect(url_for('subscription_info'))
-    
     # Get the current day or default to day 1
     current_day = request.args.get('day', current_user.current_day, type=int)
     if current_day < 1 or current_day > 30:
         current_day = 1
     
-    # Get or create journal entry for this day
-    entry = JournalEntry.query.filter_by(user_id=current_user.id, day_number=current_day).first()
+    # Get journal entry for this day
+    entry = JournalEntry.query.options(undefer_group('content'), undefer(JournalEntry.drawing_data)).filter_by(
+        user_id=current_user.id, day_number=current_day
+    ).first()
     if not entry:
+        # Show an empty page; the entry is created on its first save
         entry = JournalEntry(user_id=current_user.id, day_number=current_day)
-        db.session.add(entry)
-        db.session.commit()
     
     # Get all entries for progress overview
-    all_entries = JournalEntry.query.filter_by(user_id=current_user.id).order_by(JournalEntry.day_number).all()
+    all_entries = JournalEntry.progress_grid(current_user.id)
     
     return render_template('interactive_journal.html', 
                          entry=entry, 
@@ -298,134 +334,345 @@ def recovery_journal():
                          current_user=current_user)
 
 @app.route('/save-journal-entry', methods=['POST'])
-@login_required
+@subscription_required(api=True)
 def save_journal_entry():
     """Save journal entry via AJAX"""
-    if not current_user.has_active_subscription():
-        return {'success': False, 'error': 'Subscription required'}, 403
-    
     day_number = request.form.get('day_number', type=int)
     if not day_number or day_number < 1 or day_number > 30:
         return {'success': False, 'error': 'Invalid day number'}, 400
     
-    # Get or create entry
-    entry = JournalEntry.query.filter_by(user_id=current_user.id, day_number=day_number).first()
-    if not entry:
-        entry = JournalEntry(user_id=current_user.id, day_number=day_number)
-        db.session.add(entry)
-    
     # Update entry fields
-    entry.daily_reflection = request.form.get('daily_reflection', '').strip()
-    entry.gratitude_items = request.form.get('gratitude_items', '').strip()
-    entry.challenges_faced = request.form.get('challenges_faced', '').strip()
-    entry.wins_celebrations = request.form.get('wins_celebrations', '').strip()
-    entry.goals_tomorrow = request.form.get('goals_tomorrow', '').strip()
-    entry.trigger_notes = request.form.get('trigger_notes', '').strip()
-    entry.coping_strategies = request.form.get('coping_strategies', '').strip()
-    entry.support_connections = request.form.get('support_connections', '').strip()
-    entry.drawing_data = request.form.get('drawing_data', '').strip()
+    values = {field: request.form.get(field, '').strip() for field in JournalEntry.TEXT_FIELDS}
+    # Canvases now save strokes separately, so only older clients send a PNG snapshot
+    if 'drawing_data' in request.form:
+        try:
+            values['drawing_ref'] = store_drawing(request.form['drawing_data'].strip())
+            values['drawing_data'] = None  # Replaces any legacy drawing not moved yet
+        except DrawingStoreError as e:
+            return {'success': False, 'error': str(e)}, 400
     
     # Update ratings
-    entry.mood_rating = request.form.get('mood_rating', type=int)
-    entry.energy_level = request.form.get('energy_level', type=int)
-    entry.sleep_quality = request.form.get('sleep_quality', type=int)
+    for field in JournalEntry.RATING_FIELDS:
+        values[field] = request.form.get(field, type=int)
     
-    # Mark as completed if significant content is present
-    completion_percentage = entry.get_completion_percentage()
-    entry.completed = completion_percentage >= 50  # Consider 50%+ as completed
-    entry.updated_date = datetime.utcnow()
+    try:
+        result = save_journal_changes(day_number, values)
+        return {'success': True, 'message': 'Entry saved successfully!', **result}
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error saving journal entry: {e}")
+        return {'success': False, 'error': 'Failed to save entry'}, 500
+
+@app.route('/save-journal-entry/delta', methods=['POST'])
+@subscription_required(api=True)
+def save_journal_entry_delta():
+    """Save only the changed fields of a journal entry via AJAX (JSON autosave)"""
+    payload = request.get_json(silent=True) or {}
+    day_number = payload.get('day_number')
+    version = payload.get('version')
+    changes = payload.get('changes')
+    
+    if not isinstance(day_number, int) or day_number < 1 or day_number > 30:
+        return {'success': False, 'error': 'Invalid day number'}, 400
+    if not isinstance(version, int) or version < 0:
+        return {'success': False, 'error': 'Invalid version'}, 400
+    if not isinstance(changes, dict):
+        return {'success': False, 'error': 'Invalid changes'}, 400
+    
+    # Validate and normalise only the fields that were sent
+    values = {}
+    for field, value in changes.items():
+        if field in JournalEntry.TEXT_FIELDS:
+            if value is not None and not isinstance(value, str):
+                return {'success': False, 'error': f'Invalid value for {field}'}, 400
+            values[field] = (value or '').strip()
+        elif field in JournalEntry.RATING_FIELDS:
+            if value is not None and (not isinstance(value, int) or value < 1 or value > 10):
+                return {'success': False, 'error': f'Invalid value for {field}'}, 400
+            values[field] = value
+        elif field == 'drawing_data':
+            if value is not None and not isinstance(value, str):
+                return {'success': False, 'error': 'Invalid value for drawing_data'}, 400
+            try:
+                values['drawing_ref'] = store_drawing((value or '').strip())
+                values['drawing_data'] = None
+            except DrawingStoreError as e:
+                return {'success': False, 'error': str(e)}, 400
+        else:
+            return {'success': False, 'error': f'Unknown field {field}'}, 400
+    
+    if not values:
+        return {'success': True, 'version': version, 'message': 'Nothing to save'}
     
     try:
-        db.session.commit()
-        
-        # Update user progress
-        if entry.completed and current_user.current_day == day_number:
-            current_user.current_day = min(day_number + 1, 30)
-            current_user.days_completed = JournalEntry.query.filter_by(
-                user_id=current_user.id, completed=True
-            ).count()
-            current_user.last_activity = datetime.utcnow()
-            db.session.commit()
-        
+        result = save_journal_changes(day_number, values, version)
+        return {'success': True, 'message': 'Entry saved successfully!', **result}
+    except StaleJournalEntry as e:
+        db.session.rollback()
         return {
-            'success': True, 
-            'completion_percentage': completion_percentage,
-            'is_completed': entry.completed,
-            'message': 'Entry saved successfully!'
-        }
+            'success': False,
+            'error': 'This entry was changed somewhere else. Please reload the page.',
+            'version': e.version
+        }, 409
     except Exception as e:
         db.session.rollback()
         logging.error(f"Error saving journal entry: {e}")
         return {'success': False, 'error': 'Failed to save entry'}, 500
 
+class StaleJournalEntry(Exception):
+    """Raised when a save was based on an older version of the entry"""
+    def __init__(self, version):
+        super().__init__(f"Journal entry is at version {version}")
+        self.version = version
+
+def save_journal_changes(day_number, values, version=None):
+    """Apply changed journal fields for the current user and commit
+
+    The entry is created on its first save. When a version is given, the
+    changes only apply on top of that version and StaleJournalEntry is raised
+    otherwise. Returns the entry's new version and completion state.
+    """
+    completion = JournalEntry.completion_percentage_sql(values)
+    
+    def lock_entry():
+        return db.session.execute(
+            select(JournalEntry.version, JournalEntry.completed)
+            .filter_by(user_id=current_user_id(), day_number=day_number)
+            .with_for_update()
+        ).first()
+    
+    # Lock the entry's small state columns, then apply one targeted UPDATE
+    current = lock_entry()
+    
+    if current is None:
+        # Score the new entry in Python, then insert it unless another request just did
+        new_entry = JournalEntry(**values)
+        completion_percentage = new_entry.update_completion()
+        created = db.session.execute(
+            upsert_statement(JournalEntry)
+            .values(
+                user_id=current_user_id(),
+                day_number=day_number,
+                completion_percentage=completion_percentage,
+                completed=new_entry.completed,
+                **values
+            )
+            .on_conflict_do_nothing(index_elements=['user_id', 'day_number'])
+            .returning(JournalEntry.version)
+        ).first()
+        
+        if created is not None:
+            update_user_progress(day_number, False, new_entry.completed)
+            db.session.commit()
+            return {
+                'version': created.version,
+                'completion_percentage': completion_percentage,
+                'is_completed': new_entry.completed
+            }
+        current = lock_entry()
+    
+    if version is not None and current.version != version:
+        raise StaleJournalEntry(current.version)
+    
+    new_version, is_completed, completion_percentage = db.session.execute(
+        update(JournalEntry)
+        .where(
+            JournalEntry.user_id == current_user_id(),
+            JournalEntry.day_number == day_number,
+            JournalEntry.version == current.version
+        )
+        .values(
+            completion_percentage=completion,
+            completed=completion >= 50,
+            updated_date=datetime.utcnow(),
+            version=JournalEntry.version + 1,
+            **values
+        )
+        .returning(JournalEntry.version, JournalEntry.completed, JournalEntry.completion_percentage)
+        .execution_options(synchronize_session=False)
+    ).one()
+    
+    # Update user progress in the same transaction
+    update_user_progress(day_number, bool(current.completed), is_completed)
+    db.session.commit()
+    
+    return {
+        'version': new_version,
+        'completion_percentage': completion_percentage,
+        'is_completed': is_completed
+    }
+
+@app.route('/save-journal-entry/strokes', methods=['POST'])
+@subscription_required(api=True)
+def save_journal_strokes():
+    """Append new drawing strokes to a journal entry via AJAX"""
+    return append_strokes('journal')
+
+def append_strokes(canvas):
+    """Append the strokes in the JSON request to one of the current user's canvases"""
+    number_field, max_number, model = STROKE_CANVASES[canvas]
+    payload = request.get_json(silent=True) or {}
+    
+    number = payload.get(number_field)
+    if not isinstance(number, int) or number < 1 or number > max_number:
+        return {'success': False, 'error': f"Invalid {number_field.replace('_', ' ')}"}, 400
+    
+    try:
+        strokes = parse_strokes(payload.get('strokes', []))
+    except StrokeError as e:
+        return {'success': False, 'error': str(e)}, 400
+    
+    clear = payload.get('clear') is True
+    if not strokes and not clear:
+        return {'success': True, 'message': 'Nothing to save'}
+    
+    try:
+        if clear:
+            # Drop earlier strokes and any PNG snapshot saved before strokes existed
+            DrawingStrokeBatch.query.filter_by(
+                user_id=current_user_id(), canvas=canvas, number=number
+            ).delete(synchronize_session=False)
+            db.session.execute(
+                update(model)
+                .where(model.user_id == current_user_id(), getattr(model, number_field) == number)
+                .values(drawing_ref=None, drawing_data=None)
+                .execution_options(synchronize_session=False)
+            )
+        
+        if strokes:
+            db.session.add(DrawingStrokeBatch(
+                user_id=current_user_id(),
+                canvas=canvas,
+                number=number,
+                data=encode_strokes(strokes)
+            ))
+        
+        db.session.commit()
+        return {'success': True, 'message': 'Drawing saved successfully!'}
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error saving drawing strokes: {e}")
+        return {'success': False, 'error': 'Failed to save drawing'}, 500
+
+def load_stroke_data(canvas, number):
+    """Get all packed strokes for one of the current user's canvases, oldest first"""
+    return b''.join(db.session.execute(
+        select(DrawingStrokeBatch.data)
+        .filter_by(user_id=current_user.id, canvas=canvas, number=number)
+        .order_by(DrawingStrokeBatch.id)
+    ).scalars())
+
+def update_user_progress(day_number, was_completed, is_completed):
+    """Apply a journal entry's completion change to the current user's progress counters
+
+    Runs inside the caller's transaction so the counters commit together with the entry.
+    """
+    values = {}
+    if was_completed != is_completed:
+        values['days_completed'] = User.days_completed + (1 if is_completed else -1)
+    if is_completed:
+        # Only advance users who are on this day, without loading the user to check
+        on_this_day = User.current_day == day_number
+        values['current_day'] = case((on_this_day, min(day_number + 1, 30)), else_=User.current_day)
+        values['last_activity'] = case((on_this_day, datetime.utcnow()), else_=User.last_activity)
+    
+    if values:
+        db.session.execute(
+            update(User)
+            .where(User.id == current_user_id())
+            .values(**values)
+            .execution_options(synchronize_session=False)
+        )
+
 @app.route('/journal-pdf')
-@login_required 
+@subscription_required
 def journal_pdf():
     """Interactive PDF journal viewer with drawing and navigation"""
-    # Check subscription status
-    if not current_user.has_active_subscription():
-        flash('Your subscription is not active. Please subscribe to access the recovery journal.', 'error')
-        return redirect(url_for('subscription_info'))
-    
     # Get current page from URL parameter
     current_page = request.args.get('page', 1, type=int)
     if current_page < 1 or current_page > 79:
         current_page = 1
     
-    # Get or create PDF annotation entry for this page
-    pdf_entry = PDFAnnotation.query.filter_by(
+    # Get PDF annotation entry for this page
+    pdf_entry = PDFAnnotation.query.options(undefer(PDFAnnotation.drawing_data)).filter_by(
         user_id=current_user.id, 
         page_number=current_page
     ).first()
     if not pdf_entry:
+        # Show an empty page; the annotation is created on its first save
         pdf_entry = PDFAnnotation(user_id=current_user.id, page_number=current_page)
-        db.session.add(pdf_entry)
-        db.session.commit()
+    
+    # Show the pre-rendered page image when there is one, and let the browser fetch its neighbours early
+    current_page_image = page_image(current_page)
+    prefetch_urls = [
+        url for url in (page_prefetch_url(page) for page in (current_page - 1, current_page + 1)) if url
+    ]
     
     return render_template('pdf_journal.html', 
                          current_page=current_page, 
                          total_pages=79,
                          pdf_entry=pdf_entry,
+                         page_image=current_page_image,
+                         prefetch_urls=prefetch_urls,
+                         pdf_version=None if current_page_image else journal_pdf_version(),
                          current_user=current_user)
 
+@app.route('/journal-pdf/pages/<name>')
+@subscription_required
+def journal_page_image(name):
+    """A pre-rendered journal page image (file names change whenever the content does)"""
+    if not is_page_image(name):
+        abort(404)
+    
+    response = send_file(os.path.join(app.config['JOURNAL_PAGES_PATH'], name), conditional=True, etag=False)
+    response.set_etag(name)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/journal-pdf/file')
+@subscription_required
+def journal_pdf_file():
+    """The 79-page PDF journal for the viewer, cacheable and range-capable"""
+    return send_journal_pdf()
+
 @app.route('/journal-pdf-download')
-@login_required 
+@subscription_required
 def journal_pdf_download():
     """Download the full 79-page PDF journal guide"""
-    # Check subscription status
-    if not current_user.has_active_subscription():
-        flash('Your subscription is not active. Please subscribe to access the recovery journal.', 'error')
-        return redirect(url_for('subscription_info'))
-    
     # Serve the professional 79-page recovery journal as download
-    return send_from_directory('static/downloads', 'recovery-journal-full.pdf', as_attachment=True)
+    return send_journal_pdf(as_attachment=True)
 
 @app.route('/save-pdf-annotation', methods=['POST'])
-@login_required
+@subscription_required(api=True)
 def save_pdf_annotation():
     """Save PDF page annotation via AJAX"""
-    if not current_user.has_active_subscription():
-        return {'success': False, 'error': 'Subscription required'}, 403
-    
     page_number = request.form.get('page_number', type=int)
     if not page_number or page_number < 1 or page_number > 79:
         return {'success': False, 'error': 'Invalid page number'}, 400
     
-    # Get or create annotation entry
-    annotation = PDFAnnotation.query.filter_by(
-        user_id=current_user.id, 
-        page_number=page_number
-    ).first()
-    if not annotation:
-        annotation = PDFAnnotation(user_id=current_user.id, page_number=page_number)
-        db.session.add(annotation)
-    
     # Update annotation fields
-    annotation.notes = request.form.get('notes', '').strip()
-    annotation.drawing_data = request.form.get('drawing_data', '').strip()
-    annotation.updated_date = datetime.utcnow()
+    values = {
+        'notes': request.form.get('notes', '').strip(),
+        'updated_date': datetime.utcnow()
+    }
+    # Canvases now save strokes separately, so only older clients send a PNG snapshot
+    if 'drawing_data' in request.form:
+        try:
+            values['drawing_ref'] = store_drawing(request.form['drawing_data'].strip())
+            values['drawing_data'] = None  # Replaces any legacy drawing not moved yet
+        except DrawingStoreError as e:
+            return {'success': False, 'error': str(e)}, 400
     
     try:
+        # Create the annotation on first save, otherwise update it in place
+        db.session.execute(
+            upsert_statement(PDFAnnotation)
+            .values(user_id=current_user_id(), page_number=page_number, **values)
+            .on_conflict_do_update(index_elements=['user_id', 'page_number'], set_=values)
+        )
         db.session.commit()
         return {
             'success': True,
@@ -436,6 +683,96 @@ def save_pdf_annotation():
         logging.error(f"Error saving PDF annotation: {e}")
         return {'success': False, 'error': 'Failed to save annotation'}, 500
 
+@app.route('/save-pdf-annotation/strokes', methods=['POST'])
+@subscription_required(api=True)
+def save_pdf_strokes():
+    """Append new drawing strokes to a PDF page annotation via AJAX"""
+    return append_strokes('pdf')
+
+@app.route('/drawings/strokes/<canvas>/<int:number>')
+@login_required
+def drawing_strokes(canvas, number):
+    """Return the strokes drawn on one of the current user's canvases"""
+    if canvas not in STROKE_CANVASES:
+        abort(404)
+    
+    return {'strokes': decode_strokes(load_stroke_data(canvas, number))}
+
+@app.route('/drawings/strokes/<canvas>/<int:number>.png')
+@login_required
+def drawing_strokes_png(canvas, number):
+    """Export the strokes drawn on one of the current user's canvases as a PNG"""
+    if canvas not in STROKE_CANVASES:
+        abort(404)
+    
+    data = load_stroke_data(canvas, number)
+    response = app.response_class(mimetype='image/png')
+    response.set_etag(stroke_png_key(data, *DRAWING_CANVAS_SIZE))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    
+    # Only rasterize (or read the cached PNG) when the client doesn't already have this version
+    if response.get_etag()[0] in request.if_none_match:
+        response.status_code = 304
+    else:
+        response.set_data(render_stroke_png(data, *DRAWING_CANVAS_SIZE))
+    return response
+
+@app.route('/drawings/<key>')
+@login_required
+def drawing(key):
+    """Serve a stored canvas drawing with long-lived caching"""
+    if not is_drawing_key(key):
+        abort(404)
+    
+    # Keys are content hashes, so a matching ETag means the client already has these bytes
+    if key in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        owned = db.session.query(
+            exists().where(JournalEntry.user_id == current_user.id, JournalEntry.drawing_ref == key)
+        ).scalar() or db.session.query(
+            exists().where(PDFAnnotation.user_id == current_user.id, PDFAnnotation.drawing_ref == key)
+        ).scalar()
+        if not owned:
+            abort(404)
+        
+        try:
+            drawing_file = get_drawing_store().open(key)
+        except FileNotFoundError:
+            abort(404)
+        response = send_file(drawing_file, mimetype='image/png', conditional=True, etag=False)
+    
+    response.set_etag(key)
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response
+
+# Export formats: how each is generated and its mimetype
+EXPORT_FORMATS = {
+    'ndjson': (iter_export_ndjson, 'application/x-ndjson'),
+    'csv': (iter_export_csv, 'text/csv'),
+    'zip': (lambda user_id: iter_export_zip(user_id, DRAWING_CANVAS_SIZE), 'application/zip'),
+}
+
+@app.route('/journal/export.<fmt>')
+@login_required
+def export_journal(fmt):
+    """Download all of the current user's journal entries and annotations, streamed as it's generated"""
+    if fmt not in EXPORT_FORMATS:
+        abort(404)
+    
+    generate, mimetype = EXPORT_FORMATS[fmt]
+    # Former subscribers can still take their data with them
+    response = app.response_class(stream_with_context(generate(current_user.id)), mimetype=mimetype)
+    filename = f"recovery-journal-{datetime.utcnow():%Y-%m-%d}.{fmt}"
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
+
 @app.route('/admin/layout')
 @login_required
 def admin_layout():
@@ -445,9 +782,7 @@ def admin_layout():
         return redirect(url_for('dashboard'))
     
     # Get current settings
-    settings = {}
-    for setting in SiteSettings.query.all():
-        settings[setting.setting_name] = setting.setting_value
+    settings = get_site_settings()
     
     return render_template('admin_layout.html', settings=settings)
 
@@ -470,20 +805,8 @@ def update_layout():
         'spacing': request.form.get('spacing', 'normal')
     }
     
-    for setting_name, setting_value in layout_settings.items():
-        existing_setting = SiteSettings.query.filter_by(setting_name=setting_name).first()
-        if existing_setting:
-            existing_setting.setting_value = setting_value
-            existing_setting.updated_date = datetime.utcnow()
-        else:
-            new_setting = SiteSettings(
-                setting_name=setting_name,
-                setting_value=setting_value,
-                description=f"Layout setting for {setting_name}"
-            )
-            db.session.add(new_setting)
-    
     try:
+        save_site_settings(layout_settings)
         db.session.commit()
         flash('Layout settings updated successfully!', 'success')
     except Exception as e:
@@ -493,6 +816,91 @@ def update_layout():
     
     return redirect(url_for('admin_layout'))
 
+@app.route('/admin/broadcast', methods=['GET', 'POST'])
+@login_required
+def admin_broadcast():
+    """Compose broadcasts to all active subscribers and follow their progress (owner only)"""
+    if not current_user.is_owner:
+        flash('Access denied. Admin privileges required.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    form = BroadcastForm()
+    if form.validate_on_submit():
+        try:
+            broadcast = create_broadcast(form.subject.data, form.message.data)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error creating broadcast: {e}")
+            flash('Error creating broadcast. Please try again.', 'error')
+        else:
+            start_broadcast_thread(app, broadcast.id)
+            logging.info("Broadcast %s started by %s", broadcast.id, current_user.email)
+            flash('Broadcast started. Progress is shown below.', 'success')
+        return redirect(url_for('admin_broadcast'))
+    
+    subscriber_count = db.session.execute(
+        select(func.count(EmailSubscriber.id)).where(EmailSubscriber.is_active.is_(True))
+    ).scalar()
+    broadcasts = db.session.execute(
+        select(Broadcast).order_by(Broadcast.created_date.desc()).limit(20)
+    ).scalars().all()
+    
+    return render_template('admin_broadcast.html', form=form, resume_form=ResumeBroadcastForm(),
+                           broadcasts=broadcasts, subscriber_count=subscriber_count)
+
+@app.route('/admin/broadcast/<int:broadcast_id>/resume', methods=['POST'])
+@login_required
+def resume_broadcast(broadcast_id):
+    """Resume an interrupted broadcast after its last recorded batch (owner only)"""
+    if not current_user.is_owner:
+        flash('Access denied. Admin privileges required.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    if not ResumeBroadcastForm().validate_on_submit():
+        flash('Your session expired. Please try resuming the broadcast again.', 'error')
+        return redirect(url_for('admin_broadcast'))
+    
+    # Take the lease here, so the owner learns now if the broadcast can't be resumed
+    if not claim_broadcast(broadcast_id):
+        flash('That broadcast is already finished or still being sent.', 'error')
+        return redirect(url_for('admin_broadcast'))
+
+    start_broadcast_thread(app, broadcast_id, claimed=True)
+    flash('Broadcast resuming. Subscribers who already received it will be skipped.', 'info')
+    return redirect(url_for('admin_broadcast'))
+
+@app.route('/admin/analytics', methods=['GET', 'POST'])
+@login_required
+def admin_analytics():
+    """Journal averages, rating distributions and retention per signup cohort (owner only)
+
+    Reads only the rollup tables; POST refreshes them first.
+    """
+    if not current_user.is_owner:
+        flash('Access denied. Admin privileges required.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    form = RefreshAnalyticsForm()
+    if request.method == 'POST':
+        if not form.validate_on_submit():
+            flash('Your session expired. Please try refreshing again.', 'error')
+        else:
+            try:
+                cohorts = refresh_rollups()
+                db.session.commit()
+                flash(f'Analytics refreshed ({len(cohorts)} cohorts updated).', 'success')
+            except Exception as e:
+                db.session.rollback()
+                logging.error("Error refreshing analytics: %s", e)
+                flash('Error refreshing analytics. Please try again.', 'error')
+        return redirect(url_for('admin_analytics', cohort=request.args.get('cohort')))
+    
+    cohort = request.args.get('cohort')
+    return render_template('admin_analytics.html', form=form, cohort=cohort, days=day_summaries(cohort),
+                           cohorts=cohort_funnels(), funnel_days=FUNNEL_DAYS,
+                           updated_at=rollups_updated_at())
+
 @app.route('/create-owner-account')
 def create_owner_account():
     """Create owner account for site access"""
@@ -525,10 +933,10 @@ def create_owner_account():
             ('spacing', 'normal', 'Element spacing')
         ]
         
-        for name, value, desc in default_settings:
-            setting = SiteSettings(setting_name=name, setting_value=value, description=desc)
-            db.session.add(setting)
-        
+        save_site_settings(
+            {name: value for name, value, desc in default_settings},
+            {name: desc for name, value, desc in default_settings}
+        )
         db.session.commit()
         return f"Owner account created! Email: owner@eyesofanaddict.online | Password: recovery2024"
     except Exception as e:
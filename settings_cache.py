@@ -0,0 +1,82 @@
+import time
+import uuid
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select
+from app import db
+from models import SiteSettings, upsert_statement
+
+# Reserved settings row whose value changes on every save, so other workers notice.
+# Rows whose names start with an underscore are internal and never part of the layout settings.
+VERSION_SETTING = '_settings_version'
+
+# Per-worker cache of the layout settings
+_cache = {'settings': None, 'version': None, 'checked_at': 0.0}
+
+
+def get_site_settings():
+    """Get the layout settings as a dict, cached per worker
+
+    Within the TTL no query is made. After it, only the version row is read,
+    and the full table is reloaded only when another worker saved new settings.
+    """
+    now = time.monotonic()
+    if _cache['settings'] is not None and now - _cache['checked_at'] < current_app.config['SETTINGS_CACHE_TTL']:
+        return _cache['settings']
+
+    version = db.session.execute(
+        select(SiteSettings.setting_value).filter_by(setting_name=VERSION_SETTING)
+    ).scalar()
+
+    if _cache['settings'] is None or version != _cache['version']:
+        _cache['settings'] = {
+            setting_name: setting_value
+            for setting_name, setting_value in db.session.execute(
+                select(SiteSettings.setting_name, SiteSettings.setting_value)
+                .where(SiteSettings.setting_name.not_like('\\_%', escape='\\'))
+            )
+        }
+        _cache['version'] = version
+    _cache['checked_at'] = now
+    return _cache['settings']
+
+
+def save_site_settings(values, descriptions=None):
+    """Upsert layout settings in one statement and bump the settings version
+
+    The caller commits. This worker's cache is dropped straight away; other
+    workers pick up the new version once their TTL runs out.
+    """
+    descriptions = descriptions or {}
+    now = datetime.utcnow()
+    rows = [
+        {
+            'setting_name': name,
+            'setting_value': value,
+            'description': descriptions.get(name, f"Layout setting for {name}"),
+            'updated_date': now
+        }
+        for name, value in values.items()
+    ]
+    rows.append({
+        'setting_name': VERSION_SETTING,
+        'setting_value': uuid.uuid4().hex,
+        'description': 'Changes whenever settings are saved, to refresh cached copies',
+        'updated_date': now
+    })
+
+    statement = upsert_statement(SiteSettings).values(rows)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=['setting_name'],
+        set_={
+            'setting_value': statement.excluded.setting_value,
+            'updated_date': statement.excluded.updated_date
+        }
+    ))
+    clear_settings_cache()
+
+
+def clear_settings_cache():
+    """Forget this worker's cached settings"""
+    _cache['settings'] = None
+    _cache['version'] = None
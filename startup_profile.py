@@ -0,0 +1,84 @@
+import os
+import sys
+import json
+import time
+import subprocess
+from collections import Counter
+
+# SDKs that are imported on first use; none should be loaded once the app has started
+LAZY_MODULES = ('stripe', 'sendgrid', 'requests', 'redis', 'PIL', 'pypdfium2')
+
+# Run in a fresh interpreter by profile_cold_start(); prints the startup profile as JSON
+_COLD_START_SCRIPT = """
+import json, sys
+import main
+profile = main.app.extensions['startup_profile']
+if sys.argv[1]:
+    main.app.test_client().get(sys.argv[1])
+    profile.mark('first_request')
+print(json.dumps(profile.as_dict()))
+"""
+
+
+class StartupProfile:
+    """Wall-clock time of each phase of this process's startup, marked as each one ends"""
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self._last = self.started
+        self.phases = []
+
+    def mark(self, phase):
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    @property
+    def total_seconds(self):
+        return self._last - self.started
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total_seconds * 1000, 1),
+            'phases_ms': {phase: round(seconds * 1000, 1) for phase, seconds in self.phases},
+            'lazy_modules_loaded': [name for name in LAZY_MODULES if name in sys.modules],
+        }
+
+    def summary(self):
+        phases = ', '.join(f"{phase} {seconds * 1000:.0f}" for phase, seconds in self.phases)
+        return f"{self.total_seconds * 1000:.0f} ms ({phases})"
+
+
+def _import_times(stderr):
+    """Total self time in ms of each top-level package, from `python -X importtime` output"""
+    totals = Counter()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        totals[name.strip().split('.')[0]] += int(self_us) / 1000
+    return totals
+
+
+def _start_app(root_path, path, *options):
+    result = subprocess.run(
+        [sys.executable, *options, '-c', _COLD_START_SCRIPT, path or ''],
+        cwd=root_path, env=dict(os.environ), capture_output=True, text=True
+    )
+    if result.returncode:
+        raise RuntimeError(f"App failed to start:\n{result.stderr[-2000:]}")
+    return result
+
+
+def profile_cold_start(root_path, path=None, import_count=10):
+    """Start the app in a fresh interpreter, as a new instance would, and report how long it took
+
+    With ``path``, a first request to it is timed as well. Returns the child's
+    startup profile plus the slowest packages to import.
+    """
+    profile = json.loads(_start_app(root_path, path).stdout.strip().splitlines()[-1])
+    if import_count:
+        # A second start, since -X importtime slows imports down and would skew the phases
+        import_times = _import_times(_start_app(root_path, None, '-X', 'importtime').stderr)
+        profile['slowest_imports_ms'] = {name: round(ms, 1) for name, ms in import_times.most_common(import_count)}
+    return profile
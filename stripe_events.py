@@ -0,0 +1,151 @@
+import json
+import logging
+from datetime import datetime
+from sqlalchemy import select
+from app import db
+from models import StripeEvent, User, upsert_statement
+from entitlements import bump_entitlement_version
+from stripe_service import forget_checkout_session
+
+# Failed events are retried by `flask process-stripe-events` until this many attempts
+MAX_ATTEMPTS = 5
+
+
+def record_stripe_event(event):
+    """Log a Stripe event (as a dict) unless it was already received; the caller commits
+
+    Returns False for a redelivery of an event we already have.
+    """
+    return bool(db.session.execute(
+        upsert_statement(StripeEvent).values(
+            id=event['id'],
+            type=event['type'],
+            payload=json.dumps(event),
+            status='pending',
+            attempts=0,
+            created_at=datetime.utcfromtimestamp(event['created']),
+            received_date=datetime.utcnow()
+        ).on_conflict_do_nothing(index_elements=['id'])
+    ).rowcount)
+
+
+def _find_user(customer_id, email):
+    """Find the user for a Stripe customer, falling back to the email used at checkout"""
+    user = None
+    if customer_id:
+        user = db.session.execute(select(User).filter_by(stripe_customer_id=customer_id)).scalar()
+    if user is None and email:
+        user = db.session.execute(select(User).filter_by(email=email)).scalar()
+    return user
+
+
+def _timestamp(value):
+    return datetime.utcfromtimestamp(value) if value else None
+
+
+def _apply_checkout_completed(session, created_at):
+    email = (session.get('metadata') or {}).get('user_email') or session.get('customer_email')
+    user = _find_user(session.get('customer'), email)
+    if user is None:
+        return False
+
+    user.stripe_customer_id = session.get('customer') or user.stripe_customer_id
+    user.stripe_subscription_id = session.get('subscription') or user.stripe_subscription_id
+    # A subscription event may already have recorded a newer state
+    if session.get('payment_status') in ('paid', 'no_payment_required') and (
+            user.subscription_updated_at is None or user.subscription_updated_at <= created_at):
+        user.subscription_status = 'active'
+        user.subscription_updated_at = created_at
+    return True
+
+
+def _apply_subscription(subscription, created_at):
+    email = (subscription.get('metadata') or {}).get('user_email')
+    user = _find_user(subscription.get('customer'), email)
+    if user is None:
+        return False
+    # Stripe doesn't guarantee delivery order; never let an older event undo a newer one
+    if user.subscription_updated_at is not None and user.subscription_updated_at > created_at:
+        return True
+
+    # Newer API versions report the billing period on the subscription items
+    items = (subscription.get('items') or {}).get('data') or [{}]
+    period_start = subscription.get('current_period_start') or items[0].get('current_period_start')
+    period_end = subscription.get('current_period_end') or items[0].get('current_period_end')
+
+    user.stripe_customer_id = subscription.get('customer') or user.stripe_customer_id
+    user.stripe_subscription_id = subscription['id']
+    user.subscription_status = subscription.get('status', 'canceled')
+    user.subscription_start = _timestamp(period_start) or user.subscription_start
+    user.subscription_end = _timestamp(subscription.get('ended_at') or period_end) or user.subscription_end
+    user.subscription_updated_at = created_at
+    return True
+
+
+# How each handled event type changes a user, given the event's data object and creation time.
+# Handlers return False when the event isn't about any user we know.
+EVENT_HANDLERS = {
+    'checkout.session.completed': _apply_checkout_completed,
+    'customer.subscription.created': _apply_subscription,
+    'customer.subscription.updated': _apply_subscription,
+    'customer.subscription.deleted': _apply_subscription,
+}
+
+
+def apply_stripe_event(event):
+    """Apply a logged event to its user and mark it processed or ignored"""
+    handler = EVENT_HANDLERS.get(event.type)
+    data = json.loads(event.payload)['data']['object']
+    if event.type in ('checkout.session.completed', 'checkout.session.expired'):
+        forget_checkout_session(data['id'])
+    if handler is not None and handler(data, event.created_at):
+        event.status = 'processed'
+        # Logged-in sessions pick up the change instead of waiting for their claim to expire
+        bump_entitlement_version()
+    else:
+        event.status = 'ignored'
+    event.processed_date = datetime.utcnow()
+    event.last_error = None
+
+
+def process_stripe_events(event_ids=None, limit=100):
+    """Apply pending (or previously failed) events in the order Stripe created them
+
+    Each event is locked, applied and committed on its own, so concurrent
+    processors skip each other's events and one bad event doesn't hold up the rest.
+    Returns the number of events handled.
+    """
+    tried = []
+    while len(tried) < limit:
+        query = (
+            select(StripeEvent)
+            .where(StripeEvent.status.in_(('pending', 'failed')), StripeEvent.attempts < MAX_ATTEMPTS)
+            .order_by(StripeEvent.created_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        if event_ids is not None:
+            query = query.where(StripeEvent.id.in_(event_ids))
+        if tried:
+            query = query.where(StripeEvent.id.not_in(tried))
+        event = db.session.execute(query).scalar()
+        if event is None:
+            break
+
+        event_id = event.id
+        tried.append(event_id)
+        try:
+            event.attempts = (event.attempts or 0) + 1
+            apply_stripe_event(event)
+            db.session.commit()
+            logging.info("Stripe event %s (%s) %s", event_id, event.type, event.status)
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error applying Stripe event {event_id}: {e}")
+            event = db.session.get(StripeEvent, event_id)
+            event.status = 'failed'
+            event.attempts = (event.attempts or 0) + 1
+            event.last_error = str(e)
+            db.session.commit()
+
+    return len(tried)
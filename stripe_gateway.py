@@ -0,0 +1,136 @@
+import logging
+import random
+import threading
+import time
+import uuid
+from instrumentation import observe_outbound
+
+
+class StripeUnavailable(Exception):
+    """Raised instead of calling Stripe while the circuit breaker is open"""
+
+
+class CircuitBreaker:
+    """Stops calls to a failing service for a while instead of letting each request time out
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    calls fail fast. Once ``reset_seconds`` have passed one trial call is let
+    through: success closes the breaker again, failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        """Whether calls are currently being refused"""
+        with self._lock:
+            return (self.opened_at is not None and
+                    (self._trial_running or time.monotonic() - self.opened_at < self.reset_seconds))
+
+    def before_call(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if self._trial_running or time.monotonic() - self.opened_at < self.reset_seconds:
+                raise StripeUnavailable("Stripe is unavailable, try again shortly")
+            self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.warning(f"Stripe circuit breaker open after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class StripeGateway:
+    """The app's only way of calling the Stripe API
+
+    Calls share one pooled HTTP session with explicit connect and read
+    timeouts, go through a circuit breaker, and have their latency recorded
+    per API method. Every write carries an idempotency key, so transient
+    failures (network errors, rate limits, 5xx responses) are retried with
+    jittered backoff without risking a duplicate.
+    """
+
+    RETRY_BASE_SECONDS = 0.25
+
+    def __init__(self, api_key, connect_timeout=3.05, read_timeout=10, max_retries=2, breaker=None):
+        # The SDK is slow to import, so it waits until the first Stripe call creates the gateway
+        import requests
+        import stripe
+
+        session = requests.Session()
+        session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        self.client = stripe.StripeClient(
+            api_key,
+            http_client=stripe.RequestsClient(timeout=(connect_timeout, read_timeout), session=session),
+            max_network_retries=0  # Retries are done here, where the breaker can see them
+        )
+        self.max_retries = max_retries
+        self.breaker = breaker or CircuitBreaker()
+
+    @staticmethod
+    def is_transient(error):
+        """Whether an error is worth retrying and counts against the breaker"""
+        import stripe
+
+        if isinstance(error, (stripe.APIConnectionError, stripe.RateLimitError)):
+            return True
+        return isinstance(error, stripe.StripeError) and (error.http_status or 0) >= 500
+
+    def call(self, method, request, idempotent=True):
+        """Make one logical API call, where ``request`` performs the HTTP request
+
+        Non-idempotent calls are attempted once.
+        """
+        self.breaker.before_call()
+        attempts = 1 + (self.max_retries if idempotent else 0)
+        for attempt in range(1, attempts + 1):
+            started = time.monotonic()
+            try:
+                result = request()
+            except Exception as e:
+                observe_outbound('stripe', method, time.monotonic() - started, error=True)
+                if not self.is_transient(e):
+                    # The request reached Stripe and was refused; Stripe itself is fine
+                    self.breaker.record_success()
+                    raise
+                if attempt == attempts:
+                    self.breaker.record_failure()
+                    raise
+                delay = self.RETRY_BASE_SECONDS * 2 ** (attempt - 1)
+                logging.warning(f"Stripe {method} failed (attempt {attempt}), retrying: {e}")
+                time.sleep(delay * random.uniform(0.5, 1.5))
+            else:
+                observe_outbound('stripe', method, time.monotonic() - started)
+                self.breaker.record_success()
+                return result
+
+    def create_checkout_session(self, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key or str(uuid.uuid4())}
+        return self.call('checkout.sessions.create', lambda: self.client.v1.checkout.sessions.create(params, options))
+
+    def create_portal_session(self, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key or str(uuid.uuid4())}
+        return self.call('billing_portal.sessions.create',
+                         lambda: self.client.v1.billing_portal.sessions.create(params, options))
+
+    def update_subscription(self, subscription_id, params, idempotency_key=None):
+        options = {'idempotency_key': idempotency_key or str(uuid.uuid4())}
+        return self.call('subscriptions.update',
+                         lambda: self.client.v1.subscriptions.update(subscription_id, params, options))
@@ -1,22 +1,98 @@
 import os
-import stripe
-from flask import url_for
+import calendar
+import logging
+import secrets
+import threading
 from datetime import datetime, timedelta
+from sqlalchemy import and_, delete, or_, select, update
+from app import db
+from models import CheckoutSession, upsert_statement
+from stripe_gateway import StripeGateway
 
-# Configure Stripe
-stripe.api_key = os.environ.get('STRIPE_SECRET_KEY')
+# Stripe keeps a checkout session open for 30 minutes to 24 hours. Sessions last 90 minutes
+# and are handed out until 15 minutes before they close. A session Stripe hasn't confirmed
+# yet is retried with the same key for 45 minutes, so it is always asked to stay open for
+# at least that long.
+CHECKOUT_WINDOW_SECONDS = 45 * 60
+CHECKOUT_LIFETIME_SECONDS = 90 * 60
+CHECKOUT_REUSE_MARGIN_SECONDS = 15 * 60
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+def get_stripe_gateway():
+    """Get this process's Stripe gateway, configured from the environment"""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = StripeGateway(
+                    os.environ.get('STRIPE_SECRET_KEY'),
+                    connect_timeout=float(os.environ.get('STRIPE_CONNECT_TIMEOUT', 3.05)),
+                    read_timeout=float(os.environ.get('STRIPE_READ_TIMEOUT', 10)),
+                    max_retries=int(os.environ.get('STRIPE_MAX_RETRIES', 2))
+                )
+    return _gateway
+
+def is_stripe_available():
+    """Whether Stripe calls are being attempted, i.e. the circuit breaker isn't open"""
+    return not get_stripe_gateway().breaker.is_open
+
+def _live_checkout_session(now):
+    """Whether a checkout session row can still be handed out, or retried with its key"""
+    return or_(
+        and_(CheckoutSession.url.isnot(None), CheckoutSession.expires_at > now),
+        and_(CheckoutSession.url.is_(None), CheckoutSession.created_date > now - timedelta(seconds=CHECKOUT_WINDOW_SECONDS))
+    )
 
 def create_checkout_session(user_email, user_name):
-    """Create a Stripe checkout session for journal subscription"""
+    """Get a Stripe checkout URL for the journal subscription
+
+    The user's open session is reused while it's fresh, so retries and
+    double clicks don't create new ones. A new session gets a random
+    idempotency key that is committed before Stripe is called, so a retry
+    after a failed or lost response asks Stripe for the same session.
+    The caller commits the session once it's created.
+    """
+    now = datetime.utcnow()
+    live = _live_checkout_session(now)
+    checkout = db.session.execute(
+        select(CheckoutSession).where(CheckoutSession.user_email == user_email, live)
+    ).scalar()
+    if checkout is None:
+        values = {
+            'idempotency_key': secrets.token_hex(16),
+            'stripe_session_id': None,
+            'url': None,
+            'expires_at': now.replace(microsecond=0) + timedelta(
+                seconds=CHECKOUT_LIFETIME_SECONDS - CHECKOUT_REUSE_MARGIN_SECONDS),
+            'created_date': now
+        }
+        # Only replace a stale row, so concurrent requests end up sharing one key
+        db.session.execute(
+            upsert_statement(CheckoutSession)
+            .values(user_email=user_email, **values)
+            .on_conflict_do_update(index_elements=['user_email'], set_=values, where=~live)
+        )
+        db.session.commit()
+        checkout = db.session.execute(
+            select(CheckoutSession).where(CheckoutSession.user_email == user_email)
+        ).scalar_one()
+    if checkout.url:
+        return checkout.url
+    
+    # Retries send the same key and identical parameters, so they get the same session back from Stripe
+    stripe_expires_at = calendar.timegm(checkout.expires_at.utctimetuple()) + CHECKOUT_REUSE_MARGIN_SECONDS
+    
     try:
         # Domain for redirects
         domain = os.environ.get('REPLIT_DEV_DOMAIN') if os.environ.get('REPLIT_DEPLOYMENT') else 'localhost:5000'
         protocol = 'https' if os.environ.get('REPLIT_DEPLOYMENT') else 'http'
         
-        checkout_session = stripe.checkout.Session.create(
-            customer_email=user_email,
-            payment_method_types=['card'],
-            line_items=[{
+        checkout_session = get_stripe_gateway().create_checkout_session({
+            'customer_email': user_email,
+            'payment_method_types': ['card'],
+            'line_items': [{
                 'price_data': {
                     'currency': 'usd',
                     'product_data': {
@@ -32,72 +108,63 @@ def create_checkout_session(user_email, user_name):
                 },
                 'quantity': 1,
             }],
-            mode='subscription',
-            success_url=f'{protocol}://{domain}/subscription/success?session_id={{CHECKOUT_SESSION_ID}}',
-            cancel_url=f'{protocol}://{domain}/subscription/cancel',
-            metadata={
+            'mode': 'subscription',
+            'success_url': f'{protocol}://{domain}/subscription/success?session_id={{CHECKOUT_SESSION_ID}}',
+            'cancel_url': f'{protocol}://{domain}/subscription/cancel',
+            'metadata': {
                 'user_email': user_email,
                 'user_name': user_name
             },
-            subscription_data={
+            'subscription_data': {
                 'metadata': {
                     'user_email': user_email,
                     'user_name': user_name
                 }
             },
-            billing_address_collection='required',
-            automatic_tax={'enabled': True},
-        )
+            'billing_address_collection': 'required',
+            'automatic_tax': {'enabled': True},
+            'expires_at': stripe_expires_at,
+        }, idempotency_key=checkout.idempotency_key)
         
+        db.session.execute(
+            update(CheckoutSession)
+            .where(CheckoutSession.id == checkout.id, CheckoutSession.idempotency_key == checkout.idempotency_key)
+            .values(stripe_session_id=checkout_session.id, url=checkout_session.url)
+            .execution_options(synchronize_session=False)
+        )
         return checkout_session.url
     except Exception as e:
-        print(f"Stripe checkout error: {e}")
+        logging.error("Stripe checkout error: %s", e)
         return None
 
+def forget_checkout_session(stripe_session_id):
+    """Stop reusing a checkout session once it's completed or expired; the caller commits"""
+    db.session.execute(delete(CheckoutSession).filter_by(stripe_session_id=stripe_session_id))
+
 def create_customer_portal_session(customer_id):
     """Create a customer portal session for subscription management"""
     try:
         domain = os.environ.get('REPLIT_DEV_DOMAIN') if os.environ.get('REPLIT_DEPLOYMENT') else 'localhost:5000'
         protocol = 'https' if os.environ.get('REPLIT_DEPLOYMENT') else 'http'
         
-        portal_session = stripe.billing_portal.Session.create(
-            customer=customer_id,
-            return_url=f'{protocol}://{domain}/dashboard',
-        )
+        portal_session = get_stripe_gateway().create_portal_session({
+            'customer': customer_id,
+            'return_url': f'{protocol}://{domain}/dashboard',
+        })
         return portal_session.url
     except Exception as e:
-        print(f"Customer portal error: {e}")
+        logging.error("Customer portal error: %s", e)
         return None
 
-def get_subscription_status(customer_id):
-    """Get the current subscription status for a customer"""
-    try:
-        subscriptions = stripe.Subscription.list(customer=customer_id, limit=1)
-        if subscriptions.data:
-            subscription = subscriptions.data[0]
-            return {
-                'status': subscription.status,
-                'current_period_start': datetime.fromtimestamp(subscription.current_period_start),
-                'current_period_end': datetime.fromtimestamp(subscription.current_period_end),
-                'cancel_at_period_end': subscription.cancel_at_period_end
-            }
-        return None
-    except Exception as e:
-        print(f"Subscription status error: {e}")
-        return None
+def cancel_subscription(subscription_id):
+    """Cancel a subscription at the end of the current period
 
-def cancel_subscription(customer_id):
-    """Cancel a subscription at the end of the current period"""
+    The user's stored status is updated when Stripe sends the resulting
+    customer.subscription.updated webhook.
+    """
     try:
-        subscriptions = stripe.Subscription.list(customer=customer_id, limit=1)
-        if subscriptions.data:
-            subscription = subscriptions.data[0]
-            updated_subscription = stripe.Subscription.modify(
-                subscription.id,
-                cancel_at_period_end=True
-            )
-            return True
-        return False
+        get_stripe_gateway().update_subscription(subscription_id, {'cancel_at_period_end': True})
+        return True
     except Exception as e:
-        print(f"Cancel subscription error: {e}")
-        return False
\ No newline at end of file
+        logging.error("Cancel subscription error: %s", e)
+        return False
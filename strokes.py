@@ -0,0 +1,161 @@
+import sys
+import struct
+import zlib
+from array import array
+
+# Tools the canvases can draw with, stored as their index
+TOOLS = ('pen', 'eraser')
+
+# Limits for a single save request
+MAX_STROKES_PER_SAVE = 500
+MAX_POINTS_PER_STROKE = 10000
+
+# Coordinates are stored as unsigned 16-bit quarter pixels
+COORDINATE_SCALE = 4
+MAX_COORDINATE = 0xFFFF / COORDINATE_SCALE
+
+# Per-stroke header: tool, width in tenths of a pixel, red, green, blue, point count
+_HEADER = struct.Struct('<BHBBBI')
+
+
+class StrokeError(ValueError):
+    """Raised when submitted stroke data is malformed"""
+
+
+def _parse_color(value):
+    if not isinstance(value, str) or len(value) != 7 or not value.startswith('#'):
+        raise StrokeError('Stroke color must look like #RRGGBB')
+    try:
+        return tuple(int(value[i:i + 2], 16) for i in (1, 3, 5))
+    except ValueError:
+        raise StrokeError('Stroke color must look like #RRGGBB')
+
+
+def parse_strokes(data):
+    """Validate strokes sent by the canvas and return them as tuples
+
+    Each stroke is a dict with ``tool``, ``width``, ``color`` and a flat
+    ``points`` list of x, y pairs.
+    """
+    if not isinstance(data, list) or len(data) > MAX_STROKES_PER_SAVE:
+        raise StrokeError(f'Send a list of at most {MAX_STROKES_PER_SAVE} strokes')
+
+    strokes = []
+    for stroke in data:
+        if not isinstance(stroke, dict):
+            raise StrokeError('Each stroke must be an object')
+
+        tool = stroke.get('tool', 'pen')
+        if tool not in TOOLS:
+            raise StrokeError(f'Unknown drawing tool {tool}')
+
+        width = stroke.get('width')
+        if not isinstance(width, (int, float)) or isinstance(width, bool) or not 0 < width <= 100:
+            raise StrokeError('Stroke width must be between 0 and 100')
+
+        points = stroke.get('points')
+        if (not isinstance(points, list) or len(points) % 2 or
+                not 2 <= len(points) <= MAX_POINTS_PER_STROKE * 2):
+            raise StrokeError(f'Stroke points must be x, y pairs (at most {MAX_POINTS_PER_STROKE})')
+        for value in points:
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                raise StrokeError('Stroke points must be numbers')
+
+        strokes.append((tool, float(width), _parse_color(stroke.get('color')), points))
+    return strokes
+
+
+def encode_strokes(strokes):
+    """Pack parsed strokes into the compact binary format"""
+    chunks = []
+    for tool, width, (red, green, blue), points in strokes:
+        coords = array('H', (
+            int(round(min(max(value, 0), MAX_COORDINATE) * COORDINATE_SCALE)) for value in points
+        ))
+        if sys.byteorder == 'big':
+            coords.byteswap()
+        chunks.append(_HEADER.pack(TOOLS.index(tool), int(round(width * 10)), red, green, blue, len(points) // 2))
+        chunks.append(coords.tobytes())
+    return b''.join(chunks)
+
+
+def iter_strokes(data):
+    """Yield (tool, width, (r, g, b), points) tuples from packed stroke data"""
+    offset = 0
+    while offset < len(data):
+        tool, width, red, green, blue, count = _HEADER.unpack_from(data, offset)
+        offset += _HEADER.size
+        coords = array('H')
+        coords.frombytes(data[offset:offset + count * 2 * coords.itemsize])
+        if sys.byteorder == 'big':
+            coords.byteswap()
+        offset += count * 2 * coords.itemsize
+        yield TOOLS[tool], width / 10, (red, green, blue), [value / COORDINATE_SCALE for value in coords]
+
+
+def decode_strokes(data):
+    """Unpack stroke data into the JSON shape the canvas sends"""
+    return [
+        {
+            'tool': tool,
+            'width': width,
+            'color': '#%02x%02x%02x' % color,
+            'points': points
+        }
+        for tool, width, color, points in iter_strokes(data)
+    ]
+
+
+def _disc(radius):
+    """Pixel offsets covered by a filled circle of the given radius"""
+    reach = int(radius + 0.5)
+    limit = radius * radius
+    return [
+        (dx, dy)
+        for dy in range(-reach, reach + 1)
+        for dx in range(-reach, reach + 1)
+        if dx * dx + dy * dy <= limit
+    ]
+
+
+def rasterize_png(data, width, height):
+    """Render packed stroke data to a transparent PNG
+
+    Strokes are drawn with round caps by stamping discs along each segment,
+    which matches the canvas's round line caps and joins closely enough for exports.
+    """
+    pixels = bytearray(width * height * 4)
+
+    for tool, stroke_width, (red, green, blue), points in iter_strokes(data):
+        radius = max(stroke_width / 2, 0.5)
+        disc = _disc(radius)
+        color = bytes((red, green, blue, 255)) if tool == 'pen' else bytes(4)
+        step = max(radius / 2, 0.5)
+
+        xs, ys = points[0::2], points[1::2]
+        segments = list(zip(zip(xs, ys), zip(xs[1:], ys[1:]))) or [((xs[0], ys[0]), (xs[0], ys[0]))]
+        for (x0, y0), (x1, y1) in segments:
+            distance = ((x1 - x0) ** 2 + (y1 - y0) ** 2) ** 0.5
+            steps = max(int(distance / step), 1)
+            for i in range(steps + 1):
+                cx = int(round(x0 + (x1 - x0) * i / steps))
+                cy = int(round(y0 + (y1 - y0) * i / steps))
+                for dx, dy in disc:
+                    px, py = cx + dx, cy + dy
+                    if 0 <= px < width and 0 <= py < height:
+                        index = (py * width + px) * 4
+                        pixels[index:index + 4] = color
+
+    # Each scanline starts with filter type 0 (none)
+    stride = width * 4
+    raw = b''.join(b'\x00' + bytes(pixels[row * stride:(row + 1) * stride]) for row in range(height))
+
+    def chunk(kind, body):
+        return struct.pack('>I', len(body)) + kind + body + struct.pack('>I', zlib.crc32(kind + body) & 0xFFFFFFFF)
+
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(raw, 6)),
+        chunk(b'IEND', b'')
+    ])
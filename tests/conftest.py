@@ -0,0 +1,29 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The app is configured from the environment when it's imported, so point it at a scratch
+# SQLite database (and drawing store) before anything imports it
+_scratch = tempfile.mkdtemp(prefix='eyesofanaddict-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_scratch, 'test.db')}"
+os.environ['DRAWING_STORE_PATH'] = os.path.join(_scratch, 'drawings')
+os.environ.setdefault('SESSION_SECRET', 'test-secret')
+os.environ['LOG_QUEUE'] = '0'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import app as flask_app  # noqa: E402
+from app import db  # noqa: E402
+from drawing_store import LocalDrawingStore, init_drawing_store  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """The app inside an app context, with empty tables that are dropped afterwards and an empty drawing store"""
+    init_drawing_store(flask_app, LocalDrawingStore(str(tmp_path / 'drawings')))
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
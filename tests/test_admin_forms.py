@@ -0,0 +1,59 @@
+import re
+
+import pytest
+
+import routes
+from app import db
+from models import Broadcast, User
+
+
+@pytest.fixture
+def owner_client(app):
+    owner = User(email='owner@example.com', name='Owner', is_owner=True, subscription_status='active')
+    owner.set_password('owner')
+    db.session.add(owner)
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(owner.id)
+        session['_fresh'] = True
+    return client
+
+
+def csrf_token(client, path):
+    return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', client.get(path).get_data(as_text=True)).group(1)
+
+
+def test_resume_broadcast_requires_csrf_token(owner_client, monkeypatch):
+    broadcast = Broadcast(subject='Weekly update', message='Hello {name}', status='sending')
+    db.session.add(broadcast)
+    db.session.commit()
+    started = []
+    monkeypatch.setattr(routes, 'start_broadcast_thread',
+                        lambda app, broadcast_id, claimed: started.append(broadcast_id))
+
+    owner_client.post(f'/admin/broadcast/{broadcast.id}/resume')
+    assert started == []
+
+    token = csrf_token(owner_client, '/admin/broadcast')
+    owner_client.post(f'/admin/broadcast/{broadcast.id}/resume', data={'csrf_token': token})
+    assert started == [broadcast.id]
+
+    # The first resume holds the lease, so a second one is refused instead of reported as started
+    response = owner_client.post(f'/admin/broadcast/{broadcast.id}/resume', data={'csrf_token': token},
+                                 follow_redirects=True)
+    assert started == [broadcast.id]
+    assert 'already finished or still being sent' in response.get_data(as_text=True)
+
+
+def test_analytics_refresh_requires_csrf_token(owner_client, monkeypatch):
+    refreshes = []
+    monkeypatch.setattr(routes, 'refresh_rollups', lambda: refreshes.append(True) or [])
+
+    owner_client.post('/admin/analytics')
+    assert refreshes == []
+
+    token = csrf_token(owner_client, '/admin/analytics')
+    owner_client.post('/admin/analytics', data={'csrf_token': token})
+    assert refreshes == [True]
@@ -0,0 +1,138 @@
+import json
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, select, update
+
+from analytics import FUNNEL_DAYS, RATING_METRICS, RATING_VALUES, cohort_funnels, refresh_rollups
+from app import db
+from benchmark import seed_benchmark_data
+from models import CohortRollup, JournalEntry, JournalRollup, User
+
+COHORTS = ('2025-01', '2025-02', '2025-03', '2025-04')
+LONG_AGO = datetime.utcnow() - timedelta(days=2)
+
+
+def expected_rollups():
+    """Every rollup recomputed in Python from the journal entries"""
+    cohorts = {user.id: user.created_date.strftime('%Y-%m') for user in db.session.execute(select(User)).scalars()}
+    rollups = defaultdict(lambda: defaultdict(int))
+    for entry in db.session.execute(select(JournalEntry)).scalars():
+        rollup = rollups[(cohorts[entry.user_id], entry.day_number)]
+        rollup['entries'] += 1
+        rollup['completed_entries'] += bool(entry.completed)
+        rollup['completion_total'] += entry.completion_percentage
+        if entry.time_spent_minutes is not None:
+            rollup['minutes_total'] += entry.time_spent_minutes
+            rollup['minutes_count'] += 1
+        for metric, column in RATING_METRICS.items():
+            value = getattr(entry, column.key)
+            histogram = rollup.setdefault(f'{metric}_histogram', [0] * len(RATING_VALUES))
+            if value is not None:
+                rollup[f'{metric}_total'] += value
+                rollup[f'{metric}_count'] += 1
+                histogram[value - 1] += 1
+    return {key: dict(rollup) for key, rollup in rollups.items()}
+
+
+def stored_rollups():
+    stored = {}
+    for rollup in db.session.execute(select(JournalRollup)).scalars():
+        values = {field: getattr(rollup, field) for field in (
+            'entries', 'completed_entries', 'completion_total', 'minutes_total', 'minutes_count')}
+        for metric in RATING_METRICS:
+            values[f'{metric}_total'] = getattr(rollup, f'{metric}_total')
+            values[f'{metric}_count'] = getattr(rollup, f'{metric}_count')
+            values[f'{metric}_histogram'] = json.loads(getattr(rollup, f'{metric}_histogram'))
+        stored[(rollup.cohort, rollup.day_number)] = values
+    return stored
+
+
+def assert_rollups_match(expected):
+    stored = stored_rollups()
+    assert stored.keys() == expected.keys()
+    for key, values in expected.items():
+        assert {field: stored[key].get(field, 0) for field in values} == values, key
+
+
+def shift_entries(user_ids, rng, updated_date):
+    """Give some of the users' entries new ratings, completion and time spent"""
+    for entry_id in db.session.execute(select(JournalEntry.id).where(JournalEntry.user_id.in_(user_ids))).scalars():
+        if rng.random() < 0.3:
+            completion = rng.choice((0, 30, 60, 100))
+            db.session.execute(update(JournalEntry).where(JournalEntry.id == entry_id).values(
+                mood_rating=rng.choice((None, *RATING_VALUES)),
+                sleep_quality=rng.choice((None, *RATING_VALUES)),
+                time_spent_minutes=rng.choice((None, 10, 25)),
+                completion_percentage=completion,
+                completed=completion >= 50,
+                updated_date=updated_date,
+            ))
+    db.session.commit()
+
+
+@pytest.fixture
+def journals(app):
+    """Users spread over four signup months, each with a random run of days and varied entries"""
+    rng = random.Random(20)
+    user_ids = seed_benchmark_data(40)
+    by_cohort = defaultdict(list)
+    for index, user_id in enumerate(user_ids):
+        cohort = COHORTS[index % len(COHORTS)]
+        by_cohort[cohort].append(user_id)
+        db.session.execute(update(User).where(User.id == user_id).values(
+            created_date=datetime.strptime(cohort, '%Y-%m') + timedelta(days=rng.randint(0, 27)),
+            subscription_status=rng.choice(('active', 'canceled')),
+        ))
+        # Users drop off after a random number of days, as the funnel expects
+        db.session.execute(delete(JournalEntry).where(
+            JournalEntry.user_id == user_id, JournalEntry.day_number > rng.randint(0, 30)))
+    db.session.execute(update(JournalEntry).values(updated_date=LONG_AGO))
+    db.session.commit()
+    shift_entries(user_ids, rng, LONG_AGO)
+    return by_cohort
+
+
+def test_full_refresh_matches_recomputation(journals):
+    refresh_rollups(full=True)
+    db.session.commit()
+
+    expected = expected_rollups()
+    assert_rollups_match(expected)
+
+    users = db.session.execute(select(User)).scalars().all()
+    sizes = {rollup.cohort: (rollup.users, rollup.subscribers)
+             for rollup in db.session.execute(select(CohortRollup)).scalars()}
+    assert sizes == {
+        cohort: (len(members), sum(user.subscription_status == 'active' for user in members))
+        for cohort in COHORTS
+        for members in [[user for user in users if user.created_date.strftime('%Y-%m') == cohort]]
+    }
+    funnels = {funnel['cohort']: funnel['funnel'] for funnel in cohort_funnels()}
+    assert funnels == {
+        cohort: [expected.get((cohort, day), {}).get('entries', 0) for day in FUNNEL_DAYS] for cohort in COHORTS
+    }
+
+
+def test_incremental_refresh_only_reaggregates_changed_cohorts(journals):
+    refresh_rollups()
+    db.session.commit()
+    before = expected_rollups()
+
+    rng = random.Random(21)
+    # Saved after the refresh: picked up by the next incremental one
+    shift_entries(journals['2025-02'], rng, datetime.utcnow())
+    # Changed without moving updated_date past the watermark: only a full refresh sees it
+    shift_entries(journals['2025-03'], rng, LONG_AGO)
+    after = expected_rollups()
+    assert any(before[key] != after[key] for key in after if key[0] == '2025-03')
+
+    assert refresh_rollups() == ['2025-02']
+    db.session.commit()
+    assert_rollups_match({key: after[key] if key[0] == '2025-02' else before[key] for key in after})
+
+    assert sorted(refresh_rollups(full=True)) == list(COHORTS)
+    db.session.commit()
+    assert_rollups_match(after)
@@ -0,0 +1,44 @@
+import pytest
+
+from app import db
+from broadcasts import NAME_HTML_TAG, NAME_TAG, build_broadcast_email, claim_broadcast, create_broadcast, send_broadcast
+from email_service import EmailDeliveryError, FakeTransport
+from models import EmailSubscriber
+
+
+class RejectingTransport:
+    def send(self, mail):
+        return 500
+
+
+@pytest.fixture
+def broadcast(app):
+    db.session.add_all([EmailSubscriber(email=f'reader{n}@example.com', name=f'Reader {n}') for n in range(3)])
+    broadcast = create_broadcast('Weekly update', 'Hello {name}')
+    db.session.commit()
+    return broadcast
+
+
+def test_failed_send_releases_lease(broadcast):
+    with pytest.raises(EmailDeliveryError):
+        send_broadcast(broadcast.id, interval=0, transport=RejectingTransport())
+
+    db.session.expire_all()
+    assert broadcast.status == 'sending'
+    assert broadcast.lease_expires_at is None
+    # Resumable straight away rather than after the lease runs out
+    assert claim_broadcast(broadcast.id)
+    transport = FakeTransport()
+    assert send_broadcast(broadcast.id, interval=0, transport=transport, claimed=True) == 3
+    assert len(transport.sent) == 1
+
+
+def test_names_are_escaped_in_html_only(app):
+    broadcast = create_broadcast('Weekly update', 'Hello {name}')
+    mail = build_broadcast_email(broadcast, [(1, 'reader@example.com', '<b>Sam</b> & co')]).get()
+
+    substitutions = mail['personalizations'][0]['substitutions']
+    html_body, = [content['value'] for content in mail['content'] if content['type'] == 'text/html']
+    text_body, = [content['value'] for content in mail['content'] if content['type'] == 'text/plain']
+    assert html_body.replace(NAME_HTML_TAG, substitutions[NAME_HTML_TAG]) == '<p>Hello &lt;b&gt;Sam&lt;/b&gt; &amp; co</p>'
+    assert text_body.replace(NAME_TAG, substitutions[NAME_TAG]) == 'Hello <b>Sam</b> & co'
@@ -0,0 +1,91 @@
+import base64
+
+import pytest
+
+import drawing_store
+from app import db
+from models import JournalEntry, PDFAnnotation, User
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+PNG_DATA_URL = 'data:image/png;base64,' + base64.b64encode(PNG).decode()
+
+
+@pytest.fixture
+def user(app):
+    user = User(email='drawer@example.com', name='Drawer', subscription_status='active')
+    user.set_password('drawer')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_migrate_drawings_keeps_drawings_it_cannot_store(app, user):
+    db.session.add_all([
+        JournalEntry(user_id=user.id, day_number=1, drawing_data=PNG_DATA_URL),
+        JournalEntry(user_id=user.id, day_number=2, drawing_data='data:image/jpeg;base64,AAAA'),
+        JournalEntry(user_id=user.id, day_number=3, drawing_data='data:image/png;base64,not base64!'),
+        PDFAnnotation(user_id=user.id, page_number=1, drawing_data=PNG_DATA_URL),
+    ])
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['migrate-drawings', '--batch-size', '1'])
+    assert result.exit_code == 0, result.output
+    assert 'JournalEntry: moved 1 drawings, 2 could not be stored' in result.output
+    assert 'PDFAnnotation: moved 1 drawings, 0 could not be stored' in result.output
+
+    db.session.expire_all()
+    entries = {entry.day_number: entry for entry in JournalEntry.query.all()}
+    assert entries[1].drawing_data is None and entries[1].drawing_ref
+    assert entries[2].drawing_data.startswith('data:image/jpeg') and entries[2].drawing_ref is None
+    assert entries[3].drawing_data and entries[3].drawing_ref is None
+
+
+@pytest.fixture
+def client(app, user):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+
+def test_pages_show_legacy_drawings_until_they_are_moved(client, user):
+    db.session.add_all([
+        JournalEntry(user_id=user.id, day_number=1, drawing_data=PNG_DATA_URL),
+        PDFAnnotation(user_id=user.id, page_number=1, drawing_data=PNG_DATA_URL),
+    ])
+    db.session.commit()
+
+    for path in ('/recovery-journal?day=1', '/journal-pdf?page=1'):
+        response = client.get(path)
+        assert response.status_code == 200
+        assert f'data-drawing-url="{PNG_DATA_URL}"' in response.get_data(as_text=True)
+
+
+def test_new_snapshot_replaces_legacy_drawing(client, user):
+    db.session.add(JournalEntry(user_id=user.id, day_number=1, drawing_data=PNG_DATA_URL))
+    db.session.commit()
+
+    response = client.post('/save-journal-entry', data={'day_number': 1, 'drawing_data': ''})
+    assert response.status_code == 200, response.get_data(as_text=True)
+    db.session.expire_all()
+    entry = JournalEntry.query.filter_by(user_id=user.id, day_number=1).one()
+    assert entry.drawing_data is None and entry.drawing_ref is None
+    assert 'data-drawing-url=""' in client.get('/recovery-journal?day=1').get_data(as_text=True)
+
+
+def test_stroke_png_is_rasterized_once_per_version(client, monkeypatch):
+    rasterized = []
+    monkeypatch.setattr(drawing_store, 'rasterize_png', lambda *args: rasterized.append(args) or PNG)
+    stroke = {'tool': 'pen', 'color': '#000000', 'width': 3, 'points': [10, 10, 20, 20]}
+
+    client.post('/save-journal-entry/strokes', json={'day_number': 1, 'strokes': [stroke]})
+    first = client.get('/drawings/strokes/journal/1.png')
+    assert client.get('/drawings/strokes/journal/1.png').data == first.data == PNG
+    assert len(rasterized) == 1
+
+    # New strokes are a new version, rendered under a new ETag
+    client.post('/save-journal-entry/strokes', json={'day_number': 1, 'strokes': [stroke]})
+    second = client.get('/drawings/strokes/journal/1.png')
+    assert second.get_etag() != first.get_etag()
+    assert len(rasterized) == 2
@@ -0,0 +1,90 @@
+from datetime import datetime, timedelta
+
+import pytest
+from flask import Flask
+
+import email_outbox
+from app import db
+from email_outbox import MAX_ATTEMPTS, RETRY_BASE_SECONDS, enqueue_email, process_outbox
+from email_service import get_transport
+
+
+@pytest.fixture
+def transport(app, monkeypatch):
+    """The fake transport the worker sends through, emptied for the test"""
+    monkeypatch.setenv('EMAIL_TRANSPORT', 'fake')
+    transport = get_transport()
+    monkeypatch.setattr(transport, 'sent', [])
+    return transport
+
+
+@pytest.fixture
+def message(app):
+    message = enqueue_email('welcome', 'reader@example.com', name='Reader')
+    db.session.commit()
+    return message
+
+
+def reject_sends(transport, monkeypatch):
+    monkeypatch.setattr(transport, 'send', lambda mail: 500)
+
+
+def make_due(message):
+    message.next_attempt_at = datetime.utcnow()
+    db.session.commit()
+
+
+def test_pending_email_is_sent(transport, message):
+    assert process_outbox() == 1
+
+    assert message.status == 'sent'
+    assert message.attempts == 1 and message.sent_date and message.last_error is None
+    assert len(transport.sent) == 1
+    # Sent emails aren't claimed again
+    assert process_outbox() == 0
+
+
+def test_failed_send_is_retried_with_backoff(transport, message, monkeypatch):
+    monkeypatch.setattr(email_outbox.random, 'uniform', lambda low, high: high)
+    reject_sends(transport, monkeypatch)
+    before = datetime.utcnow()
+    process_outbox()
+
+    assert message.status == 'pending' and message.attempts == 1
+    assert 'Status code: 500' in message.last_error
+    first_delay = message.next_attempt_at - before
+    assert timedelta(seconds=RETRY_BASE_SECONDS - 1) <= first_delay <= timedelta(seconds=RETRY_BASE_SECONDS + 1)
+    # Not due yet, so the worker leaves it alone
+    assert process_outbox() == 0
+
+    make_due(message)
+    before = datetime.utcnow()
+    process_outbox()
+    assert message.attempts == 2
+    assert message.next_attempt_at - before > first_delay + timedelta(seconds=RETRY_BASE_SECONDS - 2)
+
+
+def test_email_fails_after_max_attempts(transport, message, monkeypatch):
+    reject_sends(transport, monkeypatch)
+    for _ in range(MAX_ATTEMPTS):
+        make_due(message)
+        assert process_outbox() == 1
+
+    assert message.status == 'failed' and message.attempts == MAX_ATTEMPTS
+    make_due(message)
+    assert process_outbox() == 0
+
+
+def test_in_process_worker_waits_for_first_request(monkeypatch):
+    started = []
+    monkeypatch.setattr(email_outbox, 'start_outbox_thread', lambda app, poll_interval: started.append(app))
+    server = Flask('server')
+    server.add_url_rule('/', 'index', lambda: 'ok')
+    email_outbox.start_outbox_thread_on_first_request(server)
+    # Importing the app, as flask CLI commands do, doesn't start the worker
+    assert started == []
+
+    client = server.test_client()
+    client.get('/')
+    client.get('/')
+    assert started == [server]
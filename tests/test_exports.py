@@ -0,0 +1,61 @@
+import base64
+import io
+import json
+import zipfile
+
+import pytest
+
+import drawing_store
+from app import db
+from models import JournalEntry, PDFAnnotation, User
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\x00' * 16
+PNG_DATA_URL = 'data:image/png;base64,' + base64.b64encode(PNG).decode()
+STROKE = {'tool': 'pen', 'color': '#000000', 'width': 3, 'points': [10, 10, 20, 20]}
+
+
+@pytest.fixture
+def client(app):
+    user = User(email='exporter@example.com', name='Exporter', subscription_status='active')
+    user.set_password('exporter')
+    db.session.add(user)
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+        session['_fresh'] = True
+    return client
+
+
+def export_zip(client):
+    response = client.get('/journal/export.zip')
+    assert response.status_code == 200
+    return zipfile.ZipFile(io.BytesIO(response.data))
+
+
+def test_zip_reuses_rendered_stroke_png(client, monkeypatch):
+    rasterized = []
+    monkeypatch.setattr(drawing_store, 'rasterize_png', lambda *args: rasterized.append(args) or PNG)
+    client.post('/save-journal-entry/strokes', json={'day_number': 2, 'strokes': [STROKE]})
+    client.get('/drawings/strokes/journal/2.png')
+
+    archive = export_zip(client)
+    assert archive.read('strokes/journal-day-02.png') == PNG
+    assert json.loads(archive.read('strokes/journal-day-02.json'))[0]['tool'] == 'pen'
+    assert len(rasterized) == 1
+
+
+def test_zip_includes_legacy_drawings(client):
+    user = User.query.filter_by(email='exporter@example.com').one()
+    db.session.add_all([
+        JournalEntry(user_id=user.id, day_number=1, drawing_data=PNG_DATA_URL),
+        JournalEntry(user_id=user.id, day_number=2, drawing_data='data:image/png;base64,not base64!'),
+        PDFAnnotation(user_id=user.id, page_number=3, drawing_data=PNG_DATA_URL),
+    ])
+    db.session.commit()
+
+    archive = export_zip(client)
+    assert archive.read('drawings/journal-day-01.png') == PNG
+    assert archive.read('drawings/pdf-page-003.png') == PNG
+    assert 'drawings/journal-day-02.png' not in archive.namelist()
@@ -0,0 +1,8 @@
+def test_metrics_hidden_without_token(app, monkeypatch):
+    client = app.test_client()
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', None)
+    assert client.get('/metrics').status_code == 404
+
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'scrape-secret')
+    assert client.get('/metrics').status_code == 404
+    assert client.get('/metrics', headers={'Authorization': 'Bearer scrape-secret'}).status_code == 200
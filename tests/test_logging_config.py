@@ -0,0 +1,45 @@
+import io
+import json
+import logging
+
+import pytest
+
+import logging_config
+
+
+@pytest.fixture
+def queued_json_logs(monkeypatch):
+    """Log through the background queue as JSON; returns a function that flushes and reads the lines"""
+    monkeypatch.setenv('LOG_QUEUE', '1')
+    monkeypatch.setenv('LOG_FORMAT', 'json')
+    logging_config.configure_logging()
+    output = io.StringIO()
+    logging_config._listener.handlers[0].setStream(output)
+
+    def read():
+        logging_config.stop_listener()
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    yield read
+    monkeypatch.setenv('LOG_QUEUE', '0')
+    monkeypatch.delenv('LOG_FORMAT')
+    logging_config.configure_logging()
+
+
+def test_queued_records_keep_arguments_as_logged(queued_json_logs):
+    items = ['first']
+    logging.getLogger('tests').warning("Items: %s", items)
+    items.append('second')
+
+    assert [entry['message'] for entry in queued_json_logs()] == ["Items: ['first']"]
+
+
+def test_queued_records_keep_tracebacks(queued_json_logs):
+    try:
+        raise ValueError('broken')
+    except ValueError:
+        logging.getLogger('tests').exception("Failed")
+
+    entry, = queued_json_logs()
+    assert entry['message'] == 'Failed'
+    assert 'ValueError: broken' in entry['exception']
@@ -0,0 +1,86 @@
+import json
+import os
+from datetime import datetime
+
+import pytest
+from sqlalchemy import select
+
+from app import db
+from models import StripeEvent, User
+from stripe_events import process_stripe_events, record_stripe_event
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fixtures', 'stripe_events')
+CHECKOUT = os.path.join(FIXTURES, 'checkout.session.completed.json')
+RENEWAL = os.path.join(FIXTURES, 'customer.subscription.updated.json')
+CANCEL = os.path.join(FIXTURES, 'customer.subscription.deleted.json')
+
+
+def load_event(path):
+    with open(path) as event_file:
+        return json.load(event_file)
+
+
+def replay(app, *paths):
+    result = app.test_cli_runner().invoke(args=['replay-stripe-events', *paths])
+    assert result.exit_code == 0, result.output
+    return result
+
+
+def fixture_user():
+    db.session.expire_all()
+    return db.session.execute(select(User).filter_by(email='member@example.com')).scalar_one()
+
+
+@pytest.fixture
+def member(app):
+    user = User(email='member@example.com', name='Fixture Member')
+    user.set_password('fixture')
+    db.session.add(user)
+    db.session.commit()
+    return user
+
+
+def test_checkout_activates_and_cancel_ends_subscription(app, member):
+    replay(app, CHECKOUT)
+    user = fixture_user()
+    assert user.subscription_status == 'active'
+    assert user.stripe_customer_id == 'cus_Rfixture0001'
+    assert user.stripe_subscription_id == 'sub_1Qfixture0001'
+    assert user.subscription_updated_at == datetime.utcfromtimestamp(load_event(CHECKOUT)['created'])
+
+    replay(app, RENEWAL, CANCEL)
+    user = fixture_user()
+    assert user.subscription_status == 'canceled'
+    assert user.stripe_subscription_id == 'sub_1Qfixture0001'
+    assert user.subscription_updated_at == datetime.utcfromtimestamp(load_event(CANCEL)['created'])
+    assert user.subscription_end == datetime.utcfromtimestamp(1740830400)
+    assert {event.status for event in db.session.execute(select(StripeEvent)).scalars()} == {'processed'}
+
+
+def test_redelivered_event_is_ignored(app, member):
+    replay(app, CHECKOUT)
+
+    assert not record_stripe_event(load_event(CHECKOUT))
+    result = replay(app, CHECKOUT)
+    assert 'already received' in result.output
+    assert db.session.execute(select(StripeEvent)).scalars().all()[0].attempts == 1
+
+
+def test_older_event_does_not_undo_newer_one(app, member):
+    replay(app, CANCEL)
+    replay(app, RENEWAL)
+
+    user = fixture_user()
+    assert user.subscription_status == 'canceled'
+    assert user.subscription_updated_at == datetime.utcfromtimestamp(load_event(CANCEL)['created'])
+    # The stale event is still marked handled, so it isn't retried
+    assert db.session.get(StripeEvent, load_event(RENEWAL)['id']).status == 'processed'
+
+
+def test_late_checkout_does_not_reactivate_canceled_subscription(app, member):
+    for path in (CANCEL, CHECKOUT):
+        assert record_stripe_event(load_event(path))
+        db.session.commit()
+        process_stripe_events([load_event(path)['id']])
+
+    assert fixture_user().subscription_status == 'canceled'
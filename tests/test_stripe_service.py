@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy import inspect, select, text
+
+import stripe_service
+from app import db
+from migrations import _set_schema_version, migrate_database
+from models import CheckoutSession
+from stripe_service import create_checkout_session, forget_checkout_session
+
+
+class RecordingGateway:
+    """Fails the first ``failures`` calls, then creates a session per idempotency key"""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.keys = []
+
+    def create_checkout_session(self, params, idempotency_key=None):
+        self.keys.append((idempotency_key, params['expires_at']))
+        if len(self.keys) <= self.failures:
+            raise TimeoutError('Read timed out')
+        return SimpleNamespace(id=f'cs_{idempotency_key}', url=f'https://checkout.example.com/{idempotency_key}')
+
+
+@pytest.fixture
+def gateway(app, monkeypatch):
+    gateway = RecordingGateway(failures=1)
+    monkeypatch.setattr(stripe_service, '_gateway', gateway)
+    return gateway
+
+
+def test_retry_reuses_key_until_session_is_forgotten(gateway):
+    assert create_checkout_session('member@example.com', 'Member') is None
+    db.session.rollback()
+
+    url = create_checkout_session('member@example.com', 'Member')
+    db.session.commit()
+    assert create_checkout_session('member@example.com', 'Member') == url
+    # The failed attempt was repeated with the same key and parameters
+    assert len(gateway.keys) == 2 and gateway.keys[0] == gateway.keys[1]
+
+    checkout = db.session.execute(select(CheckoutSession)).scalar_one()
+    assert checkout.url == url and checkout.stripe_session_id == f'cs_{gateway.keys[0][0]}'
+
+    forget_checkout_session(checkout.stripe_session_id)
+    db.session.commit()
+    assert create_checkout_session('member@example.com', 'Member') != url
+    assert gateway.keys[2][0] != gateway.keys[0][0]
+
+
+def test_migration_rebuilds_checkout_sessions(app):
+    CheckoutSession.__table__.drop(db.engine)
+    db.session.execute(text(
+        "CREATE TABLE checkout_session (id INTEGER PRIMARY KEY, user_email VARCHAR(120) NOT NULL UNIQUE, "
+        "stripe_session_id VARCHAR(255) NOT NULL, url TEXT NOT NULL, expires_at DATETIME NOT NULL, created_date DATETIME)"
+    ))
+    _set_schema_version(6)
+    db.session.commit()
+
+    assert [number for number, _ in migrate_database()] == [7]
+    columns = {column['name']: column for column in inspect(db.engine).get_columns('checkout_session')}
+    assert 'idempotency_key' in columns and columns['url']['nullable']